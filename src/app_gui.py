@@ -1,29 +1,55 @@
 import tkinter as tk
 from tkinter import scrolledtext
 import asyncio
+import threading
+import time
 from tkinter import ttk
-from gpt_controller import GPTController
-from transcriber import AudioRecorder, AudioTranscriber
-from test_prompt import test_transcription
+from transcriber import AudioRecorder, LiveTranscriber
+from pipeline import ConsultationPipeline
+from metrics import metrics
+from ui_render import RenderScheduler, TextView
+from consultation_store import ConsultationStore
+from audio_processing import new_recording_name
 
 class AppGUI:
-    def __init__(self, audio_recorder: AudioRecorder, audio_transcriber: AudioTranscriber, gpt_controller: GPTController, asyncio_loop: asyncio.BaseEventLoop, terminate_event: asyncio.Event):
+    # startup_cback(phase), when given, is told when the 'window' is shown and the audio 'devices' are listed
+    def __init__(self, audio_recorder: AudioRecorder, pipeline: ConsultationPipeline, asyncio_loop: asyncio.BaseEventLoop, terminate_event: asyncio.Event, live_transcriber: LiveTranscriber = None,
+                 startup_cback=None, input_channels: int = 1, max_fps: float = 30, transcript_max_chars: int = 20000,
+                 store: ConsultationStore = None, recordings_dir: str = '.'):
         self.audio_recorder = audio_recorder
-        self.audio_transcriber = audio_transcriber
-        self.gpt_controller = gpt_controller
+        self.pipeline = pipeline
+        self.live_transcriber = live_transcriber
+        self.live_session = None
+        self.rolling_summary = None
+        self.warming = None # connections kept open while recording
         self.asyncio_loop = asyncio_loop
         self.terminate_event = terminate_event
         self.audio_input_dropdown = None
+        self.second_input_dropdown = None
+        self.input_channels = input_channels # channels recorded from a single input, e.g. a stereo interface with one mic per speaker
         self.device_map = {}
         self.capture_button = None
+        self.language = 'en' # 'pt-BR'
+        self.store = store # past consultations, searched in the history tab
+        self.recordings_dir = recordings_dir
+        self.consultation_id = 0 # last started consultation, its transcription is on screen
+        self.report_consultation_id = None # consultation whose report is on screen
+        self.stop_times = {} # consultation id -> when stop was pressed, for the stop-to-report time
+        self.startup_cback = startup_cback
+        self.default_device_name = None
+        self.transcript_max_chars = transcript_max_chars # longer transcripts only show their end
 
         # create the main window
         self.root = tk.Tk() 
         self.root.title("Med Assist AI")
         self.root.protocol("WM_DELETE_WINDOW", self.close_program)
+        # streamed transcripts and report deltas are rendered at most max_fps times per second
+        self.render_scheduler = RenderScheduler(self.root, max_fps)
         self.create_widgets()
 
     def run_mainloop(self):
+        if self.startup_cback is not None:
+            self.root.after_idle(self.startup_cback, 'window')
         self.root.mainloop()
     
     def close_program(self):
@@ -48,19 +74,23 @@ class AppGUI:
         audio_input_label = tk.Label(self.tab1, text="Input:")
         audio_input_label.grid(row=0, column=0, padx=5, pady=5)
 
-        # dropdown for audio input
-        self.find_devices()
-        device_names = [x for x in self.device_map.keys() if x != 'None']
-        device_names.insert(0, 'None') # make 'None' first element
-        self.audio_input_dropdown = DeviceSelectDropdown(self.tab1, 0, 1, device_names, self.stop_audio_recording)
-        # set the default microphone
-        if self.default_device_name is not None:
-            self.audio_input_dropdown.selected_option.set(self.default_device_name)
+        # dropdown for audio input, filled once the devices are enumerated in the background
+        self.audio_input_dropdown = DeviceSelectDropdown(self.tab1, 0, 1, ['loading devices...'], self.stop_audio_recording)
+
+        # optional second input (e.g. the patient's microphone), recorded as its own channel
+        second_input_label = tk.Label(self.tab1, text="Input 2:")
+        second_input_label.grid(row=0, column=2, padx=5, pady=5)
+        self.second_input_dropdown = DeviceSelectDropdown(self.tab1, 0, 3, ['None'], self.stop_audio_recording)
+        threading.Thread(target=self.load_devices, daemon=True).start()
 
-        # start/stop capture button
-        self.capture_button = tk.Button(self.tab1, text="Start\nConsultation", command=self.toggle_capture)
+        # start/stop capture button, enabled with the devices
+        self.capture_button = tk.Button(self.tab1, text="Start\nConsultation", command=self.toggle_capture, state=tk.DISABLED)
         self.capture_button.grid(row=0, column=4, padx=20, pady=20, columnspan=3, rowspan=2, ipadx=20, ipady=20)
 
+        # pipeline progress
+        self.status_label = tk.Label(self.tab1, text="", justify='left')
+        self.status_label.grid(row=1, column=0, padx=5, pady=5, columnspan=3)
+
         # transcribed text label
         label_textbox_left = tk.Label(self.tab1, text="Consultation Transcription:", justify='left')
         label_textbox_left.grid(row=2, column=0, padx=5, pady=5)
@@ -77,6 +107,7 @@ class AppGUI:
         # LEFT text box
         self.textbox_left = scrolledtext.ScrolledText(self.tab1, wrap=tk.WORD, height=25, width=50)
         self.textbox_left.grid(row=3, column=0, padx=10, pady=10, columnspan=3, rowspan=6, sticky='nsew')
+        self.transcript_view = TextView(self.textbox_left, self.render_scheduler, self.transcript_max_chars)
 
         # RIGHT text boxes
         self.textbox_right = scrolledtext.ScrolledText(self.tab1, wrap=tk.WORD, height=10, width=50)
@@ -87,6 +118,8 @@ class AppGUI:
 
         self.textbox_right3 = scrolledtext.ScrolledText(self.tab1, wrap=tk.WORD, height=10, width=50)
         self.textbox_right3.grid(row=7, column=4, padx=10, pady=10, columnspan=2, sticky='nsew')
+        self.report_views = {key: TextView(textbox, self.render_scheduler) for key, textbox in
+                             (('summary', self.textbox_right), ('symptoms', self.textbox_right2), ('diagnoses', self.textbox_right3))}
 
         ############## second tab
         self.tab2 = ttk.Frame(self.notebook)
@@ -95,8 +128,91 @@ class AppGUI:
         # base prompt textbox
         self.textbox_base_prompt = scrolledtext.ScrolledText(self.tab2, wrap=tk.WORD, height=30, width=100, background='#f0f0f0')
         self.textbox_base_prompt.grid(row=1, column=0, padx=10, pady=10, columnspan=5,  sticky='nsew')
+
+        ############## history tab
+        if self.store is not None:
+            self.create_history_tab()
+
+    def create_history_tab(self):
+        self.tab3 = ttk.Frame(self.notebook)
+        self.notebook.add(self.tab3, text='History')
+        tk.Label(self.tab3, text="Search:").grid(row=0, column=0, padx=5, pady=5)
+        self.search_text = tk.StringVar(self.tab3)
+        search_entry = tk.Entry(self.tab3, textvariable=self.search_text, width=60)
+        search_entry.grid(row=0, column=1, padx=5, pady=5, sticky='ew')
+        self.search_text.trace_add('write', lambda *args: self.schedule_search())
+        self.search_job = None
+        self.search_results = []
+        self.results_list = tk.Listbox(self.tab3, height=30, width=70)
+        self.results_list.grid(row=1, column=0, padx=10, pady=10, columnspan=2, sticky='nsew')
+        self.results_list.bind('<<ListboxSelect>>', lambda e: self.show_consultation())
+        self.textbox_history = scrolledtext.ScrolledText(self.tab3, wrap=tk.WORD, height=30, width=70)
+        self.textbox_history.grid(row=1, column=2, padx=10, pady=10, sticky='nsew')
+        # the list is refreshed when the tab is opened
+        self.notebook.bind('<<NotebookTabChanged>>', lambda e: self.search() if self.notebook.select() == str(self.tab3) else None)
+
+    # search while typing, once the typing pauses
+    def schedule_search(self):
+        if self.search_job is not None:
+            self.root.after_cancel(self.search_job)
+        self.search_job = self.root.after(150, self.search)
+
+    def search(self):
+        self.search_job = None
+        start = time.perf_counter()
+        try:
+            self.search_results = self.store.search(self.search_text.get())
+        except Exception as e:
+            # incomplete queries are expected while typing
+            print(f"search exception {e}")
+            return
+        metrics.record('search', time.perf_counter() - start)
+        self.results_list.delete(0, tk.END)
+        for result in self.search_results:
+            started = time.strftime('%Y-%m-%d %H:%M', time.localtime(result['started']))
+            self.results_list.insert(tk.END, f"{result['id']}. {started} [{result['status']}] {' '.join(result['snippet'].split())}")
+
+    def show_consultation(self):
+        selection = self.results_list.curselection()
+        if not selection:
+            return
+        consultation = self.store.get(self.search_results[selection[0]]['id'])
+        if consultation is None:
+            return
+        text = [f"Consultation {consultation['id']}, {time.strftime('%Y-%m-%d %H:%M', time.localtime(consultation['started']))}",
+                f"Recording: {consultation['audio_file']}"]
+        if consultation['error']:
+            text.append(f"Error: {consultation['error']}")
+        for title, key in (('Appointment Summary', 'summary'), ('Reported Symptoms', 'symptoms'), ('Possible Diagnoses', 'diagnoses'),
+                           ('Transcription', 'transcription')):
+            text.append(f"\n{title}:\n{consultation[key] or ''}")
+        self.textbox_history.delete('1.0', tk.END)
+        self.textbox_history.insert(tk.END, '\n'.join(text))
         
 
+    # initializing PortAudio and querying every device can take seconds, the window shows first
+    def load_devices(self):
+        try:
+            self.audio_recorder.open_audio()
+            self.find_devices()
+        except Exception as e:
+            print(f"audio device enumeration exception {e}")
+            self.device_map['None'] = None
+        try:
+            self.root.after(0, self.show_devices)
+        except RuntimeError:
+            pass # window already closed
+
+    def show_devices(self):
+        device_names = [x for x in self.device_map.keys() if x != 'None']
+        device_names.insert(0, 'None') # make 'None' first element
+        # set the default microphone
+        self.audio_input_dropdown.set_options(device_names, self.default_device_name or 'None')
+        self.second_input_dropdown.set_options(device_names, 'None')
+        self.capture_button.config(state=tk.NORMAL)
+        if self.startup_cback is not None:
+            self.startup_cback('devices')
+
     def find_devices(self):
         # query and map audio input devices
         num_devices = self.audio_recorder.p.get_device_count()
@@ -118,91 +234,156 @@ class AppGUI:
     def start_audio_recording(self):
         print("starting audio recording...")
         # # get selected
-        device_info = self.device_map[self.audio_input_dropdown.selected_option.get()]
-        source_rate = int(device_info['defaultSampleRate'])
+        device_info = self.device_map.get(self.audio_input_dropdown.selected_option.get())
         if device_info == None:
             print("no audio input device selected")
             return
-        device_id = device_info['index']
-        print('device_id', device_id)
-        self.audio_recorder.start(device_id, source_rate, file_name="consultation_audio.wav")
+        inputs = self.get_inputs(device_info)
+        channels = sum(x[2] for x in inputs)
+        print('inputs', inputs)
+        # one recording per consultation, named uniquely: without a store the ids restart with every launch
+        file_name = new_recording_name(self.recordings_dir, self.audio_recorder.audio_format)
+        # the store assigns the ids, unique among the workstations and the server sharing it
+        consultation_id = self.store.start(self.language, file_name) if self.store is not None else None
+        self.consultation_id = consultation_id if consultation_id is not None else self.consultation_id + 1
+        self.clear_log()
+        audio_cback = None
+        if self.live_transcriber is not None:
+            # stream the audio while recording so only the last second is left to transcribe on stop
+            consultation_id = self.consultation_id
+            transcript_cback = lambda transcription, is_final: self.set_live_transcript_callback(consultation_id, transcription, is_final)
+            # the report is kept up to date during the recording when the pipeline does rolling summaries
+            self.rolling_summary = self.pipeline.start_rolling_summary(consultation_id)
+            segment_cback = self.rolling_summary.add_segment if self.rolling_summary is not None else None
+            self.live_session = self.live_transcriber.start(self.asyncio_loop, transcript_cback, language=self.language, sample_rate=self.audio_recorder.sample_rate,
+                                                            channels=channels, segment_cback=segment_cback)
+            audio_cback = self.live_session.send_audio
+        else:
+            # without live transcription the pipeline may upload the recording as it is made
+            self.live_session = self.pipeline.start_upload(self.asyncio_loop, self.language, self.audio_recorder.sample_rate, channels)
+            if self.live_session is not None:
+                audio_cback = self.live_session.send_audio
+        self.audio_recorder.start_inputs(inputs, file_name=file_name, audio_cback=audio_cback)
+        if self.audio_recorder.stream is None:
+            self.abort_audio_recording('the audio input could not be opened')
+            return
+        self.warming = self.pipeline.start_warming(self.asyncio_loop, live=self.live_transcriber is not None)
         self.capture_button.config(text="Stop and\nGenerate Report")
+        self.update_recording_status()
+
+    # the inputs didn't open: give up the sessions started for the recording, nothing will be sent to them
+    def abort_audio_recording(self, error: str):
+        live_session, self.live_session = self.live_session, None
+        if live_session is not None:
+            live_session.closed = True
+            live_session.future.cancel()
+        rolling_summary, self.rolling_summary = self.rolling_summary, None
+        if rolling_summary is not None:
+            self.asyncio_loop.call_soon_threadsafe(rolling_summary.cancel)
+        if self.store is not None:
+            self.store.save_report(self.consultation_id, {}, 'error', error)
+        if self.capture_button:
+            self.capture_button.config(text="Start\nConsultation")
+        self.status_label.config(text=f"consultation {self.consultation_id}: {error}")
+
+    # (device_id, source_rate, channels) of each stream to record, one channel per speaker when there are several.
+    # with a second input both are recorded mono, otherwise the first input gives input_channels channels if it has them
+    def get_inputs(self, device_info):
+        second_info = self.device_map.get(self.second_input_dropdown.selected_option.get())
+        if second_info is not None and second_info['index'] == device_info['index']:
+            second_info = None
+        channels = 1 if second_info is not None else max(min(self.input_channels, int(device_info['maxInputChannels'])), 1)
+        inputs = [(device_info['index'], int(device_info['defaultSampleRate']), channels)]
+        if second_info is not None:
+            inputs.append((second_info['index'], int(second_info['defaultSampleRate']), 1))
+        return inputs
 
+    # show the capture health while recording
+    def update_recording_status(self):
+        if self.audio_recorder.stream is None:
+            return
+        stats = self.audio_recorder.get_stats()
+        self.status_label.config(text=(f"consultation {self.consultation_id}: recording... buffer {stats['queue_depth']:.1f}s, "
+                                       f"dropped {stats['overruns'] + stats['input_overflows']}, callback max {stats['max_callback_time'] * 1000:.1f}ms"))
+        self.root.after(1000, self.update_recording_status)
+
+    # hand the recording over to the pipeline, the GUI stays free to start the next consultation
     def stop_audio_recording(self):
+        if self.audio_recorder.stream is None and self.live_session is None:
+            return # device changed while not recording
         print("stopping audio recording...")
-        file_name = self.audio_recorder.stop()
+        self.stop_times[self.consultation_id] = time.perf_counter()
+        with metrics.span('record_stop', self.consultation_id):
+            file_name = self.audio_recorder.stop()
+        if file_name is not None and self.store is not None:
+            self.store.save_audio_file(self.consultation_id, file_name) # the format may have fallen back to WAV
         if self.capture_button:
             self.capture_button.config(text="Start\nConsultation")
-        if file_name is None:
+        if self.warming is not None:
+            self.warming.cancel() # the open connections stay in the pool
+            self.warming = None
+        live_session, self.live_session = self.live_session, None
+        rolling_summary, self.rolling_summary = self.rolling_summary, None
+        if file_name is None and live_session is None:
             return
-        file_name = "oet-speaking-sample-role-play-medicine.mp3" # TEST: use test audio
-        # transcription = self.audio_transcriber.transcribe(file_name, language='pt-BR')
-        transcription = self.audio_transcriber.transcribe(file_name, language='en')
-        # transcription = test_transcription # TEST: use test transcription
-        if transcription is None:
+        asyncio.run_coroutine_threadsafe(self.pipeline.run(self.consultation_id, file_name, live_session, self.language, self.set_pipeline_event_callback,
+                                                           rolling_summary), self.asyncio_loop)
+
+    def set_pipeline_event_callback(self, consultation_id, event, data):
+        self.render_scheduler.call(self.render_pipeline_event, consultation_id, event, data, time.perf_counter())
+    # ui_render: from the event being emitted to its rendering done, streamed deltas are not recorded
+    def render_pipeline_event(self, consultation_id, event, data, emitted):
+        self.update_ui_with_pipeline_event(consultation_id, event, data)
+        if event == 'section' and data[2]:
             return
-        self.update_log(transcription)
-        
-        self.update_ui_with_resume("processing...")
-        self.update_ui_with_symptoms("processing...")
-        self.update_ui_with_diagnostics("processing...")
-
-        print("sending resume query...")
-        messages = [
-            {'role': 'system', 'content': ("Act as a medical assistant whose goal is to summarize medical consultations. "
-                                           "These consultations are in the form of transcripts, generated from audio recordings that may contain capture errors. "
-                                           "The medical assistant must be able to summarize the transcript of the consultation in a short and objective text, keeping the most important information. "
-                                           "Do not explain or make any comments. Write only the summary of the consultation and nothing more.")},
-            {'role': 'user', 'content': transcription}
-        ]
-        asyncio.run_coroutine_threadsafe(self.gpt_controller.send_query(messages, self.set_resume_callback), self.asyncio_loop)
-    
-        print("sending symptoms query...")
-        messages = [
-            {'role': 'system', 'content': ("Act as a medical assistant whose objective is to list all the symptoms reported by the patient during a medical consultation. "
-                                           "These consultations are in the form of transcriptions, generated from audio recordings that may contain capture errors. "
-                                           "The medical assistant must be capable of gathering all reported symptoms, in order of medical importance, into a simple and objective list. "
-                                           "Do not explain or make any comments. Write only the list and nothing more.")},
-            {'role': 'user', 'content': transcription}
-        ]
-        asyncio.run_coroutine_threadsafe(self.gpt_controller.send_query(messages, self.set_symptoms_callback), self.asyncio_loop)
-        
-        print("sending diagnostics query...")
-        messages = [
-            {'role': 'system', 'content': ("Act as a medical assistant whose objective is to list all possible diagnoses of a patient in a medical consultation. "
-                                           "These consultations are in the form of transcripts, generated from audio recordings that may contain capture errors. "
-                                           "The medical assistant must be able to gather all possible diagnoses, in order of medical importance, in a simple and objective list. "
-                                           "Do not explain or make any comments. Just list the diagnoses with a brief description of the reason.")},
-            {'role': 'user', 'content': transcription}
-        ]
-        asyncio.run_coroutine_threadsafe(self.gpt_controller.send_query(messages, self.set_diagnostics_callback), self.asyncio_loop)
-
-    def set_resume_callback(self, resume_msg):
-        print("setting resume callback...")
-        self.root.after(0, self.update_ui_with_resume, resume_msg.content)
-    def update_ui_with_resume(self, resume):
-        print("updating UI with resume...")
-        self.textbox_right.delete('1.0', tk.END)
-        self.textbox_right.insert(tk.END, resume)
-        self.textbox_right.see(tk.END)
-
-    def set_symptoms_callback(self, symptoms_msg):
-        print("setting symptoms callback...")
-        self.root.after(0, self.update_ui_with_symptoms, symptoms_msg.content)
-    def update_ui_with_symptoms(self, symptoms):
-        print("updating UI with symptoms...")
-        self.textbox_right2.delete('1.0', tk.END)
-        self.textbox_right2.insert(tk.END, symptoms)
-        self.textbox_right2.see(tk.END)
-
-    def set_diagnostics_callback(self, diagnostics_msg):
-        print("setting diagnostics callback...")
-        self.root.after(0, self.update_ui_with_diagnostics, diagnostics_msg.content)
-    def update_ui_with_diagnostics(self, diagnostics):
-        print("updating UI with diagnostics...")
-        self.textbox_right3.delete('1.0', tk.END)
-        self.textbox_right3.insert(tk.END, diagnostics)
-        self.textbox_right3.see(tk.END)
+        metrics.record('ui_render', time.perf_counter() - emitted, consultation_id, event=event)
+        if event in ('done', 'error'):
+            stopped = self.stop_times.pop(consultation_id, None)
+            # failed consultations only get their totals written
+            metrics.finish_consultation(consultation_id, time.perf_counter() - stopped if stopped is not None and event == 'done' else None)
+    def update_ui_with_pipeline_event(self, consultation_id, event, data):
+        if event == 'status' or event == 'error':
+            self.status_label.config(text=f"consultation {consultation_id}: {data}")
+        elif event == 'transcription':
+            # don't overwrite the transcription of a newer consultation
+            if consultation_id == self.consultation_id:
+                self.update_log(data)
+        elif event == 'analysis':
+            # newest report wins the panes
+            if self.report_consultation_id is None or consultation_id >= self.report_consultation_id:
+                self.report_consultation_id = consultation_id
+                for view in self.report_views.values():
+                    view.set_placeholder("processing...")
+        elif event == 'section' and consultation_id == self.report_consultation_id:
+            key, text, append = data
+            update = {'summary': self.update_ui_with_resume, 'symptoms': self.update_ui_with_symptoms, 'diagnoses': self.update_ui_with_diagnostics}[key]
+            update(text, append)
+        elif event == 'section_error' and consultation_id == self.report_consultation_id:
+            key, error = data
+            # keep what was already streamed
+            self.report_views[key].append(f"\n[{error}]")
+
+    def update_ui_with_resume(self, resume, append=False):
+        if not append:
+            print("updating UI with resume...")
+        self.render_pane(self.report_views['summary'], resume, append)
+
+    def update_ui_with_symptoms(self, symptoms, append=False):
+        if not append:
+            print("updating UI with symptoms...")
+        self.render_pane(self.report_views['symptoms'], symptoms, append)
+
+    def update_ui_with_diagnostics(self, diagnostics, append=False):
+        if not append:
+            print("updating UI with diagnostics...")
+        self.render_pane(self.report_views['diagnoses'], diagnostics, append)
+
+    # replace the pane content, or append a streamed delta (the first one replaces the placeholder)
+    def render_pane(self, view, text, append=False):
+        if append:
+            view.append(text)
+        else:
+            view.set(text)
 
     def toggle_capture(self):
         print("toggling capture...")
@@ -211,22 +392,29 @@ class AppGUI:
         else:
             self.stop_audio_recording()
 
-    def update_log(self, message, color='black'):
-        print (f"updating log with message: {message}")
-        def task():
-            self.textbox_left.insert(tk.END, message)
-            self.textbox_left.see(tk.END)
-        self.root.after(0, task)
+    def set_live_transcript_callback(self, consultation_id, transcription, is_final):
+        if consultation_id == self.consultation_id:
+            self.render_scheduler.call(self.update_log_live, consultation_id, transcription, is_final)
+    def update_log_live(self, consultation_id, transcription, is_final):
+        if consultation_id != self.consultation_id:
+            return
+        # interim results are replaced by the next result, final ones are kept
+        if is_final:
+            self.transcript_view.set_interim('')
+            self.transcript_view.append(transcription)
+        else:
+            self.transcript_view.set_interim(" " + transcription)
+
+    # replaces the transcription
+    def update_log(self, message):
+        print (f"updating log with message: {message[:200]}")
+        self.transcript_view.set(message)
 
     def clear_log(self):
-        self.textbox_left.configure(state='normal')
-        self.textbox_left.delete('1.0', tk.END)
+        self.transcript_view.clear()
 
     def fill_results(self, results):
-        # clear guru textbox
-        self.textbox_right.delete('1.0', tk.END)
-        self.textbox_right.insert(tk.END, results)
-        self.textbox_right.see(tk.END)
+        self.report_views['summary'].set(results)
 
 class DeviceSelectDropdown:
     def __init__(self, master, row, col, device_names, device_changed_callback):
@@ -238,6 +426,13 @@ class DeviceSelectDropdown:
         self.audio_input_dropdown = tk.OptionMenu(master, self.selected_option, *device_names)
         self.audio_input_dropdown.grid(row=row, column=col, padx=5, pady=5)
 
+    def set_options(self, device_names, selected):
+        menu = self.audio_input_dropdown['menu']
+        menu.delete(0, 'end')
+        for name in device_names:
+            menu.add_command(label=name, command=tk._setit(self.selected_option, name))
+        self.selected_option.set(selected)
+
     def device_changed(self, *args):
         # handle selected device change
         self.device_changed_callback()
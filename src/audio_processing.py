@@ -0,0 +1,255 @@
+import io
+import os
+import threading
+import time
+import uuid
+import wave
+from lazy_import import lazy_import
+np = lazy_import('numpy') # imported on first use, see lazy_import.py
+
+soundfile = lazy_import('soundfile', optional=True) # optional, without it recordings are written as WAV
+encode_lock = threading.Lock() # chunks are encoded from several threads, the lazy import isn't thread safe before python 3.12
+
+# streaming resampler for 16-bit mono PCM: windowed-sinc low-pass (anti-aliasing) followed by
+# linear interpolation, keeping filter history and phase between blocks so there are no seams
+class StreamResampler:
+    def __init__(self, source_rate: int, target_rate: int = 16000, num_taps: int = 63):
+        self.source_rate = int(source_rate)
+        self.target_rate = int(target_rate)
+        self.step = self.source_rate / self.target_rate
+        self.taps = None
+        if self.source_rate > self.target_rate:
+            # cut a bit below the target nyquist frequency
+            cutoff = 0.9 * (self.target_rate / 2) / self.source_rate
+            n = np.arange(num_taps) - (num_taps - 1) / 2
+            taps = 2 * cutoff * np.sinc(2 * cutoff * n) * np.hamming(num_taps)
+            self.taps = (taps / taps.sum()).astype(np.float32)
+        self.history = np.zeros(num_taps - 1 if self.taps is not None else 0, dtype=np.float32)
+        self.last = np.float32(0)
+        self.pos = 1.0 # next output position, index 0 is the last sample of the previous block
+
+    def process(self, in_data: bytes):
+        if self.source_rate == self.target_rate:
+            return in_data
+        samples = np.frombuffer(in_data, dtype=np.int16).astype(np.float32)
+        if self.taps is not None:
+            x = np.concatenate((self.history, samples))
+            self.history = x[len(x) - len(self.history):]
+            samples = np.convolve(x, self.taps, mode='valid').astype(np.float32)
+        y = np.concatenate(([self.last], samples))
+        last_index = len(y) - 1
+        if self.pos > last_index:
+            self.pos -= last_index
+            self.last = y[-1]
+            return b''
+        positions = self.pos + np.arange(int((last_index - self.pos) // self.step) + 1) * self.step
+        out = np.interp(positions, np.arange(len(y)), y)
+        self.pos = positions[-1] + self.step - last_index
+        self.last = y[-1]
+        return np.clip(np.round(out), -32768, 32767).astype(np.int16).tobytes()
+
+# preallocated single-producer / single-consumer ring of int16 samples.
+# the producer only moves write_index and the consumer only moves read_index, so no lock is needed
+class RingBuffer:
+    def __init__(self, capacity: int):
+        self.buffer = np.zeros(capacity, dtype=np.int16)
+        self.capacity = capacity
+        self.write_index = 0 # total samples written
+        self.read_index = 0 # total samples read
+        self.overruns = 0 # blocks dropped because the buffer was full
+        self.max_depth = 0
+
+    def depth(self):
+        return self.write_index - self.read_index
+
+    # called from the audio callback, never blocks: drops the block when there is no room
+    def write(self, in_data: bytes):
+        samples = np.frombuffer(in_data, dtype=np.int16)
+        n = len(samples)
+        depth = self.write_index - self.read_index
+        if depth + n > self.capacity:
+            self.overruns += 1
+            return False
+        start = self.write_index % self.capacity
+        first = min(n, self.capacity - start)
+        self.buffer[start:start + first] = samples[:first]
+        self.buffer[:n - first] = samples[first:]
+        # publish only after the copy
+        self.write_index += n
+        self.max_depth = max(self.max_depth, depth + n)
+        return True
+
+    # called from the writer thread, returns every available sample
+    def read(self):
+        n = self.write_index - self.read_index
+        if n == 0:
+            return b''
+        start = self.read_index % self.capacity
+        first = min(n, self.capacity - start)
+        data = self.buffer[start:start + first].tobytes() + self.buffer[:n - first].tobytes()
+        self.read_index += n
+        return data
+
+# writes 16-bit PCM WAV as frames arrive, channels interleaved
+class WaveSink:
+    def __init__(self, file_name: str, sample_rate: int, channels: int = 1):
+        self.file_name = file_name
+        self.wave_file = wave.open(file_name, 'wb')
+        self.wave_file.setnchannels(channels)
+        self.wave_file.setsampwidth(2)
+        self.wave_file.setframerate(sample_rate)
+
+    def write(self, frames: bytes):
+        self.wave_file.writeframes(frames)
+
+    def close(self):
+        self.wave_file.close()
+
+# incremental FLAC / Ogg Opus encoding through libsndfile, no post-processing at stop time
+class SoundFileSink:
+    formats = {'.flac': ('FLAC', 'PCM_16'), '.opus': ('OGG', 'OPUS'), '.ogg': ('OGG', 'OPUS')}
+
+    def __init__(self, file_name: str, sample_rate: int, channels: int = 1):
+        self.file_name = file_name
+        self.channels = channels
+        file_format, subtype = self.formats[os.path.splitext(file_name)[1].lower()]
+        self.sound_file = soundfile.SoundFile(file_name, 'w', samplerate=sample_rate, channels=channels, format=file_format, subtype=subtype)
+
+    def write(self, frames: bytes):
+        self.sound_file.write(np.frombuffer(frames, dtype=np.int16).reshape(-1, self.channels))
+
+    def close(self):
+        self.sound_file.close()
+
+# path of a new recording in directory, unique across runs and the processes sharing the directory
+def new_recording_name(directory: str, audio_format: str):
+    name = f"consultation_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:8]}.{audio_format.strip('.') or 'wav'}"
+    return os.path.join(directory, name)
+
+# the container is chosen by the file extension: .wav, .flac or .opus/.ogg
+def open_audio_sink(file_name: str, sample_rate: int, channels: int = 1):
+    extension = os.path.splitext(file_name)[1].lower()
+    if extension in SoundFileSink.formats:
+        if soundfile is not None:
+            return SoundFileSink(file_name, sample_rate, channels)
+        print(f"soundfile not installed, recording {extension} as WAV")
+        file_name = os.path.splitext(file_name)[0] + '.wav'
+    return WaveSink(file_name, sample_rate, channels)
+
+# (channels, seconds) of an in-memory WAV/FLAC/OGG recording, None when it can't be read (e.g. mp3 without soundfile support)
+def audio_info(data: bytes):
+    try:
+        with wave.open(io.BytesIO(data), 'rb') as wave_file:
+            return wave_file.getnchannels(), wave_file.getnframes() / wave_file.getframerate()
+    except Exception:
+        pass
+    if soundfile is None:
+        return None
+    try:
+        info = soundfile.info(io.BytesIO(data))
+        return info.channels, info.duration
+    except Exception:
+        return None
+
+# same as audio_info for a file, only its header is read
+def audio_file_info(file_name: str):
+    try:
+        with wave.open(file_name, 'rb') as wave_file:
+            return wave_file.getnchannels(), wave_file.getnframes() / wave_file.getframerate()
+    except Exception:
+        pass
+    if soundfile is None:
+        return None
+    try:
+        info = soundfile.info(file_name)
+        return info.channels, info.duration
+    except Exception:
+        return None
+
+# decode a recording to 16-bit samples, returns (samples, sample_rate).
+# channels are mixed to mono unless keep_channels, then samples has one column per channel.
+# WAV is read directly, other formats need soundfile
+def read_pcm(file_name: str, keep_channels: bool = False):
+    if os.path.splitext(file_name)[1].lower() == '.wav':
+        with wave.open(file_name, 'rb') as wave_file:
+            if wave_file.getsampwidth() != 2:
+                raise ValueError(f"{file_name}: only 16-bit WAV is supported")
+            samples = np.frombuffer(wave_file.readframes(wave_file.getnframes()), dtype=np.int16)
+            channels, sample_rate = wave_file.getnchannels(), wave_file.getframerate()
+    else:
+        if soundfile is None:
+            raise ValueError(f"{file_name}: soundfile is needed to decode this format")
+        samples, sample_rate = soundfile.read(file_name, dtype='int16', always_2d=True)
+        channels = samples.shape[1]
+        samples = samples.reshape(-1)
+    if keep_channels:
+        return samples.reshape(-1, channels), sample_rate
+    if channels > 1:
+        samples = samples.reshape(-1, channels).mean(axis=1).astype(np.int16)
+    return samples, sample_rate
+
+# frames start to stop of a recording as blocks of 16-bit samples (one column per channel), only one block is in memory
+# at a time. returns (sample_rate, channels, blocks). WAV is read directly, other formats need soundfile
+def read_pcm_blocks(file_name: str, block_frames: int = 1 << 18, start: int = 0, stop: int = None):
+    if os.path.splitext(file_name)[1].lower() == '.wav':
+        wave_file = wave.open(file_name, 'rb')
+        if wave_file.getsampwidth() != 2:
+            wave_file.close()
+            raise ValueError(f"{file_name}: only 16-bit WAV is supported")
+        channels = wave_file.getnchannels()
+        def blocks():
+            with wave_file:
+                wave_file.setpos(min(start, wave_file.getnframes()))
+                remaining = (wave_file.getnframes() if stop is None else stop) - start
+                while remaining > 0:
+                    data = wave_file.readframes(min(block_frames, remaining))
+                    if not data:
+                        return
+                    block = np.frombuffer(data, dtype=np.int16).reshape(-1, channels)
+                    remaining -= len(block)
+                    yield block
+        return wave_file.getframerate(), channels, blocks()
+    if soundfile is None:
+        raise ValueError(f"{file_name}: soundfile is needed to decode this format")
+    info = soundfile.info(file_name)
+    return info.samplerate, info.channels, soundfile.blocks(file_name, blocksize=block_frames, dtype='int16', always_2d=True, start=start, stop=stop)
+
+# frames start to stop of a recording, one column per channel
+def read_pcm_range(file_name: str, start: int, stop: int):
+    _, channels, blocks = read_pcm_blocks(file_name, start=start, stop=stop)
+    return np.concatenate(list(blocks) or [np.zeros((0, channels), dtype=np.int16)])
+
+# mean square of every frame_seconds of a recording, channels mixed, read a block at a time so memory doesn't grow
+# with the recording length. returns (energy, sample_rate, frames), the last partial frame is left out of energy
+def read_frame_energy(file_name: str, frame_seconds: float = 0.03):
+    sample_rate, channels, blocks = read_pcm_blocks(file_name)
+    frame = int(sample_rate * frame_seconds)
+    energy = []
+    frames = 0
+    rest = np.zeros(0, dtype=np.float32)
+    for block in blocks:
+        frames += len(block)
+        x = np.concatenate((rest, block.astype(np.float32).mean(axis=1)))
+        count = len(x) // frame
+        energy.append(np.mean(x[:count * frame].reshape(count, frame) ** 2, axis=1))
+        rest = x[count * frame:]
+    return (np.concatenate(energy) if energy else np.zeros(0, dtype=np.float32)), sample_rate, frames
+
+# in-memory WAV file of 16-bit samples, 2-d samples have one column per channel
+def encode_wav(samples, sample_rate: int):
+    buffer = io.BytesIO()
+    with wave.open(buffer, 'wb') as wave_file:
+        wave_file.setnchannels(samples.shape[1] if samples.ndim == 2 else 1)
+        wave_file.setsampwidth(2)
+        wave_file.setframerate(sample_rate)
+        wave_file.writeframes(samples.astype(np.int16).tobytes())
+    return buffer.getvalue()
+
+# in-memory FLAC file (lossless, about half the size of WAV), WAV without soundfile
+def encode_flac(samples, sample_rate: int):
+    if soundfile is None:
+        return encode_wav(samples, sample_rate)
+    buffer = io.BytesIO()
+    with encode_lock:
+        soundfile.write(buffer, samples.astype(np.int16), sample_rate, format='FLAC', subtype='PCM_16')
+    return buffer.getvalue()
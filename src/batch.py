@@ -0,0 +1,158 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from dotenv import load_dotenv
+from transcriber import AudioTranscriber
+from chunked_transcriber import ChunkedTranscriber
+from gpt_controller import GPTController
+from model_router import ModelRouter
+from http_transport import HttpTransport
+from pipeline import ConsultationPipeline
+from result_cache import ResultCache
+from prompts import REPORT_SCHEMA
+from metrics import metrics, current_consultation
+load_dotenv()
+
+AUDIO_EXTENSIONS = ('.wav', '.flac', '.opus', '.ogg', '.mp3', '.m4a', '.webm')
+
+# headless reprocessing of a folder of recordings: transcription + report for every file, appended to a
+# JSONL file as each one finishes. completed files are skipped, so an interrupted run can simply be restarted.
+class BatchProcessor:
+    def __init__(self, pipeline: ConsultationPipeline, output_file: str, language: str = 'en', concurrency: int = 4,
+                 max_per_minute: int = 30, max_backoff: float = 120.0):
+        self.pipeline = pipeline
+        self.output_file = output_file
+        self.language = language
+        self.concurrency = concurrency
+        self.max_per_minute = max_per_minute # consultation starts per minute, keeps the API rate limits in reach
+        self.max_backoff = max_backoff
+        self.start_times = []
+        self.backoff = 0.0 # pause before the next start, grows while items fail (usually rate limits)
+        self.rate_lock = asyncio.Lock()
+
+    def find_files(self, folder: str):
+        files = []
+        for directory, _, names in os.walk(folder):
+            for name in sorted(names):
+                if name.lower().endswith(AUDIO_EXTENSIONS):
+                    files.append(os.path.relpath(os.path.join(directory, name), folder))
+        return sorted(files)
+
+    # files with an 'ok' record in the output file
+    def completed_files(self):
+        completed = set()
+        if not os.path.exists(self.output_file):
+            return completed
+        with open(self.output_file, encoding='utf-8') as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # a line cut by an interruption
+                if record.get('status') == 'ok':
+                    completed.add(record['file'])
+        return completed
+
+    async def run(self, folder: str):
+        files = self.find_files(folder)
+        completed = self.completed_files()
+        pending = [f for f in files if f not in completed]
+        print(f"batch: {len(files)} recordings, {len(files) - len(pending)} already done, {len(pending)} to process")
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = {'ok': 0, 'error': 0}
+        start = time.perf_counter()
+
+        async def worker(relative_name):
+            async with semaphore:
+                await self.wait_rate_limit()
+                try:
+                    record = await self.process(folder, relative_name)
+                except Exception as e:
+                    # one broken recording doesn't stop the others, it is retried by the next run
+                    print(f"batch: {relative_name} exception {e}")
+                    record = {'file': relative_name, 'status': 'error', 'error': str(e)}
+            total = record.get('transcription_seconds', 0) + record.get('analysis_seconds', 0)
+            metrics.finish_consultation(relative_name, total if record['status'] == 'ok' else None)
+            results[record['status']] += 1
+            self.backoff = 0.0 if record['status'] == 'ok' else min(max(self.backoff * 2, 5.0), self.max_backoff)
+            with open(self.output_file, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            print(f"batch: {relative_name} {record['status']} ({results['ok'] + results['error']}/{len(pending)})")
+
+        await asyncio.gather(*(worker(name) for name in pending))
+        print(f"batch: done in {time.perf_counter() - start:.1f}s, {results['ok']} ok, {results['error']} failed")
+        return results
+
+    async def wait_rate_limit(self):
+        async with self.rate_lock:
+            if self.backoff:
+                await asyncio.sleep(self.backoff)
+            now = time.monotonic()
+            self.start_times = [t for t in self.start_times if now - t < 60]
+            if len(self.start_times) >= self.max_per_minute:
+                await asyncio.sleep(60 - (now - self.start_times[0]))
+            self.start_times.append(time.monotonic())
+
+    async def process(self, folder: str, relative_name: str):
+        record = {'file': relative_name, 'status': 'error'}
+        current_consultation.set(relative_name) # each worker runs in its own task and context
+        start = time.perf_counter()
+        transcription = await self.pipeline.transcribe_file(os.path.join(folder, relative_name), self.language)
+        record['transcription_seconds'] = round(time.perf_counter() - start, 3)
+        if transcription is None:
+            record['error'] = 'transcription failed'
+            return record
+        record['transcription'] = transcription
+
+        sections = {}
+        def events(event, data=None):
+            if event == 'analysis':
+                sections.clear()
+            elif event == 'section':
+                key, text, append = data
+                sections[key] = sections.get(key, '') + text if append else text
+            elif event == 'section_error':
+                sections.pop(data[0], None)
+        start = time.perf_counter()
+        await self.pipeline.analyse(transcription, events)
+        record['analysis_seconds'] = round(time.perf_counter() - start, 3)
+        record.update(sections)
+        if any(key not in sections for key in REPORT_SCHEMA):
+            record['error'] = 'analysis failed'
+            return record
+        record['status'] = 'ok'
+        return record
+
+def main():
+    parser = argparse.ArgumentParser(description="Transcribe and analyse every recording of a folder.")
+    parser.add_argument('folder')
+    parser.add_argument('--output', help="JSONL results file (default: <folder>/results.jsonl)")
+    parser.add_argument('--language', default='en')
+    parser.add_argument('--concurrency', type=int, default=4, help="consultations processed at the same time")
+    parser.add_argument('--max-per-minute', type=int, default=30, help="consultations started per minute")
+    parser.add_argument('--analysis-mode', default=os.getenv('ANALYSIS_MODE', 'structured'), choices=['structured', 'separate'])
+    args = parser.parse_args()
+
+    cache_dir = os.getenv('CACHE_DIR', 'cache')
+    transcription_cache = ResultCache(os.path.join(cache_dir, 'transcriptions')) if cache_dir else None
+    llm_cache = ResultCache(os.path.join(cache_dir, 'llm')) if cache_dir else None
+    channel_names = [x.strip() for x in os.getenv('CHANNEL_NAMES', '').split(',') if x.strip()] or None
+    transport = HttpTransport(int(os.getenv('HTTP_MAX_CONNECTIONS', 20)), float(os.getenv('HTTP_KEEPALIVE_SECONDS', 60)),
+                              os.getenv('HTTP2', '1') == '1', warm_interval=None)
+    audio_transcriber = AudioTranscriber(os.getenv('DEEPGRAM_API_KEY'), transcription_cache, os.getenv('DEEPGRAM_URL', ''), channel_names, transport)
+    chunked_transcriber = ChunkedTranscriber(audio_transcriber, max_parallel=int(os.getenv('MAX_PARALLEL_TRANSCRIPTIONS', 4)))
+    router = ModelRouter(os.getenv('LLM_MODEL', 'gpt-4-turbo-preview'), json.loads(os.getenv('LLM_ROUTES', '{}')), int(os.getenv('LLM_PROMPT_BUDGET', 0)) or None)
+    gpt_controller = GPTController(os.getenv('OPENAI_API_KEY'), llm_cache, base_url=os.getenv('OPENAI_BASE_URL') or None, router=router,
+                                   transport=transport)
+    pipeline = ConsultationPipeline(audio_transcriber, gpt_controller, args.analysis_mode, stream_results=False, chunked_transcriber=chunked_transcriber)
+
+    output_file = args.output or os.path.join(args.folder, 'results.jsonl')
+    processor = BatchProcessor(pipeline, output_file, args.language, args.concurrency, args.max_per_minute)
+    metrics.configure(os.getenv('METRICS_FILE', 'metrics.jsonl'), os.getenv('PROMETHEUS_FILE', ''))
+    asyncio.run(processor.run(args.folder))
+    print('stage latencies\n' + metrics.summary())
+
+if __name__ == '__main__':
+    main()
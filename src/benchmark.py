@@ -0,0 +1,261 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+from audio_processing import read_pcm
+from transcriber import AudioRecorder, AudioTranscriber, LiveTranscriber
+from gpt_controller import GPTController
+from model_router import ModelRouter
+from http_transport import HttpTransport
+from chunked_transcriber import ChunkedTranscriber
+from request_scheduler import RequestScheduler
+from pipeline import ConsultationPipeline
+from mock_servers import MockDeepgramLive, MockDeepgramPrerecorded, MockOpenAI
+from metrics import metrics, current_consultation
+from test_prompt import test_transcription
+
+# stands in for pyaudio.PyAudio: open() returns a stream that feeds the recording to stream_callback
+# from its own thread, like PortAudio does, at speed x real time. the recording loops until the stream stops.
+# streams of several channels get the recording shifted by a few seconds on each channel
+class ReplayAudio:
+    def __init__(self, samples, sample_rate: int, speed: float = 1.0):
+        self.samples = samples
+        self.sample_rate = sample_rate
+        self.speed = speed
+
+    def open(self, rate, frames_per_buffer, stream_callback, channels=1, **kwargs):
+        samples = self.samples
+        if channels > 1:
+            samples = np.stack([np.roll(self.samples, c * 3 * self.sample_rate) for c in range(channels)], axis=1)
+        return ReplayStream(samples, frames_per_buffer, frames_per_buffer / rate / self.speed, stream_callback)
+
+class ReplayStream:
+    def __init__(self, samples, frames_per_buffer, interval, stream_callback):
+        self.samples = samples
+        self.frames_per_buffer = frames_per_buffer
+        self.interval = interval
+        self.stream_callback = stream_callback
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        position = 0
+        next_time = time.perf_counter()
+        while not self.stopped.is_set():
+            block = np.take(self.samples, range(position, position + self.frames_per_buffer), axis=0, mode='wrap')
+            position = (position + self.frames_per_buffer) % len(self.samples)
+            self.stream_callback(block.astype(np.int16).tobytes(), self.frames_per_buffer, None, 0)
+            next_time += self.interval
+            self.stopped.wait(max(next_time - time.perf_counter(), 0))
+
+    def stop_stream(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def close(self):
+        pass
+
+# raw 16 kHz 16-bit mono (.lin16, as played by play_lin16.py) or anything read_pcm decodes
+def load_audio(file_name: str):
+    if file_name.endswith('.lin16'):
+        with open(file_name, 'rb') as file:
+            return np.frombuffer(file.read(), dtype=np.int16), 16000
+    return read_pcm(file_name)
+
+# speech-like bursts of modulated noise separated by pauses, when no recording is given
+def synthetic_audio(seconds: float = 30.0, sample_rate: int = 16000):
+    rng = np.random.default_rng(0)
+    t = np.arange(int(seconds * sample_rate)) / sample_rate
+    envelope = (np.sin(2 * np.pi * 3 * t) > -0.3) * ((t % 2.0) < 1.5)
+    samples = envelope * (3000 * np.sin(2 * np.pi * 180 * t) + 1500 * rng.standard_normal(len(t))) + 30 * rng.standard_normal(len(t))
+    return samples.astype(np.int16), sample_rate
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+# replays consultations end to end against the mock servers: recording through AudioRecorder, stop, transcription
+# (live or uploaded) and report generation, consultations at a time. the 'text' workload skips the audio and
+# generates the report of test_prompt.test_transcription. reports stop-to-report percentiles and throughput.
+class Benchmark:
+    def __init__(self, args):
+        self.args = args
+        self.samples, self.sample_rate = load_audio(args.audio) if args.audio else synthetic_audio()
+        self.work_dir = tempfile.mkdtemp(prefix='medassist_bench_')
+        self.latencies = []
+        self.failures = 0
+
+    async def start_servers(self):
+        args = self.args
+        self.live_server = MockDeepgramLive(port=0)
+        self.prerecorded_server = MockDeepgramPrerecorded(port=0, latency=args.transcription_latency, upload_bytes_per_second=args.upload_mbps * 125000,
+                                                          realtime_factor=args.realtime_factor)
+        self.openai_server = MockOpenAI(port=0, latency=args.llm_latency, tokens_per_second=args.tokens_per_second,
+                                        completion_tokens=args.completion_tokens, max_concurrent=args.llm_concurrency)
+        for server in (self.live_server, self.prerecorded_server, self.openai_server):
+            server.connect_latency = args.connect_latency
+            await server.start()
+        # warming the connections only makes sense with a shared pool
+        self.transport = HttpTransport(args.max_connections, warm_interval=args.warm_interval or None) if args.shared_transport else None
+        self.audio_transcriber = AudioTranscriber('mock', url=f"http://localhost:{self.prerecorded_server.port}", channel_names=['Doctor', 'Patient'],
+                                                  transport=self.transport)
+        self.live_transcriber = LiveTranscriber('mock', url=f"ws://localhost:{self.live_server.port}/v1/listen", channel_names=['Doctor', 'Patient'])
+        # a budget well above the mock's rate, queueing is measured by the server's max_concurrent
+        scheduler = RequestScheduler({'gpt-4-turbo-preview': (100000, 100000000)})
+        router = ModelRouter(routes=json.loads(self.args.routes), prompt_budget=self.args.prompt_budget or None)
+        self.gpt_controller = GPTController('mock', scheduler=scheduler, base_url=f"http://localhost:{self.openai_server.port}/v1", router=router,
+                                           transport=self.transport)
+        chunked_transcriber = ChunkedTranscriber(self.audio_transcriber) if args.chunked else None
+        self.pipeline = ConsultationPipeline(self.audio_transcriber, self.gpt_controller, args.analysis_mode, args.stream, chunked_transcriber,
+                                             args.rolling_chars or None, upload_while_recording=args.upload_while_recording)
+
+    async def stop_servers(self):
+        print(f"connections opened: deepgram {self.prerecorded_server.connects}, openai {self.openai_server.connects}")
+        if self.transport is not None:
+            await self.transport.close()
+        for server in (self.live_server, self.prerecorded_server, self.openai_server):
+            await server.stop()
+
+    async def run(self):
+        args = self.args
+        await self.start_servers()
+        try:
+            semaphore = asyncio.Semaphore(args.concurrency)
+            async def worker(consultation_id):
+                async with semaphore:
+                    await self.run_consultation(consultation_id)
+            start = time.perf_counter()
+            await asyncio.gather(*(worker(i + 1) for i in range(args.consultations)))
+            wall_time = time.perf_counter() - start
+        finally:
+            await self.stop_servers()
+        return self.report(wall_time)
+
+    async def run_consultation(self, consultation_id):
+        current_consultation.set(consultation_id)
+        done = asyncio.Event()
+        failed = []
+        def events(consultation_id, event, data=None):
+            if event == 'error' or event == 'section_error':
+                failed.append(data)
+            if event in ('done', 'error'):
+                done.set()
+
+        if self.args.workload == 'text':
+            stop = time.perf_counter()
+            await self.pipeline.analyse(test_transcription, lambda event, data=None: events(consultation_id, event, data))
+            done.set()
+        else:
+            recorder = AudioRecorder(ReplayAudio(self.samples, self.sample_rate, self.args.speed), audio_format=self.args.format,
+                                     trim_silence=self.args.trim_silence)
+            live_session = rolling_summary = None
+            if self.args.live:
+                rolling_summary = self.pipeline.start_rolling_summary(consultation_id)
+                live_session = self.live_transcriber.start(asyncio.get_running_loop(), lambda text, is_final: None,
+                                                           language='en', sample_rate=recorder.sample_rate, channels=self.args.channels,
+                                                           segment_cback=rolling_summary.add_segment if rolling_summary is not None else None)
+            else:
+                live_session = self.pipeline.start_upload(asyncio.get_running_loop(), 'en', recorder.sample_rate, self.args.channels)
+            file_name = os.path.join(self.work_dir, f"consultation_{consultation_id}.{self.args.format}")
+            recorder.start(None, self.sample_rate, file_name, live_session.send_audio if live_session is not None else None, self.args.channels)
+            warming = self.pipeline.start_warming(asyncio.get_running_loop(), live=self.args.live)
+            await asyncio.sleep(self.args.record_seconds / self.args.speed)
+            stop = time.perf_counter()
+            if warming is not None:
+                warming.cancel()
+            with metrics.span('record_stop'):
+                file_name = await asyncio.to_thread(recorder.stop)
+            await self.pipeline.run(consultation_id, file_name, live_session, 'en', events, rolling_summary)
+        await done.wait()
+        elapsed = time.perf_counter() - stop
+        if failed:
+            self.failures += 1
+            print(f"consultation {consultation_id} failed: {failed}")
+            metrics.finish_consultation(consultation_id)
+            return
+        self.latencies.append(elapsed)
+        metrics.finish_consultation(consultation_id, elapsed)
+
+    def report(self, wall_time):
+        result = {'consultations': len(self.latencies), 'failures': self.failures, 'wall_seconds': round(wall_time, 3),
+                  'throughput_per_minute': round(len(self.latencies) / wall_time * 60, 2) if wall_time else 0.0}
+        if self.latencies:
+            result.update({
+                'p50': round(percentile(self.latencies, 0.5), 3),
+                'p95': round(percentile(self.latencies, 0.95), 3),
+                'p99': round(percentile(self.latencies, 0.99), 3),
+                'mean': round(sum(self.latencies) / len(self.latencies), 3),
+                'max': round(max(self.latencies), 3),
+            })
+        print('stage latencies\n' + metrics.summary())
+        print(f"stop to report: {json.dumps(result)}")
+        return result
+
+# a result is a regression when its p95 grew or its throughput dropped by more than tolerance
+def compare(result, baseline, tolerance):
+    regressions = []
+    if 'p95' in result and 'p95' in baseline and result['p95'] > baseline['p95'] * (1 + tolerance):
+        regressions.append(f"p95 {result['p95']}s > baseline {baseline['p95']}s")
+    if result['throughput_per_minute'] < baseline['throughput_per_minute'] * (1 - tolerance):
+        regressions.append(f"throughput {result['throughput_per_minute']}/min < baseline {baseline['throughput_per_minute']}/min")
+    if result['failures'] > baseline.get('failures', 0):
+        regressions.append(f"{result['failures']} failures")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end benchmark against local mock Deepgram and OpenAI servers.")
+    parser.add_argument('--audio', help="recording to replay (.lin16 raw 16 kHz or any decodable file), synthetic speech by default")
+    parser.add_argument('--workload', default='audio', choices=['audio', 'text'], help="'text' only generates the report of the test transcription")
+    parser.add_argument('--consultations', type=int, default=8)
+    parser.add_argument('--concurrency', type=int, default=4, help="consultations at the same time")
+    parser.add_argument('--record-seconds', type=float, default=60.0, help="audio seconds recorded per consultation")
+    parser.add_argument('--speed', type=float, default=20.0, help="replay speed, x real time")
+    parser.add_argument('--format', default='flac', choices=['wav', 'flac', 'opus'])
+    parser.add_argument('--trim-silence', action='store_true')
+    parser.add_argument('--channels', type=int, default=1, help="record that many channels, one speaker each")
+    parser.add_argument('--live', action='store_true', help="stream to the mock live API instead of uploading on stop")
+    parser.add_argument('--upload-while-recording', action='store_true', help="without --live, stream the recording to the mock upload API while recording")
+    parser.add_argument('--chunked', action='store_true', help="chunked parallel transcription of the upload")
+    parser.add_argument('--rolling-chars', type=int, default=0, help="with --live, update the report every that many transcript chars")
+    parser.add_argument('--analysis-mode', default='structured', choices=['structured', 'separate'])
+    parser.add_argument('--routes', default='{}', help="model routes per task as JSON, like LLM_ROUTES")
+    parser.add_argument('--prompt-budget', type=int, default=0, help="max prompt tokens per query, 0 is only the context window")
+    parser.add_argument('--no-stream', dest='stream', action='store_false', help="don't stream the LLM results")
+    parser.add_argument('--transcription-latency', type=float, default=0.3, help="mock deepgram response latency, seconds")
+    parser.add_argument('--realtime-factor', type=float, default=100.0, help="mock deepgram audio seconds transcribed per second")
+    parser.add_argument('--upload-mbps', type=float, default=0, help="mock deepgram upload throughput, 0 is unlimited")
+    parser.add_argument('--llm-latency', type=float, default=0.5, help="mock openai time to first token, seconds")
+    parser.add_argument('--tokens-per-second', type=float, default=50.0, help="mock openai generation speed")
+    parser.add_argument('--completion-tokens', type=int, default=150)
+    parser.add_argument('--shared-transport', action='store_true', help="one connection pool for both APIs, like the app")
+    parser.add_argument('--max-connections', type=int, default=20, help="with --shared-transport, pool size")
+    parser.add_argument('--warm-interval', type=float, default=30.0, help="with --shared-transport, seconds between warm-ups while recording, 0 disables")
+    parser.add_argument('--connect-latency', type=float, default=0, help="mock servers' connection setup time, seconds (TCP + TLS)")
+    parser.add_argument('--llm-concurrency', type=int, default=0, help="mock openai requests served at once, 0 is unlimited")
+    parser.add_argument('--metrics-file', help="JSONL file for the per-stage timings")
+    parser.add_argument('--output', help="write the result as JSON, to be used as a baseline")
+    parser.add_argument('--baseline', help="result JSON of a previous run, exit with 1 on regression")
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    metrics.configure(args.metrics_file)
+    result = asyncio.run(Benchmark(args).run())
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(result, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(result, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
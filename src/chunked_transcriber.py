@@ -0,0 +1,159 @@
+import asyncio
+import re
+import time
+from lazy_import import lazy_import
+np = lazy_import('numpy') # imported on first use, see lazy_import.py
+from audio_processing import audio_file_info, read_frame_energy, read_pcm_range, encode_flac
+from transcriber import AudioTranscriber, format_speaker_words
+from vad import TimeMap
+from metrics import metrics
+
+FRAME_SECONDS = 0.03 # energy frame of the split search
+
+# splits long recordings at silences and transcribes the chunks concurrently, so the stop-to-transcript
+# latency stays roughly flat with the recording length. every chunk after the first also carries the last
+# overlap_seconds of the previous one; the words heard twice are used to match the diarized speakers.
+# recordings too short to split are streamed as they are, longer ones are read a chunk at a time
+class ChunkedTranscriber:
+    def __init__(self, audio_transcriber: AudioTranscriber, chunk_seconds: float = 60.0, search_seconds: float = 10.0,
+                 overlap_seconds: float = 5.0, max_parallel: int = 4):
+        self.audio_transcriber = audio_transcriber
+        self.chunk_seconds = chunk_seconds
+        self.search_seconds = search_seconds # how far around each target split point to look for a silence
+        self.overlap_seconds = overlap_seconds
+        self.max_parallel = max_parallel
+
+    async def transcribe(self, file_name: str, language: str = "en-US", time_map: TimeMap = None):
+        result = await self.transcribe_detailed(file_name, language, time_map)
+        return result['transcript'] if result is not None else None
+
+    # same result as AudioTranscriber.transcribe_detailed, with a speaker labeled transcript
+    async def transcribe_detailed(self, file_name: str, language: str = "en-US", time_map: TimeMap = None):
+        info = await asyncio.to_thread(audio_file_info, file_name)
+        if info is None or info[1] <= self.chunk_seconds + self.search_seconds:
+            # a single chunk, or a format that can't be decoded: the recording is uploaded as it is
+            return await self.audio_transcriber.transcribe_detailed(file_name, language, time_map)
+        try:
+            # multichannel recordings are split at the silences of the mix, every chunk keeps all the channels
+            with metrics.span('file_read', decode=True):
+                energy, sample_rate, frames = await asyncio.to_thread(read_frame_energy, file_name, FRAME_SECONDS)
+        except Exception as e:
+            print(f"chunked transcription can't decode {file_name} ({e}), sending the whole file")
+            return await self.audio_transcriber.transcribe_detailed(file_name, language, time_map)
+
+        start = time.perf_counter()
+        channels = info[0]
+        splits = self.find_splits(energy, sample_rate)
+        if not splits:
+            return await self.audio_transcriber.transcribe_detailed(file_name, language, time_map)
+        bounds = list(zip([0] + splits, splits + [frames]))
+        print(f"transcribing {frames / sample_rate:.1f}s in {len(bounds)} chunks")
+        semaphore = asyncio.Semaphore(self.max_parallel)
+        overlap = int(self.overlap_seconds * sample_rate)
+
+        async def transcribe_chunk(chunk_start, chunk_end):
+            chunk_start = max(chunk_start - overlap, 0)
+            # at most max_parallel chunks are in memory
+            async with semaphore:
+                samples = await asyncio.to_thread(read_pcm_range, file_name, chunk_start, chunk_end)
+                buffer_data = await asyncio.to_thread(encode_flac, samples, sample_rate)
+                del samples
+                result = await self.audio_transcriber.transcribe_buffer(buffer_data, language)
+            if result is None:
+                return None
+            offset = chunk_start / sample_rate
+            for word in result['words']:
+                word['start'] += offset
+                word['end'] += offset
+            return result['words']
+
+        results = await asyncio.gather(*(transcribe_chunk(chunk_start, chunk_end) for chunk_start, chunk_end in bounds))
+        if any(words is None for words in results):
+            print("chunked transcription failed")
+            return None
+        chunk_starts = [chunk_start / sample_rate for chunk_start, _ in bounds]
+        if channels > 1:
+            # the speakers are the channels, the same in every chunk: only the overlap is dropped
+            words = [w for i, chunk_words in enumerate(results) for w in chunk_words if i == 0 or w['start'] >= chunk_starts[i]]
+        else:
+            words = stitch_chunks(results, chunk_starts)
+        if time_map is not None:
+            for word in words:
+                word['start'], word['end'] = time_map.to_original(word['start']), time_map.to_original(word['end'])
+        print(f"chunked transcription took {time.perf_counter() - start:.2f}s")
+        transcript = format_speaker_words(words, self.audio_transcriber.channel_names if channels > 1 else None)
+        return {'transcript': transcript, 'words': words} if transcript else None
+
+    # split points (sample indexes) at the quietest 300 ms around every chunk_seconds.
+    # energy: mean square of every FRAME_SECONDS of the recording, see read_frame_energy
+    def find_splits(self, energy, sample_rate):
+        frame = int(sample_rate * FRAME_SECONDS)
+        count = len(energy)
+        if count == 0 or count * FRAME_SECONDS <= self.chunk_seconds + self.search_seconds:
+            return []
+        # smooth so a single quiet frame inside a word doesn't look like a pause
+        energy = np.convolve(energy, np.ones(10) / 10, mode='same')
+        splits = []
+        last = 0
+        chunk_frames = int(self.chunk_seconds / FRAME_SECONDS)
+        search_frames = int(self.search_seconds / FRAME_SECONDS)
+        while last + chunk_frames + search_frames < count:
+            low = last + chunk_frames - search_frames
+            high = last + chunk_frames + search_frames
+            last = low + int(np.argmin(energy[low:high]))
+            splits.append(last * frame)
+        return splits
+
+# merge the words of consecutive chunks. words[i] of chunk i > 0 start with the overlap, which was
+# already transcribed by chunk i - 1: it maps chunk i's speakers to the global ones and is then dropped
+def stitch_chunks(chunk_words, chunk_starts):
+    merged = []
+    speakers = set() # global speakers so far
+    for i, words in enumerate(chunk_words):
+        if i == 0:
+            merged.extend(dict(w) for w in words)
+            speakers.update(w['speaker'] for w in merged if w['speaker'] is not None)
+            continue
+        split = chunk_starts[i]
+        overlap_start = words[0]['start'] if words else split
+        previous = [w for w in merged if w['end'] >= overlap_start - 1]
+        votes = {}
+        for word in words:
+            if word['start'] >= split:
+                break
+            match = _matching_word(word, previous)
+            if match is not None and word['speaker'] is not None and match['speaker'] is not None:
+                votes.setdefault(word['speaker'], {}).setdefault(match['speaker'], 0)
+                votes[word['speaker']][match['speaker']] += 1
+        mapping = {}
+        for local, counts in sorted(votes.items(), key=lambda x: -max(x[1].values())):
+            for speaker, _ in sorted(counts.items(), key=lambda x: -x[1]):
+                if speaker not in mapping.values():
+                    mapping[local] = speaker
+                    break
+        # speakers silent during the overlap take a known speaker not used in this chunk, or a new one
+        for word in words:
+            local = word['speaker']
+            if local is None or local in mapping:
+                continue
+            unused = sorted(speakers - set(mapping.values()))
+            mapping[local] = unused[0] if unused else max(speakers, default=-1) + 1
+            speakers.add(mapping[local])
+        for word in words:
+            if word['start'] < split:
+                continue
+            word = dict(word)
+            word['speaker'] = mapping.get(word['speaker'], word['speaker'])
+            merged.append(word)
+    return merged
+
+def _normalize(word):
+    return re.sub(r'\W', '', word.lower())
+
+# same word at about the same time in the previous chunk
+def _matching_word(word, previous, tolerance=0.3):
+    text = _normalize(word['word'])
+    for candidate in previous:
+        if abs(candidate['start'] - word['start']) <= tolerance and _normalize(candidate['word']) == text:
+            return candidate
+    return None
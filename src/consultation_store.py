@@ -0,0 +1,125 @@
+import json
+import sqlite3
+import threading
+import time
+from prompts import REPORT_SCHEMA
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS consultations (
+    id INTEGER PRIMARY KEY,
+    started REAL NOT NULL,
+    language TEXT,
+    audio_file TEXT,
+    status TEXT NOT NULL DEFAULT 'recording',
+    error TEXT,
+    transcription TEXT,
+    summary TEXT,
+    symptoms TEXT,
+    diagnoses TEXT,
+    prompt_tokens INTEGER,
+    completion_tokens INTEGER,
+    cost_cents REAL,
+    stop_to_report REAL,
+    stages TEXT
+);
+CREATE INDEX IF NOT EXISTS consultations_started ON consultations(started);
+CREATE VIRTUAL TABLE IF NOT EXISTS consultations_fts USING fts5(
+    transcription, summary, symptoms, diagnoses,
+    content='consultations', content_rowid='id', tokenize='unicode61 remove_diacritics 2'
+);
+CREATE TRIGGER IF NOT EXISTS consultations_ai AFTER INSERT ON consultations BEGIN
+    INSERT INTO consultations_fts(rowid, transcription, summary, symptoms, diagnoses)
+    VALUES (new.id, new.transcription, new.summary, new.symptoms, new.diagnoses);
+END;
+CREATE TRIGGER IF NOT EXISTS consultations_ad AFTER DELETE ON consultations BEGIN
+    INSERT INTO consultations_fts(consultations_fts, rowid, transcription, summary, symptoms, diagnoses)
+    VALUES ('delete', old.id, old.transcription, old.summary, old.symptoms, old.diagnoses);
+END;
+CREATE TRIGGER IF NOT EXISTS consultations_au AFTER UPDATE OF transcription, summary, symptoms, diagnoses ON consultations BEGIN
+    INSERT INTO consultations_fts(consultations_fts, rowid, transcription, summary, symptoms, diagnoses)
+    VALUES ('delete', old.id, old.transcription, old.summary, old.symptoms, old.diagnoses);
+    INSERT INTO consultations_fts(rowid, transcription, summary, symptoms, diagnoses)
+    VALUES (new.id, new.transcription, new.summary, new.symptoms, new.diagnoses);
+END;
+"""
+
+# consultations with their recording, transcription, report, token usage and stage timings, in SQLite.
+# WAL mode lets the app, the server and other readers use the file at the same time, and the FTS5 index over
+# the transcriptions and reports keeps searches fast with tens of thousands of consultations.
+# writes are small and done in place, failures are printed and don't stop the consultation
+class ConsultationStore:
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL') # durable at checkpoints, a crash can only lose the last writes
+        self.connection.execute('PRAGMA busy_timeout=5000')
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    # the new consultation's id, assigned by SQLite so the processes sharing the file never reuse one. None on failure
+    def start(self, language: str = None, audio_file: str = None):
+        try:
+            with self.lock:
+                return self.connection.execute('INSERT INTO consultations (started, language, audio_file) VALUES (?, ?, ?)',
+                                               (time.time(), language, audio_file)).lastrowid
+        except Exception as e:
+            print(f"consultation store exception {e}")
+            return None
+
+    def save_audio_file(self, consultation_id, audio_file: str):
+        self._update(consultation_id, audio_file=audio_file)
+
+    def save_transcription(self, consultation_id, transcription: str):
+        self._update(consultation_id, transcription=transcription)
+
+    # sections: REPORT_SCHEMA key -> text, missing sections failed
+    def save_report(self, consultation_id, sections: dict, status: str = 'done', error: str = None):
+        self._update(consultation_id, status=status, error=error, **{key: sections.get(key) for key in REPORT_SCHEMA})
+
+    # metrics listener: the consultation totals of Metrics.finish_consultation
+    def save_metrics(self, consultation_id, totals: dict):
+        if not isinstance(consultation_id, int):
+            return
+        stages = totals.get('stages', {})
+        self._update(consultation_id, prompt_tokens=totals.get('prompt_tokens'), completion_tokens=totals.get('completion_tokens'),
+                     cost_cents=totals.get('cost_cents'), stop_to_report=stages.get('stop_to_report'), stages=json.dumps(stages))
+
+    def get(self, consultation_id):
+        with self.lock:
+            row = self.connection.execute('SELECT * FROM consultations WHERE id = ?', (consultation_id,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def recent(self, limit: int = 50):
+        with self.lock:
+            rows = self.connection.execute("SELECT id, started, status, substr(coalesce(summary, transcription, ''), 1, 120) AS snippet "
+                                           "FROM consultations ORDER BY started DESC LIMIT ?", (limit,)).fetchall()
+        return [dict(row) for row in rows]
+
+    # best matches first. every word has to match, the last one as a prefix so results come while typing
+    def search(self, query: str, limit: int = 50):
+        words = query.split()
+        if not words:
+            return self.recent(limit)
+        match = ' '.join('"' + word.replace('"', '""') + '"' for word in words) + '*'
+        with self.lock:
+            rows = self.connection.execute("SELECT c.id, c.started, c.status, snippet(consultations_fts, -1, '[', ']', '...', 12) AS snippet "
+                                           "FROM consultations_fts JOIN consultations c ON c.id = consultations_fts.rowid "
+                                           "WHERE consultations_fts MATCH ? ORDER BY rank LIMIT ?", (match, limit)).fetchall()
+        return [dict(row) for row in rows]
+
+    def _update(self, consultation_id, **fields):
+        assignments = ', '.join(f'{name} = ?' for name in fields)
+        self._execute(f'UPDATE consultations SET {assignments} WHERE id = ?', (*fields.values(), consultation_id))
+
+    def _execute(self, sql: str, parameters=()):
+        try:
+            with self.lock:
+                self.connection.execute(sql, parameters)
+        except Exception as e:
+            print(f"consultation store exception {e}")
@@ -1,30 +1,249 @@
-import queue
-from openai import AsyncOpenAI
+import json
+import re
+import threading
+import time
+from lazy_import import lazy_import
+from result_cache import ResultCache
+from request_scheduler import RequestScheduler
+from model_router import ModelRouter
+from http_transport import HttpTransport
+from metrics import metrics
 from dotenv import load_dotenv
+openai = lazy_import('openai') # imported on first use, see lazy_import.py
 
 load_dotenv()
 
 class GPTController:
-    def __init__(self, api_key):
-        self.client = AsyncOpenAI(api_key=api_key)
-    
-    async def send_query(self, messages, cback):
-        model = "gpt-4-turbo-preview"
-        pricing = {
-            "gpt-3.5-turbo-0125": [0.0005, 0.0015],
-            "gpt-4-turbo-preview": [0.01, 0.03]
-        }
-        price = [pricing[model][0] if model in pricing else 0, pricing[model][1] if model in pricing else 0]
+    # base_url: another OpenAI compatible endpoint, e.g. the mock server of the benchmarks
+    # router: picks the model of each task and keeps the prompts within budget, every query uses gpt-4-turbo-preview by default
+    # transport: connection pool shared with the other API clients, the SDK's own otherwise
+    def __init__(self, api_key, cache: ResultCache = None, scheduler: RequestScheduler = None, base_url: str = None, router: ModelRouter = None,
+                 transport: HttpTransport = None):
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        self.router = router if router is not None else ModelRouter()
+        self.api_key = api_key
+        self.base_url = base_url
+        self.transport = transport
+        self.client_lock = threading.Lock()
+        self._client = None
+        self.cache = cache # completions keyed by model + messages
+        self.max_output_tokens = 1000 # rough completion size, used for the token budget
+
+    # built on first use, the openai SDK import is slow
+    @property
+    def client(self):
+        with self.client_lock:
+            if self._client is None:
+                # retries and timeouts are handled by the scheduler
+                http_client = self.transport.client if self.transport is not None else None
+                self._client = openai.AsyncOpenAI(api_key=self.api_key, base_url=self.base_url, max_retries=0, http_client=http_client)
+            return self._client
+
+    # where HttpTransport.warm opens the connections of the queries
+    @property
+    def warm_url(self):
+        return (self.base_url or "https://api.openai.com/v1").rstrip('/') + '/models'
+
+    # delta_cback, when given, receives the text deltas as they arrive; cback always receives the final message.
+    # task selects the model, see ModelRouter
+    async def send_query(self, messages, cback, response_format=None, delta_cback=None, task: str = 'default'):
+        start = time.perf_counter()
+        model, messages, route = self.router.route(task, messages, self.max_output_tokens)
+        price = self.router.price(model)
+        print(f"LLM: {task} -> {model}, ~{route['prompt_tokens']} prompt tokens" +
+              (f", {route['trimmed_tokens']} trimmed" if route['trimmed_tokens'] else ""))
         try:
-            completion = await self.client.chat.completions.create(
-                model=model,
-                messages=messages,
-            )
-            print('LLM: completion id ', completion.id)
-            print('LLM: usage ', completion.usage)
-            print('LLM: in cents ', completion.usage.prompt_tokens * price[0] / 1000 * 100)
-            print('LLM: out cents ', completion.usage.completion_tokens * price[1] / 1000 * 100)
-            cback(completion.choices[0].message)
-            # return completion.choices[0].message
+            extra = {'response_format': response_format} if response_format is not None else {}
+            cache_key = ResultCache.make_key({'model': model, 'messages': messages, **extra}) if self.cache is not None else None
+            cached = self.cache.get(cache_key) if cache_key is not None else None
+            if cached is not None:
+                # same request already answered: no cost
+                print('LLM: cache hit, 0 cents')
+                metrics.record('llm_total', time.perf_counter() - start, model=model, task=task, cached=True)
+                if delta_cback is not None:
+                    delta_cback(cached['content'])
+                cback(openai.types.chat.ChatCompletionMessage(role='assistant', content=cached['content']))
+                return openai.types.CompletionUsage(**cached['usage'])
+            tokens = route['prompt_tokens'] + self.max_output_tokens
+            if delta_cback is None:
+                async def attempt():
+                    return await self.client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        **extra
+                    )
+                completion = await self.scheduler.run(model, tokens, attempt)
+                completion_id, usage, message = completion.id, completion.usage, completion.choices[0].message
+            else:
+                # once deltas reached the user the request can't be repeated
+                streamed = []
+                def forward_delta(delta):
+                    streamed.append(delta)
+                    delta_cback(delta)
+                completion_id, usage, message = await self.scheduler.run(
+                    model, tokens, lambda: self._stream_query(model, messages, forward_delta, extra),
+                    can_retry=lambda: not streamed, hedge=False)
+            in_cents = usage.prompt_tokens * price[0] / 1000 * 100
+            out_cents = usage.completion_tokens * price[1] / 1000 * 100
+            print('LLM: completion id ', completion_id)
+            print('LLM: usage ', usage)
+            print('LLM: in cents ', in_cents)
+            print('LLM: out cents ', out_cents)
+            self.router.observe(messages, usage.prompt_tokens)
+            metrics.record('llm_total', time.perf_counter() - start, model=model, task=task, stream=delta_cback is not None,
+                           estimated_tokens=route['prompt_tokens'], trimmed_tokens=route['trimmed_tokens'],
+                           prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens, cost_cents=in_cents + out_cents)
+            metrics.record_llm_usage(model, usage.prompt_tokens, usage.completion_tokens, in_cents + out_cents)
+            if cache_key is not None:
+                self.cache.put(cache_key, {'content': message.content, 'usage': usage.model_dump()})
+            cback(message)
+            return usage
         except Exception as e:
-            print('Exception send query', e)
+            print('Exception send query', repr(e))
+            metrics.record('llm_failed', time.perf_counter() - start, model=model, task=task, error=type(e).__name__)
+            return None
+
+    # forward content deltas as they arrive, the usage comes in the last chunk
+    async def _stream_query(self, model, messages, delta_cback, extra):
+        start = time.perf_counter()
+        stream = await self.client.chat.completions.create(
+            model=model,
+            messages=messages,
+            stream=True,
+            stream_options={"include_usage": True},
+            **extra
+        )
+        completion_id, usage, content = None, None, []
+        async for chunk in stream:
+            completion_id = chunk.id
+            if chunk.usage is not None:
+                usage = chunk.usage
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            if not content:
+                print(f'LLM: time to first token {time.perf_counter() - start:.2f}s')
+                metrics.record('llm_ttft', time.perf_counter() - start, model=model)
+            content.append(chunk.choices[0].delta.content)
+            delta_cback(chunk.choices[0].delta.content)
+        if usage is None:
+            raise Exception('stream finished without usage')
+        return completion_id, usage, openai.types.chat.ChatCompletionMessage(role='assistant', content=''.join(content))
+
+    # single query returning a JSON object validated against schema ({key: type}).
+    # replaced_messages are the per-section queries this one replaces, used to report the savings.
+    # section_cback, when given, receives (key, delta) as each section's text streams in.
+    # returns the parsed dict, or None if the query failed or the result is invalid.
+    async def send_structured_query(self, messages, schema, replaced_messages=None, section_cback=None, task: str = 'report'):
+        result = {}
+        partial = PartialJsonStrings(schema.keys())
+        def forward_sections(delta):
+            for key, text in partial.feed(delta).items():
+                section_cback(key, text)
+        def parse(message):
+            try:
+                data = json.loads(message.content)
+            except Exception as e:
+                print('LLM: structured result is not valid JSON', e)
+                return
+            if not isinstance(data, dict):
+                print('LLM: structured result is not an object')
+                return
+            for key, value_type in schema.items():
+                value = data.get(key)
+                if isinstance(value, list) and value_type is str:
+                    # tolerate lists where a text list was requested
+                    value = "\n".join(str(x) for x in value)
+                if not isinstance(value, value_type):
+                    print(f'LLM: structured result missing or invalid "{key}"')
+                    return
+                result[key] = value
+
+        start = time.perf_counter()
+        usage = await self.send_query(messages, parse, response_format={"type": "json_object"},
+                                      delta_cback=forward_sections if section_cback is not None else None, task=task)
+        if usage is None or not result:
+            return None
+        self.report_savings(messages, usage, replaced_messages, time.perf_counter() - start, task)
+        return result
+
+    # estimate the prompt tokens the separate queries would have used, scaling by the measured tokens per char
+    def report_savings(self, messages, usage, replaced_messages, latency, task='report'):
+        print(f'LLM: structured query latency {latency:.2f}s, prompt tokens {usage.prompt_tokens}')
+        if not replaced_messages:
+            return
+        sent_chars = sum(len(m['content']) for m in messages)
+        replaced_chars = sum(len(m['content']) for query in replaced_messages for m in query)
+        estimated_tokens = int(usage.prompt_tokens * replaced_chars / max(sent_chars, 1))
+        saved_tokens = estimated_tokens - usage.prompt_tokens
+        price = self.router.price(self.router.select(task, usage.prompt_tokens))
+        print(f'LLM: {len(replaced_messages)} separate queries would send ~{estimated_tokens} prompt tokens, '
+              f'saved ~{saved_tokens} tokens (~{saved_tokens * price[0] / 1000 * 100:.2f} cents) and {len(replaced_messages) - 1} requests')
+
+# decodes the (possibly unterminated) string values of keys in a JSON object as it streams in.
+# each key keeps its scan position, so every delta only decodes its own characters
+class PartialJsonStrings:
+    escapes = {'n': '\n', 't': '\t', 'r': '\r', 'b': '\b', 'f': '\f'}
+
+    def __init__(self, keys):
+        self.text = ''
+        self.patterns = {key: re.compile(r'"%s"\s*:\s*"' % re.escape(key)) for key in keys}
+        self.positions = {} # key -> index of its next undecoded char, once the key was seen
+        self.searched = 0 # the keys not seen yet are looked for from about here
+        self.done = set() # keys whose string is closed
+
+    # the text decoded from delta, per key
+    def feed(self, delta: str):
+        self.text += delta
+        for key, pattern in self.patterns.items():
+            if key not in self.positions:
+                # the key can start a little before the new text
+                match = pattern.search(self.text, max(self.searched - len(key) - 64, 0))
+                if match is not None:
+                    self.positions[key] = match.end()
+        self.searched = len(self.text)
+        new = {}
+        for key, position in self.positions.items():
+            if key in self.done:
+                continue
+            out, self.positions[key], closed = self.decode(position)
+            if closed:
+                self.done.add(key)
+            if out:
+                new[key] = out
+        return new
+
+    # decodes from position up to the closing quote or the end of the text, returns (text, next position, closed)
+    def decode(self, i: int):
+        text, out = self.text, []
+        while i < len(text):
+            end = text.find('"', i)
+            backslash = text.find('\\', i)
+            stop = min(x for x in (end, backslash, len(text)) if x >= 0)
+            out.append(text[i:stop])
+            i = stop
+            if i == len(text):
+                break
+            if i == end:
+                return ''.join(out), i, True
+            # stop before an incomplete escape sequence, the next delta completes it
+            if i + 1 >= len(text) or (text[i + 1] == 'u' and i + 6 > len(text)):
+                break
+            if text[i + 1] == 'u':
+                code = int(text[i + 2:i + 6], 16)
+                if 0xd800 <= code < 0xdc00:
+                    # characters outside the BMP come as a surrogate pair
+                    following = text[i + 6:i + 12]
+                    if len(following) < 6 and '\\u'.startswith(following[:2]):
+                        break # the low surrogate is still to come
+                    if following.startswith('\\u'):
+                        low = int(following[2:], 16)
+                        if 0xdc00 <= low < 0xe000:
+                            out.append(chr(0x10000 + ((code - 0xd800) << 10) + (low - 0xdc00)))
+                            i += 12
+                            continue
+                out.append(chr(code))
+                i += 6
+            else:
+                out.append(self.escapes.get(text[i + 1], text[i + 1]))
+                i += 2
+        return ''.join(out), i, False
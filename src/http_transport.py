@@ -0,0 +1,55 @@
+import asyncio
+import threading
+from lazy_import import lazy_import
+from metrics import metrics
+httpx = lazy_import('httpx') # imported on first use, see lazy_import.py
+h2 = lazy_import('h2', optional=True) # HTTP/2 support of httpx (pip install httpx[http2]), HTTP/1.1 without it
+
+# one connection pool shared by the OpenAI and Deepgram requests: consecutive queries and consultations reuse open
+# TCP/TLS connections instead of each SDK setting up its own. with HTTP/2 the parallel report queries share one
+# connection per host. used from the app's asyncio loop only, httpx connections belong to the loop that opened them
+class HttpTransport:
+    def __init__(self, max_connections: int = 20, keepalive_seconds: float = 60.0, http2: bool = True, warm_interval: float = 30.0):
+        self.max_connections = max_connections
+        self.keepalive_seconds = keepalive_seconds # idle connections are closed after that long
+        self.http2 = http2 and h2 is not None
+        self.warm_interval = warm_interval # seconds between warm-ups while recording, None disables warming
+        self.client_lock = threading.Lock()
+        self._client = None
+
+    @property
+    def client(self):
+        with self.client_lock:
+            if self._client is None:
+                limits = httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections,
+                                      keepalive_expiry=self.keepalive_seconds)
+                # the SDKs pass their own timeouts per request
+                self._client = httpx.AsyncClient(limits=limits, http2=self.http2, timeout=httpx.Timeout(30.0, connect=10.0))
+                print(f"http transport: {self.max_connections} connections, keep-alive {self.keepalive_seconds}s, {'HTTP/2' if self.http2 else 'HTTP/1.1'}")
+            return self._client
+
+    # open a connection to each url, repeated urls get parallel connections (one is enough with HTTP/2).
+    # any response will do, only the connection is kept
+    async def warm(self, urls: list):
+        async def touch(url):
+            try:
+                response = await self.client.get(url, timeout=10.0)
+                await response.aclose()
+            except Exception as e:
+                print(f"connection warm-up exception {url}: {e}")
+        if self.http2:
+            urls = list(dict.fromkeys(urls))
+        with metrics.span('connection_warmup', connections=len(urls)):
+            await asyncio.gather(*(touch(url) for url in urls))
+
+    # keeps the connections open until cancelled, e.g. while a consultation is recorded: servers close idle
+    # connections after a minute or so, so they are touched again every warm_interval seconds
+    async def keep_warm(self, urls: list):
+        while self.warm_interval is not None:
+            await self.warm(urls)
+            await asyncio.sleep(self.warm_interval)
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
@@ -0,0 +1,19 @@
+import importlib.util
+import sys
+
+# module imported on first attribute access, keeps the heavy SDKs off the startup path.
+# optional modules that are not installed give None, like a failed optional import
+def lazy_import(name: str, optional: bool = False):
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        if optional:
+            return None
+        raise ImportError(f"No module named '{name}'", name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
@@ -1,15 +1,64 @@
+import time
+START_TIME = time.perf_counter() # startup times are measured from here, before the imports
 import asyncio
-from threading import Thread
-import pyaudio
+from threading import Thread, Lock
 import os
+import json
 from app_gui import AppGUI
-from transcriber import AudioRecorder, AudioTranscriber
+from transcriber import AudioRecorder, AudioTranscriber, LiveTranscriber
 from dotenv import load_dotenv
 from gpt_controller import GPTController
+from pipeline import ConsultationPipeline
+from chunked_transcriber import ChunkedTranscriber
+from result_cache import ResultCache
+from request_scheduler import RequestScheduler
+from model_router import ModelRouter
+from http_transport import HttpTransport
+from metrics import metrics
+from consultation_store import ConsultationStore
+from service_client import ServiceClient, RemoteLiveTranscriber, RemotePipeline
 load_dotenv()
 
 DEEPGRAM_API_KEY = os.getenv('DEEPGRAM_API_KEY')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+DEEPGRAM_URL = os.getenv('DEEPGRAM_URL', '') # prerecorded API, empty is api.deepgram.com
+DEEPGRAM_LIVE_URL = os.getenv('DEEPGRAM_LIVE_URL', 'wss://api.deepgram.com/v1/listen')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL') or None
+SERVICE_URL = os.getenv('SERVICE_URL', '') # consultation server (server.py) doing the transcription and reports, empty runs them locally
+LIVE_TRANSCRIPTION = os.getenv('LIVE_TRANSCRIPTION', '1') == '1'
+ANALYSIS_MODE = os.getenv('ANALYSIS_MODE', 'structured') # 'structured' or 'separate'
+STREAM_RESULTS = os.getenv('STREAM_RESULTS', '1') == '1'
+ROLLING_SUMMARY = os.getenv('ROLLING_SUMMARY', '0') == '1' # update the report during live recordings
+ROLLING_SEGMENT_CHARS = int(os.getenv('ROLLING_SEGMENT_CHARS', 4000)) # new transcript chars per rolling update
+RECORDING_FORMAT = os.getenv('RECORDING_FORMAT', 'flac') # 'wav', 'flac' or 'opus'
+TRIM_SILENCE = os.getenv('TRIM_SILENCE', '1') == '1'
+INPUT_CHANNELS = int(os.getenv('INPUT_CHANNELS', 1)) # channels recorded from a single input, one speaker per channel
+CHANNEL_NAMES = [x.strip() for x in os.getenv('CHANNEL_NAMES', '').split(',') if x.strip()] or None # e.g. 'Doctor,Patient'
+CHUNKED_TRANSCRIPTION = os.getenv('CHUNKED_TRANSCRIPTION', '1') == '1' # recordings longer than a chunk are split and transcribed in parallel
+MAX_PARALLEL_TRANSCRIPTIONS = int(os.getenv('MAX_PARALLEL_TRANSCRIPTIONS', 4))
+UPLOAD_WHILE_RECORDING = os.getenv('UPLOAD_WHILE_RECORDING', '0') == '1' # without live transcription, stream the audio to the transcription API while recording
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', 60)) # seconds per attempt
+LLM_DEADLINE = float(os.getenv('LLM_DEADLINE', 120)) # seconds per query, retries included
+LLM_HEDGE_AFTER = float(os.getenv('LLM_HEDGE_AFTER', 0)) or None # seconds, 0 disables hedging
+LLM_MODEL = os.getenv('LLM_MODEL', 'gpt-4-turbo-preview') # model of the tasks without a route
+LLM_ROUTES = json.loads(os.getenv('LLM_ROUTES', '{}')) # {"task": "model"} or {"task": [[max_prompt_tokens, "model"], [null, "model"]]}
+LLM_PROMPT_BUDGET = int(os.getenv('LLM_PROMPT_BUDGET', 0)) or None # max prompt tokens per query, longer transcripts are shortened
+HTTP_MAX_CONNECTIONS = int(os.getenv('HTTP_MAX_CONNECTIONS', 20)) # connection pool shared by the OpenAI and Deepgram requests
+HTTP_KEEPALIVE_SECONDS = float(os.getenv('HTTP_KEEPALIVE_SECONDS', 60)) # idle connections are kept open that long
+HTTP2 = os.getenv('HTTP2', '1') == '1' # used when the h2 package is installed
+WARM_CONNECTIONS = float(os.getenv('WARM_CONNECTIONS', 30)) or None # seconds between connection warm-ups while recording, 0 disables
+LLM_LIMITS = json.loads(os.getenv('LLM_LIMITS', '{}')) # {"model": [rpm, tpm]}
+CONSULTATION_DB = os.getenv('CONSULTATION_DB', 'consultations.db') # SQLite store of past consultations, empty disables
+RECORDINGS_DIR = os.getenv('RECORDINGS_DIR', 'recordings') # one recording per consultation
+CACHE_DIR = os.getenv('CACHE_DIR', 'cache') # empty disables the result cache
+CACHE_MAX_MB = int(os.getenv('CACHE_MAX_MB', 500))
+CACHE_TTL_DAYS = float(os.getenv('CACHE_TTL_DAYS', 30))
+METRICS_FILE = os.getenv('METRICS_FILE', 'metrics.jsonl') # per-stage timings and costs, empty disables
+PROMETHEUS_FILE = os.getenv('PROMETHEUS_FILE', '') # Prometheus text file, rewritten after each consultation
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0)) # serve /metrics on this port, 0 disables
+UI_MAX_FPS = float(os.getenv('UI_MAX_FPS', 30)) # GUI updates are batched into at most this many frames per second
+TRANSCRIPT_MAX_CHARS = int(os.getenv('TRANSCRIPT_MAX_CHARS', 20000)) # only the end of longer transcripts is kept on screen
+STARTUP_BUDGET = float(os.getenv('STARTUP_BUDGET', 2.0)) # seconds until the window shows, slower startups are reported
 
 # asyncio event wrapper
 class EventAsyncio:
@@ -27,6 +76,38 @@ class EventAsyncio:
         if self.event is not None:
             return self.event.wait()
 
+# seconds from START_TIME to each startup phase: 'window' shown, audio 'devices' listed, API 'clients' ready
+class StartupTimer:
+    PHASES = ('window', 'devices', 'clients')
+
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.phases = {}
+        self.lock = Lock()
+
+    def mark(self, phase: str):
+        elapsed = time.perf_counter() - START_TIME
+        metrics.record(f'startup_{phase}', elapsed)
+        with self.lock:
+            self.phases[phase] = elapsed
+            complete = all(p in self.phases for p in self.PHASES)
+        if phase == 'window' and elapsed > self.budget:
+            print(f"startup: window shown after {elapsed:.2f}s, over the {self.budget:.2f}s budget")
+        if complete:
+            print("startup: " + ", ".join(f"{p} {self.phases[p]:.2f}s" for p in self.PHASES))
+
+# import the SDKs and build the API clients while the window is already up
+def warm_up(audio_transcriber: AudioTranscriber, gpt_controller: GPTController, startup: StartupTimer):
+    try:
+        audio_transcriber.client
+        gpt_controller.client
+        # the first recording needs numpy, touching an attribute runs the lazy import
+        import numpy
+        numpy.ndarray
+    except Exception as e:
+        print(f"client warm up exception {e}")
+    startup.mark('clients')
+
 # start asyncio loop in current thread
 def start_asyncio_loop(loop, terminate_event: EventAsyncio):
     asyncio.set_event_loop(loop)
@@ -43,10 +124,34 @@ async def asyncio_main(terminate_event: EventAsyncio):
         print(f'main routine exception {e}')
         
 def main():
-    p = pyaudio.PyAudio()
-    audio_recorder = AudioRecorder(p)
-    audio_transcriber = AudioTranscriber(DEEPGRAM_API_KEY)
-    gpt_controller = GPTController(OPENAI_API_KEY)
+    metrics.configure(METRICS_FILE, PROMETHEUS_FILE, METRICS_PORT)
+    startup = StartupTimer(STARTUP_BUDGET)
+    # PortAudio is initialized by the GUI in the background
+    audio_recorder = AudioRecorder(audio_format=RECORDING_FORMAT, trim_silence=TRIM_SILENCE)
+    transcription_cache = llm_cache = None
+    if CACHE_DIR:
+        transcription_cache = ResultCache(os.path.join(CACHE_DIR, 'transcriptions'), CACHE_MAX_MB * 1024 * 1024, CACHE_TTL_DAYS * 24 * 3600)
+        llm_cache = ResultCache(os.path.join(CACHE_DIR, 'llm'), CACHE_MAX_MB * 1024 * 1024, CACHE_TTL_DAYS * 24 * 3600)
+    os.makedirs(RECORDINGS_DIR, exist_ok=True)
+    # the server keeps the consultations of its clients
+    store = ConsultationStore(CONSULTATION_DB) if CONSULTATION_DB and not SERVICE_URL else None
+    if store is not None:
+        metrics.add_listener(store.save_metrics)
+    if SERVICE_URL:
+        # thin client: the recording is streamed to the server, which sends back the transcription and the report
+        service_client = ServiceClient(SERVICE_URL)
+        live_transcriber = RemoteLiveTranscriber(service_client) if LIVE_TRANSCRIPTION else None
+        pipeline = RemotePipeline(service_client)
+    else:
+        transport = HttpTransport(HTTP_MAX_CONNECTIONS, HTTP_KEEPALIVE_SECONDS, HTTP2, WARM_CONNECTIONS)
+        audio_transcriber = AudioTranscriber(DEEPGRAM_API_KEY, transcription_cache, DEEPGRAM_URL, CHANNEL_NAMES, transport)
+        live_transcriber = LiveTranscriber(DEEPGRAM_API_KEY, DEEPGRAM_LIVE_URL, CHANNEL_NAMES) if LIVE_TRANSCRIPTION else None
+        scheduler = RequestScheduler(LLM_LIMITS, attempt_timeout=LLM_TIMEOUT, deadline=LLM_DEADLINE, hedge_after=LLM_HEDGE_AFTER)
+        router = ModelRouter(LLM_MODEL, LLM_ROUTES, LLM_PROMPT_BUDGET)
+        gpt_controller = GPTController(OPENAI_API_KEY, llm_cache, scheduler, OPENAI_BASE_URL, router, transport)
+        chunked_transcriber = ChunkedTranscriber(audio_transcriber, max_parallel=MAX_PARALLEL_TRANSCRIPTIONS) if CHUNKED_TRANSCRIPTION else None
+        pipeline = ConsultationPipeline(audio_transcriber, gpt_controller, ANALYSIS_MODE, STREAM_RESULTS, chunked_transcriber,
+                                        ROLLING_SEGMENT_CHARS if ROLLING_SUMMARY and LIVE_TRANSCRIPTION else None, store, UPLOAD_WHILE_RECORDING)
     
     terminate_event = EventAsyncio()
     asyncio_loop = asyncio.new_event_loop()
@@ -54,12 +159,24 @@ def main():
     # start the asyncio loop in a separate thread
     asyncio_thread = Thread(target=start_asyncio_loop, args=(asyncio_loop, terminate_event), daemon=True)
     asyncio_thread.start()
+    if SERVICE_URL:
+        startup.mark('clients')
+    else:
+        Thread(target=warm_up, args=(audio_transcriber, gpt_controller, startup), daemon=True).start()
 
     # start GUI loop in mainthread
-    app_gui = AppGUI(audio_recorder, audio_transcriber, gpt_controller, asyncio_loop, terminate_event)
+    app_gui = AppGUI(audio_recorder, pipeline, asyncio_loop, terminate_event, live_transcriber, startup.mark, INPUT_CHANNELS,
+                     UI_MAX_FPS, TRANSCRIPT_MAX_CHARS, store, RECORDINGS_DIR)
     app_gui.run_mainloop()
 
-    p.terminate()
+    audio_recorder.terminate()
+    if store is not None:
+        store.close()
+
+    if CACHE_DIR:
+        print('transcription cache stats', transcription_cache.get_stats())
+        print('LLM cache stats', llm_cache.get_stats())
+    print('stage latencies\n' + metrics.summary())
 
     asyncio_thread.join()
 
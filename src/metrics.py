@@ -0,0 +1,167 @@
+import collections
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# consultation the current asyncio task works for, set by the pipeline so lower layers can attribute their timings
+current_consultation = contextvars.ContextVar('current_consultation', default=None)
+
+BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, float('inf'))
+
+# per-stage timings, token counts and cost. every record is appended to a JSONL file (when configured)
+# and aggregated into histograms exported in the Prometheus text format, to a file and/or over HTTP.
+# stages: record_stop, file_close, live_flush, file_read, transcription, llm_queue_wait, llm_ttft,
+# llm_total, ui_render, stop_to_report
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jsonl_path = None
+        self.prometheus_path = None
+        self.server = None
+        self.histograms = {} # (stage, labels) -> [bucket counts, sum, count]
+        self.recent = collections.defaultdict(lambda: collections.deque(maxlen=2000)) # stage -> last durations
+        self.counters = collections.defaultdict(float) # (name, labels) -> value
+        self.consultations = {} # consultation id -> accumulated tokens, cost and stage seconds
+        self.listeners = [] # called with (consultation id, totals) when a consultation is finished
+
+    def configure(self, jsonl_path: str = None, prometheus_path: str = None, port: int = None):
+        self.jsonl_path = jsonl_path or None
+        self.prometheus_path = prometheus_path or None
+        if port:
+            self.serve(port)
+
+    def record(self, stage: str, seconds: float, consultation_id=None, **fields):
+        if consultation_id is None:
+            consultation_id = current_consultation.get()
+        labels = tuple(sorted((k, str(v)) for k, v in fields.items() if k in ('model', 'task')))
+        with self.lock:
+            histogram = self.histograms.setdefault((stage, labels), [[0] * len(BUCKETS), 0.0, 0])
+            for i, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+            self.recent[stage].append(seconds)
+            if consultation_id is not None:
+                stages = self._totals(consultation_id)['stages']
+                stages[stage] = round(stages.get(stage, 0.0) + seconds, 6)
+        self._write({'time': time.time(), 'consultation': consultation_id, 'stage': stage, 'seconds': round(seconds, 6), **fields})
+
+    @contextlib.contextmanager
+    def span(self, stage: str, consultation_id=None, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, consultation_id, **fields)
+
+    def record_llm_usage(self, model: str, prompt_tokens: int, completion_tokens: int, cost_cents: float, consultation_id=None):
+        if consultation_id is None:
+            consultation_id = current_consultation.get()
+        with self.lock:
+            self.counters[('medassist_llm_tokens_total', (('kind', 'prompt'), ('model', model)))] += prompt_tokens
+            self.counters[('medassist_llm_tokens_total', (('kind', 'completion'), ('model', model)))] += completion_tokens
+            self.counters[('medassist_llm_cost_cents_total', (('model', model),))] += cost_cents
+            if consultation_id is not None:
+                totals = self._totals(consultation_id)
+                totals['prompt_tokens'] += prompt_tokens
+                totals['completion_tokens'] += completion_tokens
+                totals['cost_cents'] += cost_cents
+                totals['queries'] += 1
+
+    # called with the lock held
+    def _totals(self, consultation_id):
+        return self.consultations.setdefault(consultation_id, {'prompt_tokens': 0, 'completion_tokens': 0, 'cost_cents': 0.0, 'queries': 0, 'stages': {}})
+
+    def add_listener(self, listener):
+        self.listeners.append(listener)
+
+    # per consultation totals, written when the report is done
+    def finish_consultation(self, consultation_id, stop_to_report: float = None):
+        if stop_to_report is not None:
+            self.record('stop_to_report', stop_to_report, consultation_id)
+        with self.lock:
+            totals = self.consultations.pop(consultation_id, {})
+        self._write({'time': time.time(), 'consultation': consultation_id, 'stage': 'consultation', **totals})
+        if self.prometheus_path:
+            self.write_prometheus(self.prometheus_path)
+        for listener in self.listeners:
+            try:
+                listener(consultation_id, totals)
+            except Exception as e:
+                print(f"metrics listener exception {e}")
+
+    def percentiles(self, stage: str, quantiles=(0.5, 0.95, 0.99)):
+        with self.lock:
+            values = sorted(self.recent.get(stage, ()))
+        if not values:
+            return {}
+        return {q: values[min(int(q * len(values)), len(values) - 1)] for q in quantiles}
+
+    def summary(self):
+        lines = []
+        for stage in sorted(self.recent):
+            p = self.percentiles(stage)
+            lines.append(f"{stage}: n={len(self.recent[stage])} p50={p[0.5]:.3f}s p95={p[0.95]:.3f}s p99={p[0.99]:.3f}s")
+        return "\n".join(lines)
+
+    def export_prometheus(self):
+        lines = ['# TYPE medassist_stage_seconds histogram']
+        with self.lock:
+            for (stage, labels), (buckets, total, count) in sorted(self.histograms.items()):
+                label_text = ''.join(f',{k}="{v}"' for k, v in labels)
+                for bound, value in zip(BUCKETS, buckets):
+                    le = '+Inf' if bound == float('inf') else repr(bound)
+                    lines.append(f'medassist_stage_seconds_bucket{{stage="{stage}"{label_text},le="{le}"}} {value}')
+                lines.append(f'medassist_stage_seconds_sum{{stage="{stage}"{label_text}}} {total}')
+                lines.append(f'medassist_stage_seconds_count{{stage="{stage}"{label_text}}} {count}')
+            names = sorted(set(name for name, _ in self.counters))
+            for name in names:
+                lines.append(f'# TYPE {name} counter')
+                for (counter_name, labels), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        label_text = ','.join(f'{k}="{v}"' for k, v in labels)
+                        lines.append(f'{name}{{{label_text}}} {value}')
+        return '\n'.join(lines) + '\n'
+
+    def write_prometheus(self, path: str):
+        try:
+            with open(path + '.tmp', 'w') as file:
+                file.write(self.export_prometheus())
+            # atomic for node_exporter's textfile collector
+            os.replace(path + '.tmp', path)
+        except Exception as e:
+            print(f"metrics write exception {e}")
+
+    # /metrics endpoint on a daemon thread
+    def serve(self, port: int):
+        metrics = self
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.export_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            def log_message(self, *args):
+                pass
+        self.server = ThreadingHTTPServer(('0.0.0.0', port), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        print(f"metrics on http://localhost:{port}/metrics")
+
+    def _write(self, record: dict):
+        if not self.jsonl_path:
+            return
+        try:
+            with self.lock, open(self.jsonl_path, 'a', encoding='utf-8') as file:
+                file.write(json.dumps(record, default=str) + '\n')
+        except Exception as e:
+            print(f"metrics write exception {e}")
+
+# process wide instance, configured by main
+metrics = Metrics()
@@ -0,0 +1,275 @@
+import asyncio
+import json
+import os
+import time
+import websockets
+from urllib.parse import parse_qsl, urlsplit
+from audio_processing import audio_info
+from test_prompt import test_transcription
+
+# local stand-in for the deepgram live websocket API, replies with words from the test transcription.
+# run it and point the app to it with DEEPGRAM_LIVE_URL=ws://localhost:8765/v1/listen
+class MockDeepgramLive:
+    def __init__(self, host: str = "localhost", port: int = 8765, words_per_second: float = 2.5):
+        self.host = host
+        self.port = port
+        self.words_per_second = words_per_second
+        self.words = test_transcription.split()
+        self.server = None
+
+    async def start(self):
+        self.server = await websockets.serve(self._handler, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1] # port 0 picks a free one
+        print(f"mock deepgram live listening on ws://{self.host}:{self.port}/v1/listen")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _handler(self, websocket, path=None):
+        query = dict(x.split('=', 1) for x in websocket.path.split('?', 1)[-1].split('&') if '=' in x)
+        bytes_per_second = int(query.get('sample_rate', 16000)) * int(query.get('channels', 1)) * 2
+        received = 0 # audio bytes received
+        sent_words = 0 # words already finalized
+        pending = [] # words of the current interim result
+        async for message in websocket:
+            if isinstance(message, str):
+                if json.loads(message).get('type') == 'CloseStream':
+                    break
+                continue
+            received += len(message)
+            # one interim result per chunk and a final result every two seconds of audio
+            audio_seconds = received / bytes_per_second
+            target = int(audio_seconds * self.words_per_second)
+            while sent_words + len(pending) < target:
+                pending.append(self.words[(sent_words + len(pending)) % len(self.words)])
+            if not pending:
+                continue
+            is_final = len(pending) >= 2 * self.words_per_second
+            await websocket.send(self._result(pending, sent_words, is_final, query))
+            if is_final:
+                sent_words += len(pending)
+                pending = []
+        # flush the remaining audio as a final result and close like deepgram does
+        if pending:
+            await websocket.send(self._result(pending, sent_words, True, query))
+        await websocket.send(json.dumps({"type": "Metadata"}))
+        await websocket.close()
+
+    # multichannel sessions get each result on the channel of its first word's speaker
+    def _result(self, words, offset, is_final, query):
+        start = offset / self.words_per_second
+        channels = int(query.get('channels', 1))
+        channel = (offset // 20) % channels if query.get('multichannel') == 'true' else 0
+        return json.dumps({
+            "type": "Results",
+            "is_final": is_final,
+            "channel_index": [channel, channels],
+            "channel": {"alternatives": [{
+                "transcript": " ".join(words),
+                "words": [{"word": w, "punctuated_word": w, "start": start + i / self.words_per_second, "end": start + (i + 1) / self.words_per_second, "speaker": ((offset + i) // 20) % 2}
+                          for i, w in enumerate(words)],
+            }]},
+        })
+
+# minimal HTTP/1.1 server with keep-alive, enough for the deepgram and openai clients.
+# handle(method, path, headers, body) returns (status, content type, body bytes or an async iterator of chunks)
+class MockHTTPServer:
+    def __init__(self, host: str, port: int, latency: float = 0.0, max_concurrent: int = 0):
+        self.host = host
+        self.port = port
+        self.latency = latency # seconds before each response starts
+        self.semaphore = asyncio.Semaphore(max_concurrent) if max_concurrent else None # requests served at once, the rest queue
+        self.server = None
+        self.connections = set()
+        self.requests = 0
+        self.connect_latency = 0.0 # seconds to set up each new connection, like a TLS handshake
+        self.connects = 0
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._connection, self.host, self.port)
+        self.port = self.server.sockets[0].getsockname()[1] # port 0 picks a free one
+        print(f"{type(self).__name__} listening on http://{self.host}:{self.port}")
+
+    async def stop(self):
+        if self.server is not None:
+            self.server.close()
+            for task in self.connections:
+                task.cancel()
+            await self.server.wait_closed()
+            self.server = None
+
+    async def _connection(self, reader, writer):
+        task = asyncio.current_task()
+        self.connections.add(task)
+        self.connects += 1
+        try:
+            await asyncio.sleep(self.connect_latency)
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, path, _ = request_line.decode('latin-1').split(' ', 2)
+                headers = {}
+                while True:
+                    line = (await reader.readline()).decode('latin-1').strip()
+                    if not line:
+                        break
+                    name, value = line.split(':', 1)
+                    headers[name.strip().lower()] = value.strip()
+                if headers.get('transfer-encoding', '').lower() == 'chunked':
+                    body = await self._read_chunked(reader)
+                else:
+                    body = await reader.readexactly(int(headers.get('content-length', 0)))
+                self.requests += 1
+                if self.semaphore is not None:
+                    async with self.semaphore:
+                        await self._respond(writer, method, path, headers, body)
+                else:
+                    await self._respond(writer, method, path, headers, body)
+                if headers.get('connection', '').lower() == 'close':
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self.connections.discard(task)
+            writer.close()
+
+    # streamed request bodies, e.g. uploads of unknown length
+    async def _read_chunked(self, reader):
+        chunks = []
+        while True:
+            size = int((await reader.readline()).split(b';', 1)[0].strip(), 16)
+            if size == 0:
+                # trailers, up to the blank line
+                while (await reader.readline()).strip():
+                    pass
+                return b''.join(chunks)
+            chunks.append(await reader.readexactly(size))
+            await reader.readline()
+
+    async def _respond(self, writer, method, path, headers, body):
+        await asyncio.sleep(self.latency)
+        status, content_type, content = await self.handle(method, path, headers, body)
+        reason = {200: 'OK', 404: 'Not Found', 400: 'Bad Request'}.get(status, 'Error')
+        if isinstance(content, bytes):
+            writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\nContent-Length: {len(content)}\r\n\r\n".encode('latin-1') + content)
+            await writer.drain()
+            return
+        writer.write(f"HTTP/1.1 {status} {reason}\r\nContent-Type: {content_type}\r\nTransfer-Encoding: chunked\r\n\r\n".encode('latin-1'))
+        async for chunk in content:
+            writer.write(f"{len(chunk):x}\r\n".encode('latin-1') + chunk + b"\r\n")
+            await writer.drain()
+        writer.write(b"0\r\n\r\n")
+        await writer.drain()
+
+    async def handle(self, method, path, headers, body):
+        return 404, 'text/plain', b'not found'
+
+# local stand-in for the deepgram prerecorded API (POST /v1/listen), transcribes any audio as the test transcription.
+# upload_bytes_per_second limits the upload throughput, realtime_factor is how many audio seconds are processed per second.
+# point the app to it with DEEPGRAM_URL=http://localhost:8766
+class MockDeepgramPrerecorded(MockHTTPServer):
+    def __init__(self, host: str = "localhost", port: int = 8766, latency: float = 0.3, upload_bytes_per_second: float = 0,
+                 realtime_factor: float = 100.0, words_per_second: float = 2.5, max_concurrent: int = 0):
+        super().__init__(host, port, latency, max_concurrent)
+        self.upload_bytes_per_second = upload_bytes_per_second
+        self.realtime_factor = realtime_factor
+        self.words_per_second = words_per_second
+        self.words = test_transcription.split()
+
+    async def handle(self, method, path, headers, body):
+        if method != 'POST' or not path.startswith('/v1/listen'):
+            return 404, 'text/plain', b'not found'
+        query = dict(parse_qsl(urlsplit(path).query))
+        if query.get('encoding') == 'linear16':
+            # raw audio, described by the query
+            channels = int(query.get('channels', 1))
+            duration = len(body) / (2 * channels * int(query.get('sample_rate', 16000)))
+        else:
+            # anything unreadable is taken as 16 kHz 16-bit mono
+            channels, duration = audio_info(body) or (1, len(body) / 32000)
+        multichannel = query.get('multichannel', '').lower() == 'true'
+        delay = duration / self.realtime_factor if self.realtime_factor else 0
+        if self.upload_bytes_per_second:
+            delay += len(body) / self.upload_bytes_per_second
+        await asyncio.sleep(delay)
+        count = max(int(duration * self.words_per_second), 1)
+        words = [{"word": self.words[i % len(self.words)], "punctuated_word": self.words[i % len(self.words)],
+                  "start": i / self.words_per_second, "end": (i + 1) / self.words_per_second, "confidence": 0.99, "speaker": (i // 20) % 2}
+                 for i in range(count)]
+        if multichannel and channels > 1:
+            # every 20 words the next channel speaks, like the diarized speakers
+            channel_words = [[dict(w, speaker=None) for i, w in enumerate(words) if (i // 20) % channels == c] for c in range(channels)]
+        else:
+            channel_words = [words]
+        response = {
+            "metadata": {"request_id": f"mock-{self.requests}", "duration": duration, "channels": channels},
+            "results": {"channels": [{"alternatives": [{"transcript": " ".join(w["word"] for w in cw), "confidence": 0.99, "words": cw}]}
+                                     for cw in channel_words]},
+        }
+        return 200, 'application/json', json.dumps(response).encode('utf-8')
+
+# local stand-in for the OpenAI chat completions API (POST /v1/chat/completions), streaming included.
+# latency is the time to first token, tokens_per_second the generation speed. JSON mode answers with the report sections.
+# point the app to it with OPENAI_BASE_URL=http://localhost:8767/v1
+class MockOpenAI(MockHTTPServer):
+    def __init__(self, host: str = "localhost", port: int = 8767, latency: float = 0.5, tokens_per_second: float = 50.0,
+                 completion_tokens: int = 150, max_concurrent: int = 0):
+        super().__init__(host, port, latency, max_concurrent)
+        self.tokens_per_second = tokens_per_second
+        self.completion_tokens = completion_tokens # words per generated text, one word is one token here
+        self.words = test_transcription.split()
+
+    async def handle(self, method, path, headers, body):
+        if method != 'POST' or not path.endswith('/chat/completions'):
+            return 404, 'text/plain', b'not found'
+        request = json.loads(body)
+        prompt_tokens = sum(len(m.get('content') or '') for m in request['messages']) // 4
+        content = self._content(request.get('response_format', {}).get('type') == 'json_object')
+        tokens = content.split(' ')
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)}
+        completion_id = f"chatcmpl-mock{self.requests}"
+        if not request.get('stream'):
+            await asyncio.sleep(len(tokens) / self.tokens_per_second)
+            response = {"id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": request['model'],
+                        "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                        "usage": usage}
+            return 200, 'application/json', json.dumps(response).encode('utf-8')
+
+        async def events():
+            def chunk(choices, usage=None):
+                data = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": request['model'],
+                        "choices": choices, "usage": usage}
+                return f"data: {json.dumps(data)}\n\n".encode('utf-8')
+            for i, token in enumerate(tokens):
+                yield chunk([{"index": 0, "delta": {"content": token if i == 0 else " " + token}, "finish_reason": None}])
+                await asyncio.sleep(1 / self.tokens_per_second)
+            yield chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}])
+            if request.get('stream_options', {}).get('include_usage'):
+                yield chunk([], usage)
+            yield b"data: [DONE]\n\n"
+        return 200, 'text/event-stream', events()
+
+    def _content(self, json_mode):
+        if not json_mode:
+            return self._text(0, self.completion_tokens)
+        count = max(self.completion_tokens // 3, 1)
+        return json.dumps({key: self._text(i * 50, count) for i, key in enumerate(("summary", "symptoms", "diagnoses"))})
+
+    def _text(self, offset, count):
+        return " ".join(self.words[(offset + i) % len(self.words)] for i in range(count))
+
+async def main():
+    live = MockDeepgramLive(port=int(os.getenv('MOCK_DEEPGRAM_PORT', 8765)))
+    prerecorded = MockDeepgramPrerecorded(port=int(os.getenv('MOCK_DEEPGRAM_HTTP_PORT', 8766)))
+    openai = MockOpenAI(port=int(os.getenv('MOCK_OPENAI_PORT', 8767)))
+    await live.start()
+    await prerecorded.start()
+    await openai.start()
+    await asyncio.Future()
+
+if __name__ == '__main__':
+    asyncio.run(main())
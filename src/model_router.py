@@ -0,0 +1,95 @@
+from lazy_import import lazy_import
+tiktoken = lazy_import('tiktoken', optional=True) # optional, without it tokens are estimated from the text length
+
+# context window (tokens) and price per 1k tokens [prompt, completion] in dollars. every model here needs its
+# rate limits in request_scheduler.DEFAULT_LIMITS
+MODELS = {
+    "gpt-3.5-turbo-0125": {'context': 16385, 'price': [0.0005, 0.0015]},
+    "gpt-4-turbo-preview": {'context': 128000, 'price': [0.01, 0.03]},
+    "gpt-4o": {'context': 128000, 'price': [0.005, 0.015]},
+    "gpt-4o-mini": {'context': 128000, 'price': [0.00015, 0.0006]},
+}
+
+MESSAGE_OVERHEAD = 4 # tokens per message besides its content
+TRIM_MARKER = "\n[... part of the transcript omitted ...]\n"
+
+# picks the model of each query by task and prompt size, and shortens the transcript when the prompt doesn't fit.
+# routes: {task: model} or {task: [[max_prompt_tokens, model], ..., [None, model]]}, the first fitting entry wins.
+# tasks: 'summary', 'symptoms', 'diagnoses' (separate queries), 'report' (structured), 'rolling'; others use default_model.
+# prompt_budget caps the prompt tokens of every query, the models' context windows always apply
+class ModelRouter:
+    def __init__(self, default_model: str = "gpt-4-turbo-preview", routes: dict = None, prompt_budget: int = None):
+        self.default_model = default_model
+        self.routes = {task: [[None, route]] if isinstance(route, str) else route for task, route in (routes or {}).items()}
+        self.prompt_budget = prompt_budget
+        self.encodings = {}
+        self.chars_per_token = 4.0 # without tiktoken, calibrated with the measured prompt tokens
+
+    def price(self, model: str):
+        return MODELS.get(model, {}).get('price', [0, 0])
+
+    def select(self, task: str, prompt_tokens: int):
+        for max_tokens, model in self.routes.get(task, ()):
+            if max_tokens is None or prompt_tokens <= max_tokens:
+                return model
+        return self.default_model
+
+    # returns (model, messages, decision), the last message shortened when needed
+    def route(self, task: str, messages: list, max_output_tokens: int):
+        prompt_tokens = self.count_messages(messages)
+        model = self.select(task, prompt_tokens)
+        limit = MODELS.get(model, {}).get('context', 128000) - max_output_tokens
+        if self.prompt_budget:
+            limit = min(limit, self.prompt_budget)
+        decision = {'task': task, 'model': model, 'prompt_tokens': prompt_tokens, 'trimmed_tokens': 0}
+        if prompt_tokens > limit:
+            content = messages[-1]['content']
+            kept = self.trim(content, max(self.count(content) - (prompt_tokens - limit), 0))
+            messages = messages[:-1] + [{**messages[-1], 'content': kept}]
+            decision['trimmed_tokens'] = prompt_tokens - self.count_messages(messages)
+        return model, messages, decision
+
+    def count(self, text: str):
+        encoding = self.encoding()
+        if encoding is None:
+            return int(len(text) / self.chars_per_token) + 1
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def count_messages(self, messages: list):
+        return sum(self.count(m['content']) + MESSAGE_OVERHEAD for m in messages) + 3
+
+    # the measured prompt tokens of a query, to correct the estimate when tiktoken is missing
+    def observe(self, messages: list, prompt_tokens: int):
+        if self.encoding() is not None or prompt_tokens <= 0:
+            return
+        chars = sum(len(m['content']) for m in messages)
+        measured = chars / max(prompt_tokens - MESSAGE_OVERHEAD * len(messages) - 3, 1)
+        self.chars_per_token += 0.2 * (measured - self.chars_per_token)
+
+    # the consultation's start (complaint, history) and end (diagnosis, plan) matter most: whitespace is collapsed,
+    # then the middle is dropped, keeping a third of the budget from the start and the rest from the end
+    def trim(self, text: str, max_tokens: int):
+        text = '\n'.join(' '.join(line.split()) for line in text.splitlines() if line.strip())
+        if self.count(text) <= max_tokens:
+            return text
+        budget = max(max_tokens - self.count(TRIM_MARKER), 0)
+        head, tail = budget // 3, budget - budget // 3
+        encoding = self.encoding()
+        if encoding is None:
+            head_chars, tail_chars = int(head * self.chars_per_token), int(tail * self.chars_per_token)
+            return text[:head_chars] + TRIM_MARKER + (text[len(text) - tail_chars:] if tail_chars else '')
+        tokens = encoding.encode(text, disallowed_special=())
+        return encoding.decode(tokens[:head]) + TRIM_MARKER + (encoding.decode(tokens[len(tokens) - tail:]) if tail else '')
+
+    # cl100k for every model: it counts a little high for the gpt-4o models (o200k), which only makes the budget conservative
+    def encoding(self):
+        if tiktoken is None:
+            return None
+        if 'cl100k_base' not in self.encodings:
+            try:
+                self.encodings['cl100k_base'] = tiktoken.get_encoding('cl100k_base')
+            except Exception as e:
+                # the encoding is downloaded on first use
+                print(f"tiktoken encoding exception {e}, estimating tokens from the text length")
+                self.encodings['cl100k_base'] = None
+        return self.encodings['cl100k_base']
@@ -0,0 +1,202 @@
+import asyncio
+import time
+from gpt_controller import GPTController
+from transcriber import AudioTranscriber, LiveSession, UploadSession
+from vad import TimeMap
+from chunked_transcriber import ChunkedTranscriber
+from rolling_summary import RollingSummarizer
+from consultation_store import ConsultationStore
+from metrics import metrics, current_consultation
+from prompts import RESUME_PROMPT, SYMPTOMS_PROMPT, DIAGNOSTICS_PROMPT, REPORT_PROMPT, REPORT_SCHEMA, build_messages
+
+# stop -> transcribe -> analyse flow of a consultation. runs on the asyncio loop and only reports progress
+# through events_cback(consultation_id, event, data), called from the asyncio thread:
+#   'status'       data: progress text
+#   'transcription' data: full transcription (only when it was not streamed live)
+#   'analysis'     data: None, the report sections are about to be generated
+#   'section'      data: (key, text, append), key in REPORT_SCHEMA
+#   'section_error' data: (key, error text), the section failed after retries
+#   'done'         data: None
+#   'error'        data: error text
+class ConsultationPipeline:
+    def __init__(self, audio_transcriber: AudioTranscriber, gpt_controller: GPTController, analysis_mode: str = 'structured', stream_results: bool = True,
+                 chunked_transcriber: ChunkedTranscriber = None, rolling_segment_chars: int = None, store: ConsultationStore = None,
+                 upload_while_recording: bool = False):
+        self.audio_transcriber = audio_transcriber
+        self.chunked_transcriber = chunked_transcriber # long recordings are split and transcribed in parallel
+        self.gpt_controller = gpt_controller
+        self.analysis_mode = analysis_mode # 'structured' or 'separate'
+        self.stream_results = stream_results # forward LLM results as they are generated
+        self.rolling_segment_chars = rolling_segment_chars # report updated during live recordings every that many chars, None disables
+        self.analysis_latency = {}
+        self.store = store # transcriptions and reports are saved when given
+        self.upload_while_recording = upload_while_recording # without live transcription, upload the audio as it is recorded
+
+    # events(event, data) wrapper saving the transcription, the report and the outcome of the consultation to the store
+    def stored_events(self, consultation_id, events):
+        if self.store is None:
+            return events
+        sections = {}
+        def save(event, data=None):
+            if event == 'transcription':
+                self.store.save_transcription(consultation_id, data)
+            elif event == 'analysis':
+                sections.clear()
+            elif event == 'section':
+                key, text, append = data
+                sections[key] = sections.get(key, '') + text if append else text
+            elif event == 'section_error':
+                sections.pop(data[0], None)
+            elif event in ('done', 'error'):
+                self.store.save_report(consultation_id, sections, event, data if event == 'error' else None)
+            events(event, data)
+        return save
+
+    # summarizer to feed the live session's final segments to (LiveTranscriber.start segment_cback), None when disabled
+    def start_rolling_summary(self, consultation_id):
+        if self.rolling_segment_chars is None:
+            return None
+        return RollingSummarizer(self.gpt_controller, consultation_id, self.rolling_segment_chars)
+
+    # session to send the recorder's frames to (AudioRecorder.start audio_cback) when the recording is uploaded while
+    # recording, None otherwise. passed to run as its live_session
+    def start_upload(self, loop: asyncio.AbstractEventLoop, language: str, sample_rate: int, channels: int):
+        if not self.upload_while_recording:
+            return None
+        return self.audio_transcriber.start_upload(loop, language, sample_rate, channels)
+
+    # keep the API connections open while recording (HttpTransport.keep_warm) so the requests after stop skip the
+    # TCP/TLS setup: one per report query, and the uploads unless transcribing live. returns the future to cancel on
+    # stop, None without a shared transport
+    def start_warming(self, loop: asyncio.AbstractEventLoop, live: bool):
+        transport = self.gpt_controller.transport
+        if transport is None or transport.warm_interval is None:
+            return None
+        urls = [self.gpt_controller.warm_url] * (len(REPORT_SCHEMA) if self.analysis_mode == 'separate' else 1)
+        if not live:
+            urls += [self.audio_transcriber.warm_url] * (self.chunked_transcriber.max_parallel if self.chunked_transcriber is not None else 1)
+        return asyncio.run_coroutine_threadsafe(transport.keep_warm(urls), loop)
+
+    async def run(self, consultation_id, file_name: str, live_session: LiveSession, language: str, events_cback, rolling_summary: RollingSummarizer = None):
+        def send(event, data=None):
+            try:
+                events_cback(consultation_id, event, data)
+            except Exception as e:
+                print(f"pipeline event callback exception {e}")
+        events = self.stored_events(consultation_id, send)
+
+        # this task's timings are attributed to consultation_id
+        current_consultation.set(consultation_id)
+        try:
+            events('status', 'transcribing...')
+            transcription = None
+            uploaded = isinstance(live_session, UploadSession)
+            live_transcription = False # the transcription came from the live session, so did the rolling report's segments
+            if live_session is not None:
+                # flush the live session, the transcription is already on screen.
+                # an upload session only has the last frames left to send
+                with metrics.span('upload_flush' if uploaded else 'live_flush'):
+                    transcription = await live_session.finish()
+                live_transcription = transcription is not None and not uploaded
+                if transcription is not None and uploaded:
+                    events('transcription', transcription)
+                elif transcription is not None and self.store is not None:
+                    self.store.save_transcription(consultation_id, transcription)
+            if transcription is None:
+                if file_name is None:
+                    events('error', 'no recording to transcribe')
+                    return
+                # fallback: upload the whole recording
+                with metrics.span('transcription', chunked=self.chunked_transcriber is not None):
+                    transcription = await self.transcribe_file(file_name, language)
+                # transcription = test_transcription # TEST: use test transcription
+                if transcription is None:
+                    events('error', 'transcription failed')
+                    return
+                events('transcription', transcription)
+
+            if rolling_summary is not None and live_transcription:
+                with metrics.span('analysis', mode='rolling'):
+                    await self.run_rolling_analysis(rolling_summary, transcription, events)
+            else:
+                if rolling_summary is not None:
+                    # the live session failed: its segments miss the rest of the consultation
+                    rolling_summary.cancel()
+                with metrics.span('analysis', mode=self.analysis_mode):
+                    await self.analyse(transcription, events)
+            events('status', 'report ready')
+            events('done')
+        except Exception as e:
+            print(f"pipeline exception {e}")
+            events('error', str(e))
+
+    async def transcribe_file(self, file_name: str, language: str):
+        transcriber = self.chunked_transcriber if self.chunked_transcriber is not None else self.audio_transcriber
+        return await transcriber.transcribe(file_name, language=language, time_map=TimeMap.load(file_name))
+
+    # events(event, data) receives the 'analysis' and 'section' events
+    async def analyse(self, transcription: str, events):
+        events('status', 'generating report...')
+        events('analysis')
+        if self.analysis_mode == 'structured':
+            await self.run_structured_analysis(transcription, events)
+        else:
+            await self.run_separate_analysis(transcription, events)
+
+    # one query returning summary, symptoms and diagnoses together, falls back to separate queries on failure
+    async def run_structured_analysis(self, transcription, events):
+        print("sending structured report query...")
+        start = time.perf_counter()
+        replaced_messages = [build_messages(prompt, transcription) for prompt in (RESUME_PROMPT, SYMPTOMS_PROMPT, DIAGNOSTICS_PROMPT)]
+        section_cback = (lambda key, delta: events('section', (key, delta, True))) if self.stream_results else None
+        report = await self.gpt_controller.send_structured_query(build_messages(REPORT_PROMPT, transcription), REPORT_SCHEMA, replaced_messages, section_cback,
+                                                                 task='report')
+        if report is None:
+            print("structured report failed, falling back to separate queries...")
+            events('analysis')
+            await self.run_separate_analysis(transcription, events)
+            return
+        for key in REPORT_SCHEMA:
+            events('section', (key, report[key], False))
+        self.report_analysis_latency('structured', time.perf_counter() - start)
+
+    # only the part of the transcription not summarized during the recording is left to merge
+    async def run_rolling_analysis(self, rolling_summary: RollingSummarizer, transcription, events):
+        events('status', 'generating report...')
+        events('analysis')
+        start = time.perf_counter()
+        section_cback = (lambda key, delta: events('section', (key, delta, True))) if self.stream_results else None
+        report = await rolling_summary.finish(section_cback)
+        if report is None:
+            print("rolling report failed, analysing the whole transcription...")
+            await self.analyse(transcription, events)
+            return
+        for key in REPORT_SCHEMA:
+            events('section', (key, report[key], False))
+        self.report_analysis_latency('rolling', time.perf_counter() - start)
+
+    # three queries, each resending the whole transcription
+    async def run_separate_analysis(self, transcription, events):
+        start = time.perf_counter()
+        print("sending resume, symptoms and diagnostics queries...")
+        async def section_query(key, prompt):
+            cback = lambda message: events('section', (key, message.content, False))
+            delta_cback = (lambda delta: events('section', (key, delta, True))) if self.stream_results else None
+            usage = await self.gpt_controller.send_query(build_messages(prompt, transcription), cback, delta_cback=delta_cback, task=key)
+            if usage is None:
+                # don't leave the pane waiting
+                events('section_error', (key, 'could not be generated, please try again'))
+        await asyncio.gather(
+            section_query('summary', RESUME_PROMPT),
+            section_query('symptoms', SYMPTOMS_PROMPT),
+            section_query('diagnoses', DIAGNOSTICS_PROMPT),
+        )
+        self.report_analysis_latency('separate', time.perf_counter() - start)
+
+    def report_analysis_latency(self, mode, latency):
+        self.analysis_latency[mode] = latency
+        other = 'separate' if mode == 'structured' else 'structured'
+        if other in self.analysis_latency:
+            print(f"analysis latency: {mode} {latency:.2f}s, last {other} {self.analysis_latency[other]:.2f}s ({self.analysis_latency[other] - latency:+.2f}s saved)")
+        else:
+            print(f"analysis latency: {mode} {latency:.2f}s")
@@ -0,0 +1,134 @@
+import asyncio
+import random
+import time
+from lazy_import import lazy_import
+from metrics import metrics
+openai = lazy_import('openai')
+
+# requests per minute and tokens per minute allowed for each model.
+# set them to this workstation's share of the account limits
+DEFAULT_LIMITS = {
+    "gpt-3.5-turbo-0125": (3500, 160000),
+    "gpt-4-turbo-preview": (500, 300000),
+    "gpt-4o": (500, 300000),
+    "gpt-4o-mini": (500, 2000000),
+}
+
+# errors worth another attempt. a function so openai is only imported when something fails
+def retryable_errors():
+    return (openai.RateLimitError, openai.APITimeoutError, openai.APIConnectionError, openai.InternalServerError, asyncio.TimeoutError)
+
+# refills continuously up to capacity, capacity per minute
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.level = per_minute
+        self.rate = per_minute / 60
+        self.updated = time.monotonic()
+
+    def refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # seconds until amount is available, requests above capacity only wait for a full bucket
+    def wait_time(self, amount: float):
+        self.refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+# per-model request/token budgets, retries with jittered exponential backoff, per-attempt timeouts,
+# an overall deadline and optional hedging of slow requests
+class RequestScheduler:
+    def __init__(self, limits: dict = None, max_retries: int = 4, base_delay: float = 1.0, max_delay: float = 20.0,
+                 attempt_timeout: float = 60.0, deadline: float = 120.0, hedge_after: float = None):
+        self.limits = dict(DEFAULT_LIMITS, **(limits or {}))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.attempt_timeout = attempt_timeout
+        self.deadline = deadline
+        self.hedge_after = hedge_after # start a second attempt when the first takes longer, None disables
+        self.buckets = {}
+        self.locks = {} # one queue per model
+
+    # wait until model has room for one request of tokens tokens, returns the time waited
+    async def acquire(self, model: str, tokens: int):
+        start = time.monotonic()
+        if model not in self.buckets:
+            rpm, tpm = self.limits.get(model, (60, 100000))
+            self.buckets[model] = (TokenBucket(rpm), TokenBucket(tpm))
+            self.locks[model] = asyncio.Lock()
+        async with self.locks[model]:
+            requests, token_bucket = self.buckets[model]
+            while True:
+                wait = max(requests.wait_time(1), token_bucket.wait_time(tokens))
+                if wait <= 0:
+                    break
+                await asyncio.sleep(wait)
+            requests.level -= 1
+            token_bucket.level -= min(tokens, token_bucket.capacity)
+        return time.monotonic() - start
+
+    # run attempt_fn() (a coroutine function) under the model budget.
+    # can_retry() tells if a failed attempt may be repeated (e.g. nothing was streamed to the user yet);
+    # hedge=False for requests with side effects, like streaming.
+    async def run(self, model: str, tokens: int, attempt_fn, can_retry=None, hedge: bool = True):
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.max_retries + 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise asyncio.TimeoutError(f"deadline of {self.deadline}s exceeded")
+            try:
+                waited = await asyncio.wait_for(self.acquire(model, tokens), remaining)
+                metrics.record('llm_queue_wait', waited, model=model, attempt=attempt + 1)
+                if waited > 0.05:
+                    print(f"LLM: waited {waited:.2f}s for the {model} budget")
+                timeout = min(self.attempt_timeout, deadline - time.monotonic())
+                if hedge and self.hedge_after is not None and self.hedge_after < timeout:
+                    return await self._hedged(model, tokens, attempt_fn, timeout)
+                return await asyncio.wait_for(attempt_fn(), timeout)
+            except retryable_errors() as e:
+                if attempt == self.max_retries or (can_retry is not None and not can_retry()):
+                    raise
+                delay = self._retry_delay(e, attempt)
+                if time.monotonic() + delay >= deadline:
+                    raise
+                print(f"LLM: attempt {attempt + 1} failed ({type(e).__name__}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    # jittered exponential backoff, or the server's Retry-After when given
+    def _retry_delay(self, error, attempt):
+        response = getattr(error, 'response', None)
+        if response is not None:
+            try:
+                return min(float(response.headers.get('retry-after')), self.max_delay)
+            except (TypeError, ValueError):
+                pass
+        return random.uniform(0.5, 1.0) * min(self.max_delay, self.base_delay * 2 ** attempt)
+
+    # first attempt, and a second one if the first is still running after hedge_after seconds; first success wins
+    async def _hedged(self, model, tokens, attempt_fn, timeout):
+        first = asyncio.create_task(attempt_fn())
+        tasks = [first]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=self.hedge_after)
+            if not done:
+                await self.acquire(model, tokens)
+                print(f"LLM: request slower than {self.hedge_after}s, hedging")
+                tasks.append(asyncio.create_task(attempt_fn()))
+            end = time.monotonic() + timeout - self.hedge_after
+            pending = set(tasks)
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, timeout=max(end - time.monotonic(), 0), return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    raise asyncio.TimeoutError()
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
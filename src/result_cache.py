@@ -0,0 +1,118 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+# content-addressed on-disk cache of JSON results, one file per key.
+# entries older than ttl_seconds are ignored, the least recently used ones are evicted above max_bytes
+class ResultCache:
+    def __init__(self, directory: str, max_bytes: int = 200 * 1024 * 1024, ttl_seconds: float = 30 * 24 * 3600):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expired = 0
+        os.makedirs(directory, exist_ok=True)
+        # key -> [last access, size], the file access time is the LRU clock across runs
+        self.entries = {}
+        for name in os.listdir(directory):
+            if name.endswith('.json'):
+                stat = os.stat(os.path.join(directory, name))
+                self.entries[name[:-5]] = [stat.st_mtime, stat.st_size]
+        self.total_bytes = sum(size for _, size in self.entries.values())
+
+    # hash of any JSON-serializable description of the request, plus optional raw bytes (audio)
+    @staticmethod
+    def make_key(description, data: bytes = None):
+        digest = hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode('utf-8'))
+        if data is not None:
+            digest.update(hashlib.sha256(data).digest())
+        return digest.hexdigest()
+
+    # same key as make_key with the file's content, read in blocks so large recordings aren't loaded in memory
+    @staticmethod
+    def make_file_key(description, file_name: str, block_size: int = 1 << 20):
+        digest = hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode('utf-8'))
+        data_digest = hashlib.sha256()
+        with open(file_name, 'rb') as file:
+            while block := file.read(block_size):
+                data_digest.update(block)
+        digest.update(data_digest.digest())
+        return digest.hexdigest()
+
+    def get(self, key: str):
+        with self.lock:
+            path = self._path(key)
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            try:
+                with open(path, encoding='utf-8') as file:
+                    entry = json.load(file)
+            except Exception as e:
+                print(f"cache read exception {e}")
+                self._remove(key)
+                self.misses += 1
+                return None
+            if time.time() - entry['created'] > self.ttl_seconds:
+                self._remove(key)
+                self.expired += 1
+                self.misses += 1
+                return None
+            now = time.time()
+            os.utime(path, (now, now))
+            self.entries[key][0] = now
+            self.hits += 1
+            return entry['value']
+
+    def put(self, key: str, value):
+        with self.lock:
+            path = self._path(key)
+            temp_path = path + '.tmp'
+            try:
+                with open(temp_path, 'w', encoding='utf-8') as file:
+                    json.dump({'created': time.time(), 'value': value}, file)
+                os.replace(temp_path, path)
+            except Exception as e:
+                print(f"cache write exception {e}")
+                return
+            if key in self.entries:
+                self.total_bytes -= self.entries[key][1]
+            size = os.path.getsize(path)
+            self.entries[key] = [time.time(), size]
+            self.total_bytes += size
+            # evict the least recently used entries
+            for old_key, _ in sorted(self.entries.items(), key=lambda x: x[1][0]):
+                if self.total_bytes <= self.max_bytes:
+                    break
+                if old_key != key:
+                    self._remove(old_key)
+                    self.evictions += 1
+
+    def get_stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'evictions': self.evictions,
+            'expired': self.expired,
+            'entries': len(self.entries),
+            'bytes': self.total_bytes,
+        }
+
+    def _path(self, key: str):
+        return os.path.join(self.directory, key + '.json')
+
+    def _remove(self, key: str):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[1]
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,70 @@
+import asyncio
+import time
+from gpt_controller import GPTController
+from metrics import metrics, current_consultation
+from prompts import REPORT_SCHEMA, build_rolling_messages
+
+# keeps the report of a consultation up to date while it is recorded: final live segments are buffered and,
+# every segment_chars of new transcript, folded into the running report by one small query (report so far +
+# new part). at stop only the last, unsummarized part is left to fold in, so the stop-to-report time and the
+# prompt size no longer grow with the consultation length. updates run one at a time, on the asyncio loop.
+class RollingSummarizer:
+    def __init__(self, gpt_controller: GPTController, consultation_id=None, segment_chars: int = 4000):
+        self.gpt_controller = gpt_controller
+        self.consultation_id = consultation_id
+        self.segment_chars = segment_chars
+        self.report = {key: "" for key in REPORT_SCHEMA}
+        self.pending = [] # final segments not folded into the report yet
+        self.task = None
+        self.updates = 0
+        self.cancelled = False
+
+    # live session segment_cback, runs on the asyncio loop
+    def add_segment(self, text: str):
+        if self.cancelled:
+            return
+        self.pending.append(text)
+        if (self.task is None or self.task.done()) and self.pending_chars() >= self.segment_chars:
+            self.task = asyncio.get_running_loop().create_task(self._update_loop())
+
+    def pending_chars(self):
+        return sum(len(text) for text in self.pending)
+
+    # report with the remaining segments folded in, section_cback streams it like send_structured_query.
+    # None when the final update failed, the caller falls back to the whole transcription
+    async def finish(self, section_cback=None):
+        if self.task is not None:
+            await self.task
+        if not self.pending:
+            return dict(self.report) if self.updates else None
+        print(f"rolling report: final merge of {self.pending_chars()} chars after {self.updates} updates")
+        return await self._update(section_cback)
+
+    # the report won't be used, e.g. the live transcription failed: no more updates are paid for
+    def cancel(self):
+        self.cancelled = True
+        self.pending.clear()
+        if self.task is not None:
+            self.task.cancel()
+
+    async def _update_loop(self):
+        current_consultation.set(self.consultation_id)
+        while self.pending_chars() >= self.segment_chars:
+            if await self._update() is None:
+                # keep the segments, they go with the next update or the final merge
+                return
+
+    async def _update(self, section_cback=None):
+        segments = list(self.pending)
+        start = time.perf_counter()
+        report = await self.gpt_controller.send_structured_query(build_rolling_messages(self.report, "".join(segments)), REPORT_SCHEMA,
+                                                                 section_cback=section_cback, task='rolling')
+        metrics.record('rolling_update', time.perf_counter() - start, self.consultation_id, chars=sum(len(text) for text in segments), ok=report is not None)
+        if report is None:
+            print("rolling report update failed")
+            return None
+        # segments that arrived during the query stay pending
+        del self.pending[:len(segments)]
+        self.report = report
+        self.updates += 1
+        return dict(report)
@@ -0,0 +1,324 @@
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import tempfile
+import time
+from aiohttp import web
+from dotenv import load_dotenv
+from transcriber import AudioTranscriber, LiveTranscriber, LiveSession
+from audio_processing import new_recording_name
+from vad import TimeMap
+from chunked_transcriber import ChunkedTranscriber
+from gpt_controller import GPTController
+from pipeline import ConsultationPipeline
+from rolling_summary import RollingSummarizer
+from request_scheduler import RequestScheduler
+from model_router import ModelRouter
+from http_transport import HttpTransport
+from result_cache import ResultCache
+from audio_processing import open_audio_sink
+from consultation_store import ConsultationStore
+from metrics import metrics, current_consultation
+load_dotenv()
+
+# network mode: one pipeline, with its API clients and connection pools, serving every workstation of the clinic.
+#   POST /v1/consultations?language=en&format=flac  body: a recording. response: the pipeline events, one JSON object per line
+#   GET  /v1/stream?language=en&sample_rate=16000&channels=1&format=flac  websocket: binary 16-bit PCM frames, then
+#        {"type": "stop"}. receives {"event": "transcript", "data": [text, is_final]} while recording, then the pipeline events
+#   GET  /health, GET /metrics
+# events are {"consultation": id, "event": ..., "data": ...} with the ConsultationPipeline events.
+# max_active consultations are processed at once and max_queued more wait for a worker; past that, and past max_streams
+# open recordings, requests are refused with 503 and Retry-After so the clients back off
+class ConsultationServer:
+    def __init__(self, pipeline: ConsultationPipeline, live_transcriber: LiveTranscriber = None, max_active: int = 8, max_queued: int = 32,
+                 max_streams: int = 64, work_dir: str = None):
+        self.pipeline = pipeline
+        self.live_transcriber = live_transcriber # None records the streams and uploads them on stop
+        self.max_active = max_active
+        self.max_queued = max_queued
+        self.max_streams = max_streams
+        self.work_dir = work_dir or tempfile.mkdtemp(prefix='medassist_')
+        os.makedirs(self.work_dir, exist_ok=True)
+        self.workers = asyncio.Semaphore(max_active)
+        self.ids = itertools.count(1) # without a store, which assigns the ids otherwise
+        self.active = 0 # consultations being processed
+        self.waiting = 0 # consultations waiting for a worker
+        self.receiving = 0 # uploads whose recording is still arriving
+        self.streams = 0 # recordings being streamed
+        self.runner = None
+
+    def create_app(self):
+        app = web.Application(client_max_size=0) # uploads are streamed to disk
+        app.router.add_post('/v1/consultations', self.upload)
+        app.router.add_get('/v1/stream', self.stream)
+        app.router.add_get('/health', self.health)
+        app.router.add_get('/metrics', self.prometheus)
+        return app
+
+    async def start(self, host: str = '0.0.0.0', port: int = 8080):
+        self.runner = web.AppRunner(self.create_app())
+        await self.runner.setup()
+        await web.TCPSite(self.runner, host, port).start()
+        self.port = self.runner.addresses[0][1] # port 0 picks a free one
+        print(f"consultation server listening on http://{host}:{self.port}")
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def busy(self, reason: str):
+        print(f"server busy: {reason}")
+        return web.json_response({'error': reason}, status=503, headers={'Retry-After': '5'})
+
+    async def upload(self, request: web.Request):
+        # uploads still arriving take a slot of their own: they are queued only once received, by then a worker may be free
+        if self.active + self.waiting + self.receiving >= self.max_active + self.max_queued:
+            return self.busy('too many consultations queued')
+        # the slot is taken before the body arrives, so concurrent uploads can't all pass the check
+        self.receiving += 1
+        queued = False
+        try:
+            consultation_id, file_name = self.start_consultation(request.query.get('language', 'en'), request.query.get('format', 'wav'))
+            with open(file_name, 'wb') as file:
+                async for chunk in request.content.iter_chunked(1 << 16):
+                    file.write(chunk)
+            self.receiving -= 1
+            self.waiting += 1
+            queued = True
+            response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+            await response.prepare(request)
+        except BaseException:
+            if queued:
+                self.waiting -= 1
+            else:
+                self.receiving -= 1
+            raise
+        outbox = asyncio.Queue()
+        task = asyncio.create_task(self.process(consultation_id, file_name, None, request.query.get('language', 'en'),
+                                                lambda _, event, data=None: outbox.put_nowait((event, data)), None, time.perf_counter(),
+                                                queued=True))
+        try:
+            while True:
+                event, data = await outbox.get()
+                await response.write((json.dumps({'consultation': consultation_id, 'event': event, 'data': data}) + '\n').encode('utf-8'))
+                if event in ('done', 'error'):
+                    break
+            await response.write_eof()
+        except (ConnectionError, asyncio.CancelledError):
+            # the client went away, don't spend the API calls
+            task.cancel()
+            raise
+        return response
+
+    async def stream(self, request: web.Request):
+        if self.streams >= self.max_streams:
+            return self.busy('too many recordings')
+        # the slot is taken before the first await, so concurrent connections can't all pass the check
+        self.streams += 1
+        try:
+            socket = web.WebSocketResponse(heartbeat=30)
+            await socket.prepare(request)
+            language = request.query.get('language', 'en')
+            consultation_id, file_name = self.start_consultation(language, request.query.get('format', 'wav'))
+            sample_rate = int(request.query.get('sample_rate', 16000))
+            channels = int(request.query.get('channels', 1))
+            outbox = asyncio.Queue()
+            send = lambda event, data=None: outbox.put_nowait({'consultation': consultation_id, 'event': event, 'data': data})
+            sender = asyncio.create_task(self._send_loop(socket, outbox))
+            send('consultation', consultation_id)
+
+            live_session = rolling_summary = None
+            if self.live_transcriber is not None:
+                rolling_summary = self.pipeline.start_rolling_summary(consultation_id)
+                live_session = self.live_transcriber.start(asyncio.get_running_loop(), lambda text, is_final: send('transcript', [text, is_final]),
+                                                           language=language, sample_rate=sample_rate, channels=channels,
+                                                           segment_cback=rolling_summary.add_segment if rolling_summary is not None else None)
+            # kept for the upload fallback when the live transcription fails
+            sink = open_audio_sink(file_name, sample_rate, channels)
+            if sink.file_name != file_name and self.pipeline.store is not None:
+                self.pipeline.store.save_audio_file(consultation_id, sink.file_name) # fell back to WAV
+            stopped = False
+            try:
+                async for message in socket:
+                    if message.type == web.WSMsgType.BINARY:
+                        sink.write(message.data)
+                        if live_session is not None:
+                            # bounded, a live connection that can't keep up is given up for the recording
+                            live_session.send_audio(message.data)
+                    elif message.type == web.WSMsgType.TEXT and json.loads(message.data).get('type') == 'stop':
+                        stopped = True
+                        break
+            except Exception as e:
+                print(f"stream {consultation_id} exception {e}")
+            finally:
+                sink.close()
+        finally:
+            self.streams -= 1
+        if not stopped:
+            # the workstation went away while recording
+            print(f"stream {consultation_id} closed before stop")
+            if rolling_summary is not None:
+                rolling_summary.cancel() # no report will be asked for
+            if live_session is not None:
+                await live_session.finish()
+            if self.pipeline.store is not None:
+                self.pipeline.store.save_report(consultation_id, {}, 'error', 'recording interrupted')
+            sender.cancel()
+            return socket
+        await self.process(consultation_id, sink.file_name, live_session, language, lambda _, event, data=None: send(event, data),
+                           rolling_summary, time.perf_counter())
+        outbox.put_nowait(None)
+        await sender
+        await socket.close()
+        return socket
+
+    # returns (consultation_id, file_name), the id assigned by the store when there is one.
+    # recordings are named uniquely, without a store the ids restart with the server
+    def start_consultation(self, language, audio_format: str):
+        file_name = new_recording_name(self.work_dir, audio_format)
+        TimeMap.discard(file_name)
+        consultation_id = self.pipeline.store.start(language, file_name) if self.pipeline.store is not None else None
+        if consultation_id is None:
+            consultation_id = next(self.ids)
+        return consultation_id, file_name
+
+    async def _send_loop(self, socket, outbox):
+        while True:
+            message = await outbox.get()
+            if message is None:
+                return
+            try:
+                await socket.send_json(message)
+            except Exception as e:
+                print(f"stream send exception {e}")
+                return
+
+    # runs the pipeline once a worker is free. uploads are transcribed whole, streams finish their live session.
+    # queued: the caller already took the queue slot
+    async def process(self, consultation_id, file_name, live_session: LiveSession, language, events_cback, rolling_summary: RollingSummarizer, stop,
+                      queued: bool = False):
+        current_consultation.set(consultation_id)
+        events = lambda event, data=None: events_cback(consultation_id, event, data)
+        if not queued:
+            self.waiting += 1
+        try:
+            if self.workers.locked():
+                events('status', 'waiting for a worker...')
+            with metrics.span('server_queue_wait'):
+                await self.workers.acquire()
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        finished = {}
+        def record_events(consultation_id, event, data=None):
+            if event in ('done', 'error'):
+                finished[event] = time.perf_counter()
+            events_cback(consultation_id, event, data)
+        try:
+            if live_session is not None:
+                await self.pipeline.run(consultation_id, file_name, live_session, language, record_events, rolling_summary)
+            else:
+                await self.run_upload(consultation_id, file_name, language, record_events)
+        finally:
+            self.active -= 1
+            self.workers.release()
+            metrics.finish_consultation(consultation_id, finished['done'] - stop if 'done' in finished else None)
+
+    async def run_upload(self, consultation_id, file_name, language, events_cback):
+        events = self.pipeline.stored_events(consultation_id, lambda event, data=None: events_cback(consultation_id, event, data))
+        try:
+            events('status', 'transcribing...')
+            with metrics.span('transcription', chunked=self.pipeline.chunked_transcriber is not None):
+                transcription = await self.pipeline.transcribe_file(file_name, language)
+            if transcription is None:
+                events('error', 'transcription failed')
+                return
+            events('transcription', transcription)
+            with metrics.span('analysis', mode=self.pipeline.analysis_mode):
+                await self.pipeline.analyse(transcription, events)
+            events('status', 'report ready')
+            events('done')
+        except Exception as e:
+            print(f"server pipeline exception {e}")
+            events('error', str(e))
+
+    async def health(self, request: web.Request):
+        return web.json_response({'active': self.active, 'waiting': self.waiting, 'receiving': self.receiving, 'streams': self.streams,
+                                  'max_active': self.max_active, 'max_queued': self.max_queued, 'max_streams': self.max_streams})
+
+    async def prometheus(self, request: web.Request):
+        return web.Response(text=metrics.export_prometheus(), content_type='text/plain')
+
+async def serve(args):
+    mock_servers = []
+    deepgram_url = os.getenv('DEEPGRAM_URL', '')
+    deepgram_live_url = os.getenv('DEEPGRAM_LIVE_URL', 'wss://api.deepgram.com/v1/listen')
+    openai_base_url = os.getenv('OPENAI_BASE_URL') or None
+    if args.mock:
+        # local stand-ins for deepgram and openai, no accounts needed
+        from mock_servers import MockDeepgramLive, MockDeepgramPrerecorded, MockOpenAI
+        mock_servers = [MockDeepgramLive(port=0), MockDeepgramPrerecorded(port=0), MockOpenAI(port=0)]
+        for server in mock_servers:
+            await server.start()
+        deepgram_live_url = f"ws://localhost:{mock_servers[0].port}/v1/listen"
+        deepgram_url = f"http://localhost:{mock_servers[1].port}"
+        openai_base_url = f"http://localhost:{mock_servers[2].port}/v1"
+
+    cache_dir = os.getenv('CACHE_DIR', 'cache')
+    transcription_cache = ResultCache(os.path.join(cache_dir, 'transcriptions')) if cache_dir and not args.mock else None
+    llm_cache = ResultCache(os.path.join(cache_dir, 'llm')) if cache_dir and not args.mock else None
+    channel_names = [x.strip() for x in os.getenv('CHANNEL_NAMES', '').split(',') if x.strip()] or None
+    # one set of API clients sharing one connection pool for every workstation. the connections stay warm with the
+    # traffic of the other consultations, so there is no warming while recording
+    transport = HttpTransport(int(os.getenv('HTTP_MAX_CONNECTIONS', 100)), float(os.getenv('HTTP_KEEPALIVE_SECONDS', 60)),
+                              os.getenv('HTTP2', '1') == '1', warm_interval=None)
+    audio_transcriber = AudioTranscriber(os.getenv('DEEPGRAM_API_KEY', 'mock' if args.mock else None), transcription_cache, deepgram_url, channel_names,
+                                         transport)
+    live_transcriber = LiveTranscriber(os.getenv('DEEPGRAM_API_KEY', 'mock' if args.mock else None), deepgram_live_url, channel_names) if args.live else None
+    scheduler = RequestScheduler(json.loads(os.getenv('LLM_LIMITS', '{}')), attempt_timeout=float(os.getenv('LLM_TIMEOUT', 60)),
+                                 deadline=float(os.getenv('LLM_DEADLINE', 120)))
+    router = ModelRouter(os.getenv('LLM_MODEL', 'gpt-4-turbo-preview'), json.loads(os.getenv('LLM_ROUTES', '{}')), int(os.getenv('LLM_PROMPT_BUDGET', 0)) or None)
+    gpt_controller = GPTController(os.getenv('OPENAI_API_KEY', 'mock' if args.mock else None), llm_cache, scheduler, openai_base_url, router, transport)
+    chunked_transcriber = ChunkedTranscriber(audio_transcriber, max_parallel=int(os.getenv('MAX_PARALLEL_TRANSCRIPTIONS', 4)))
+    store = None
+    if args.db:
+        store = ConsultationStore(args.db)
+        metrics.add_listener(store.save_metrics)
+    rolling_chars = int(os.getenv('ROLLING_SEGMENT_CHARS', 4000)) if os.getenv('ROLLING_SUMMARY', '0') == '1' else None
+    pipeline = ConsultationPipeline(audio_transcriber, gpt_controller, args.analysis_mode, stream_results=True,
+                                    chunked_transcriber=chunked_transcriber, rolling_segment_chars=rolling_chars, store=store)
+
+    server = ConsultationServer(pipeline, live_transcriber, args.max_active, args.max_queued, args.max_streams, args.work_dir)
+    await server.start(args.host, args.port)
+    try:
+        await asyncio.Future()
+    finally:
+        await server.stop()
+        for mock_server in mock_servers:
+            await mock_server.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the consultation pipeline to the workstations (SERVICE_URL of the app).")
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-active', type=int, default=8, help="consultations processed at the same time")
+    parser.add_argument('--max-queued', type=int, default=32, help="consultations waiting for a worker before new ones are refused")
+    parser.add_argument('--max-streams', type=int, default=64, help="recordings streamed at the same time")
+    parser.add_argument('--no-live', dest='live', action='store_false', help="transcribe the streamed recordings on stop instead of live")
+    parser.add_argument('--analysis-mode', default=os.getenv('ANALYSIS_MODE', 'structured'), choices=['structured', 'separate'])
+    parser.add_argument('--work-dir', default=os.getenv('RECORDINGS_DIR', 'recordings'), help="where the received recordings are kept")
+    parser.add_argument('--db', default=os.getenv('CONSULTATION_DB', 'consultations.db'), help="SQLite consultation store, empty disables")
+    parser.add_argument('--mock', action='store_true', help="use local mock deepgram and openai servers")
+    args = parser.parse_args()
+    metrics.configure(os.getenv('METRICS_FILE', 'metrics.jsonl'), os.getenv('PROMETHEUS_FILE', ''))
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    print('stage latencies\n' + metrics.summary())
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import time
+from urllib.parse import urlencode
+from lazy_import import lazy_import
+aiohttp = lazy_import('aiohttp') # imported on first use, see lazy_import.py
+from transcriber import MAX_QUEUED_CHUNKS, queue_audio
+
+# thin client of server.py (SERVICE_URL): RemoteLiveTranscriber and RemotePipeline stand in for LiveTranscriber and
+# ConsultationPipeline, so the GUI records locally and the transcription and report come from the server
+class ServiceClient:
+    def __init__(self, url: str, timeout: float = 600.0):
+        self.url = url.rstrip('/')
+        self.timeout = timeout # seconds for a whole consultation
+        self.session = None
+
+    # one connection pool for every request, created on the asyncio loop
+    def get_session(self):
+        if self.session is None:
+            self.session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        return self.session
+
+    def websocket_url(self, path: str, params: dict):
+        return self.url.replace('http', 'ws', 1) + path + '?' + urlencode(params)
+
+class RemoteLiveTranscriber:
+    def __init__(self, client: ServiceClient):
+        self.client = client
+
+    # same interface as LiveTranscriber.start, the server runs the live transcription and the rolling summary
+    def start(self, loop: asyncio.AbstractEventLoop, transcript_cback, language: str = "en-US", sample_rate: int = 16000, channels: int = 1,
+              segment_cback=None, audio_format: str = 'flac'):
+        session = RemoteSession(loop, transcript_cback)
+        params = {'language': language, 'sample_rate': sample_rate, 'channels': channels, 'format': audio_format}
+        session.start(self.client, self.client.websocket_url('/v1/stream', params))
+        return session
+
+# one recording streamed to the server. like LiveSession, audio sent before the socket is open is queued, up to
+# MAX_QUEUED_CHUNKS: past that the stream is given up and the recording uploaded on stop
+class RemoteSession:
+    def __init__(self, loop: asyncio.AbstractEventLoop, transcript_cback):
+        self.loop = loop
+        self.transcript_cback = transcript_cback
+        self.audio_queue = asyncio.Queue(MAX_QUEUED_CHUNKS)
+        self.events = asyncio.Queue() # pipeline events from the server, None once the socket is closed
+        self.future = None
+        self.closed = False
+        self.remote_id = None # the server's consultation id
+
+    def start(self, client: ServiceClient, url: str):
+        self.future = asyncio.run_coroutine_threadsafe(self._run(client, url), self.loop)
+
+    # safe to call from the recorder thread
+    def send_audio(self, chunk: bytes):
+        if self.closed or self.future.done():
+            return
+        self.loop.call_soon_threadsafe(queue_audio, self.audio_queue, self.future, chunk)
+
+    # stop the recording on the server and forward its pipeline events to events(event, data).
+    # returns False when the connection was lost before the report was done
+    async def finish(self, events):
+        if self.closed or self.future.cancelled():
+            return False
+        self.closed = True
+        queue_audio(self.audio_queue, self.future, None)
+        while True:
+            message = await self.events.get()
+            if message is None:
+                return False
+            events(message['event'], message['data'])
+            if message['event'] in ('done', 'error'):
+                return True
+
+    async def _run(self, client: ServiceClient, url: str):
+        try:
+            async with client.get_session().ws_connect(url, heartbeat=30) as socket:
+                print("service stream open")
+                sender = asyncio.create_task(self._send_loop(socket))
+                async for message in socket:
+                    if message.type != aiohttp.WSMsgType.TEXT:
+                        continue
+                    message = json.loads(message.data)
+                    if message['event'] == 'transcript':
+                        self.transcript_cback(*message['data'])
+                    elif message['event'] == 'consultation':
+                        self.remote_id = message['data']
+                    else:
+                        self.events.put_nowait(message)
+                sender.cancel()
+        except Exception as e:
+            print(f"service stream exception {e}")
+        finally:
+            self.events.put_nowait(None)
+
+    async def _send_loop(self, socket):
+        while True:
+            chunk = await self.audio_queue.get()
+            if chunk is None:
+                await socket.send_str(json.dumps({'type': 'stop'}))
+                return
+            await socket.send_bytes(chunk)
+
+class RemotePipeline:
+    def __init__(self, client: ServiceClient):
+        self.client = client
+
+    # the server summarizes during the recording when it is configured to
+    def start_rolling_summary(self, consultation_id):
+        return None
+
+    # the server keeps its own connections warm
+    def start_warming(self, loop: asyncio.AbstractEventLoop, live: bool):
+        return None
+
+    # the server uploads the streamed recording itself
+    def start_upload(self, loop: asyncio.AbstractEventLoop, language: str, sample_rate: int, channels: int):
+        return None
+
+    # same interface as ConsultationPipeline.run. without a working stream the local recording is uploaded
+    async def run(self, consultation_id, file_name: str, live_session: RemoteSession, language: str, events_cback, rolling_summary=None):
+        def events(event, data=None):
+            try:
+                events_cback(consultation_id, event, data)
+            except Exception as e:
+                print(f"pipeline event callback exception {e}")
+
+        if live_session is not None and await live_session.finish(events):
+            return
+        if file_name is None:
+            events('error', 'no recording to transcribe')
+            return
+        events('status', 'uploading...')
+        try:
+            await self.upload(file_name, language, events)
+        except Exception as e:
+            print(f"service upload exception {e}")
+            events('error', f"service unavailable: {e}")
+
+    # a busy server (503) is asked again after its Retry-After, until the client timeout has passed
+    async def upload(self, file_name: str, language: str, events):
+        params = {'language': language, 'format': file_name.rsplit('.', 1)[-1]}
+        deadline = time.monotonic() + self.client.timeout
+        while True:
+            with open(file_name, 'rb') as file:
+                async with self.client.get_session().post(self.client.url + '/v1/consultations', params=params, data=file) as response:
+                    if response.status == 503:
+                        retry_after = response.headers.get('Retry-After', '')
+                        retry_after = float(retry_after) if retry_after.isdigit() else 5.0
+                    else:
+                        response.raise_for_status()
+                        async for line in response.content:
+                            if line.strip():
+                                message = json.loads(line)
+                                events(message['event'], message['data'])
+                        return
+            if time.monotonic() + retry_after > deadline:
+                events('error', 'service busy, try again later')
+                return
+            events('status', f"service busy, retrying in {retry_after:.0f} seconds...")
+            await asyncio.sleep(retry_after)
@@ -1,175 +1,643 @@
 import asyncio
-import wave
-import pyaudio
-from deepgram import DeepgramClient, DeepgramClientOptions, PrerecordedOptions, FileSource
-import numpy as np
-import queue
-import logging
-
-# single audio stream that generate audio slices from an input device
+import os
+import threading
+import time
+import json
+from urllib.parse import urlencode
+from lazy_import import lazy_import
+# imported on first use, see lazy_import.py
+pyaudio = lazy_import('pyaudio')
+deepgram = lazy_import('deepgram')
+np = lazy_import('numpy')
+websockets = lazy_import('websockets')
+from audio_processing import RingBuffer, StreamResampler, open_audio_sink, audio_info, audio_file_info
+from vad import TimeMap, VoiceActivityDetector
+from result_cache import ResultCache
+from metrics import metrics
+from http_transport import HttpTransport
+
+# one PortAudio input stream of a recording: the callback only copies the frames into a preallocated ring buffer,
+# the recorder's writer thread drains it and resamples each channel
+class CaptureInput:
+    def __init__(self, device_id, source_rate: int, channels: int, target_rate: int, buffer_seconds: float):
+        self.device_id = device_id
+        self.source_rate = int(source_rate)
+        self.channels = channels
+        self.ring_buffer = RingBuffer(int(source_rate * buffer_seconds) * channels)
+        self.resamplers = [StreamResampler(source_rate, target_rate) for _ in range(channels)]
+        self.stream = None
+        self.first_block_time = None # when the first block was captured, aligns the inputs of a recording
+        self.input_overflows = 0
+        self.max_callback_time = 0.0
+
+    def open(self, p):
+        self.stream = p.open(format=pyaudio.paInt16,
+                             channels=self.channels,
+                             rate=self.source_rate,
+                             input=True,
+                             input_device_index=self.device_id,
+                             frames_per_buffer=int(1024*4),
+                             stream_callback=self._fill_buffer)
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.stop_stream()
+            self.stream.close()
+            self.stream = None
+
+    # resampled samples of every channel since the last call
+    def read(self):
+        in_data = self.ring_buffer.read()
+        if not in_data:
+            return None
+        samples = np.frombuffer(in_data, dtype=np.int16).reshape(-1, self.channels)
+        if self.channels == 1:
+            return [np.frombuffer(self.resamplers[0].process(in_data), dtype=np.int16)]
+        return [np.frombuffer(resampler.process(samples[:, c].tobytes()), dtype=np.int16) for c, resampler in enumerate(self.resamplers)]
+
+    # runs on the PortAudio thread: copy and return, anything slow happens in the writer thread
+    def _fill_buffer(self, in_data, frame_count, time_info, status):
+        start = time.perf_counter()
+        try:
+            if self.first_block_time is None:
+                self.first_block_time = start - frame_count / self.source_rate
+            if status & pyaudio.paInputOverflow:
+                self.input_overflows += 1
+            self.ring_buffer.write(in_data)
+        except Exception as e:
+            print ("fill buffer exception", e)
+        self.max_callback_time = max(self.max_callback_time, time.perf_counter() - start)
+        # never end the stream from here
+        return (None, pyaudio.paContinue)
+
+# audio recording from one or more input streams, one channel of the recorded file per input channel:
+# several mono devices (doctor and patient microphones) or one multichannel device.
+# a writer thread drains the inputs, resamples to sample_rate and encodes to audio_format ('wav', 'flac' or 'opus')
+# as frames arrive. the inputs are aligned by their first captured block; a device whose clock runs slow, or that
+# stops delivering, is padded with silence once it lags more than max_skew_seconds behind the others.
+# with trim_silence the recorded file only keeps speech and short pauses, a time map sidecar maps it back
+# without pyaudio_obj PortAudio is initialized by open_audio(), which can be slow: the GUI calls it in the background
 class AudioRecorder:
-    def __init__(self, pyaudio_obj: pyaudio.PyAudio):
+    def __init__(self, pyaudio_obj=None, sample_rate: int = 16000, audio_format: str = 'wav', buffer_seconds: float = 30.0, trim_silence: bool = False,
+                 max_skew_seconds: float = 0.5):
         self.p = pyaudio_obj
+        self.sample_rate = sample_rate
+        self.audio_format = audio_format
+        self.buffer_seconds = buffer_seconds
+        self.trim_silence = trim_silence
+        self.max_skew_seconds = max_skew_seconds
+        self.vad = None
         self.file_name = 'consulta_audio.wav'
-        self.stream = None
-        self.wave_file = None
+        self.inputs = []
+        self.channels = 1 # channels of the recording, the inputs' channels in order
+        self.stream = None # first input's stream, None when not recording
+        self.sink = None
+        self.audio_cback = None
+        self.writer_thread = None
+        self.writer_stop = threading.Event()
+        self.audio_lock = threading.Lock()
+        self.writer_errors = 0
+        self.padded_seconds = 0.0 # silence inserted to keep the inputs aligned
 
-    def start(self, device_id, source_rate, file_name = 'consulta_audio.wav'):
+    # audio_cback receives the resampled frames (channels interleaved), from the writer thread
+    def start(self, device_id, source_rate, file_name = 'consulta_audio.wav', audio_cback = None, channels: int = 1):
+        self.start_inputs([(device_id, source_rate, channels)], file_name, audio_cback)
+
+    # inputs: (device_id, source_rate, channels) of each stream to record
+    def start_inputs(self, inputs, file_name = 'consulta_audio.wav', audio_cback = None):
         try:
-            self.file_name = file_name
-            self.stream = self.p.open(format=pyaudio.paInt16,
-                                    channels=1,
-                                    rate=int(source_rate),
-                                    input=True,
-                                    input_device_index=device_id,
-                                    frames_per_buffer=int(1024*4),
-                                    stream_callback=self._fill_file)
-            self.wave_file = wave.open(self.file_name, 'wb')
-            self.wave_file.setnchannels(1)
-            self.wave_file.setsampwidth(self.p.get_sample_size(pyaudio.paInt16))
-            self.wave_file.setframerate(source_rate)
+            self.audio_cback = audio_cback
+            self.inputs = [CaptureInput(device_id, source_rate, channels, self.sample_rate, self.buffer_seconds) for device_id, source_rate, channels in inputs]
+            self.channels = sum(capture_input.channels for capture_input in self.inputs)
+            self.vad = VoiceActivityDetector(self.sample_rate, channels=self.channels) if self.trim_silence else None
+            self.sink = open_audio_sink(file_name, self.sample_rate, self.channels)
+            self.file_name = self.sink.file_name
+            TimeMap.discard(self.file_name)
+            self.writer_errors = 0
+            self.padded_seconds = 0.0
+            self.writer_stop.clear()
+            self.writer_thread = threading.Thread(target=self._drain_buffer, daemon=True)
+            self.writer_thread.start()
+            p = self.open_audio()
+            for capture_input in self.inputs:
+                capture_input.open(p)
+            self.stream = self.inputs[0].stream
         except Exception as e:
             print(f"start audio recording exception {e}")
+            for capture_input in self.inputs:
+                capture_input.close()
+            self.writer_stop.set()
+
+    def open_audio(self):
+        with self.audio_lock:
+            if self.p is None:
+                self.p = pyaudio.PyAudio()
+        return self.p
+
+    def terminate(self):
+        if self.p is not None:
+            self.p.terminate()
 
     def stop(self):
         try:
             if self.stream is None:
                 return None
-            self.stream.stop_stream()
-            self.stream.close()
+            for capture_input in self.inputs:
+                capture_input.close()
             self.stream = None
-            if self.wave_file is None:
+            # the writer drains what is left in the buffers and closes the file
+            self.writer_stop.set()
+            with metrics.span('writer_drain'):
+                self.writer_thread.join()
+            self.writer_thread = None
+            print(f"recording stats {self.get_stats()}")
+            if self.sink is None:
                 return None
-            self.wave_file.close()
-            self.wave_file = None
+            if self.vad is not None:
+                self.sink.write(self.vad.flush())
+                self.vad.time_map.save(self.file_name)
+                self._report_trimming()
+            with metrics.span('file_close', format=self.audio_format):
+                self.sink.close()
+            self.sink = None
             return self.file_name
         except Exception as e:
             print(f"stop audio recording exception {e}")
             return None
 
-    def _fill_file(self, in_data, frame_count, time_info, status):
+    # overruns: blocks dropped by a full ring buffer, input_overflows: blocks PortAudio reported as overflowed,
+    # queue_depth: seconds of audio waiting for the writer (the most behind input), padded_seconds: silence inserted to keep the inputs aligned, summed over the channels
+    def get_stats(self):
+        if not self.inputs:
+            return {}
+        return {
+            'overruns': sum(x.ring_buffer.overruns for x in self.inputs),
+            'input_overflows': sum(x.input_overflows for x in self.inputs),
+            'queue_depth': max(x.ring_buffer.depth() / x.channels / x.source_rate for x in self.inputs),
+            'max_queue_depth': max(x.ring_buffer.max_depth / x.channels / x.source_rate for x in self.inputs),
+            'max_callback_time': max(x.max_callback_time for x in self.inputs),
+            'writer_errors': self.writer_errors,
+            'padded_seconds': self.padded_seconds,
+        }
+
+    # upload size and transcription time scale with the audio duration
+    def _report_trimming(self):
+        stats = self.vad.get_stats()
+        removed = stats['original_seconds'] - stats['kept_seconds']
+        print(f"silence trimming: kept {stats['kept_seconds']:.1f}s of {stats['original_seconds']:.1f}s, "
+              f"removed {stats['removed_fraction'] * 100:.0f}% ({removed:.1f}s, ~{removed * self.sample_rate * 2 * self.channels / 1e6:.1f} MB of PCM not uploaded or billed)")
+
+    def _drain_buffer(self):
+        pending = [np.zeros(0, dtype=np.int16) for _ in range(self.channels)] # resampled samples not written yet, per channel
+        aligned = len(self.inputs) == 1
+        max_skew = int(self.max_skew_seconds * self.sample_rate)
+        while True:
+            stopping = self.writer_stop.is_set()
+            received = False
+            channel = 0
+            for capture_input in self.inputs:
+                try:
+                    samples = capture_input.read()
+                except Exception as e:
+                    self.writer_errors += 1
+                    print ("resample exception", e)
+                    samples = None
+                if samples is not None:
+                    received = True
+                    for c, channel_samples in enumerate(samples):
+                        pending[channel + c] = np.concatenate((pending[channel + c], channel_samples))
+                channel += capture_input.channels
+            if not aligned and self._inputs_started():
+                self._align_start(pending)
+                aligned = True
+            if aligned:
+                self._pad_lagging(pending, max_skew if not stopping else 0)
+                count = min(len(x) for x in pending)
+                if count:
+                    self._write(np.stack([x[:count] for x in pending], axis=1).tobytes())
+                    pending = [x[count:] for x in pending]
+            if stopping and not received:
+                if not aligned:
+                    self._pad_lagging(pending, 0)
+                    count = min(len(x) for x in pending)
+                    if count:
+                        self._write(np.stack([x[:count] for x in pending], axis=1).tobytes())
+                return
+            if not received:
+                self.writer_stop.wait(0.02)
+
+    # every input delivered its first block, or the others have been waiting for a silent device long enough
+    def _inputs_started(self):
+        started = [x.first_block_time for x in self.inputs if x.first_block_time is not None]
+        if len(started) == len(self.inputs):
+            return True
+        return bool(started) and time.perf_counter() - min(started) > 4 * self.max_skew_seconds
+
+    # inputs that started capturing later start with silence
+    def _align_start(self, pending):
+        first = min(x.first_block_time for x in self.inputs if x.first_block_time is not None)
+        channel = 0
+        for capture_input in self.inputs:
+            start = capture_input.first_block_time if capture_input.first_block_time is not None else time.perf_counter()
+            delay = int((start - first) * self.sample_rate)
+            for c in range(channel, channel + capture_input.channels):
+                pending[c] = np.concatenate((np.zeros(delay, dtype=np.int16), pending[c]))
+            channel += capture_input.channels
+
+    # channels more than max_skew samples behind the most advanced one catch up with silence
+    def _pad_lagging(self, pending, max_skew):
+        longest = max(len(x) for x in pending)
+        for c, samples in enumerate(pending):
+            if longest - len(samples) > max_skew:
+                pending[c] = np.concatenate((samples, np.zeros(longest - len(samples), dtype=np.int16)))
+                if max_skew:
+                    self.padded_seconds += (longest - len(samples)) / self.sample_rate
+
+    def _write(self, frames: bytes):
         try:
-            self.wave_file.writeframes(in_data)
-            return (None, pyaudio.paContinue)
+            # the live transcription still gets every frame, only the upload is trimmed
+            self.sink.write(self.vad.process(frames) if self.vad is not None else frames)
+            if self.audio_cback is not None:
+                self.audio_cback(frames)
         except Exception as e:
-            print ("fill buffer exception", e)
+            self.writer_errors += 1
+            print ("write buffer exception", e)
     
+# speaker of a word: its channel in multichannel recordings (e.g. ['Doctor', 'Patient']), the diarized speaker otherwise
+def speaker_label(speaker, speaker_names=None):
+    if speaker_names and 0 <= speaker < len(speaker_names):
+        return speaker_names[speaker]
+    return f"Speaker {speaker}"
+
+# "Speaker N: ..." lines, a new line when the speaker changes
+def format_speaker_words(words, speaker_names=None):
+    lines = []
+    last_speaker = object()
+    for word in words:
+        if word['speaker'] != last_speaker:
+            speaker = f"{speaker_label(word['speaker'], speaker_names)}: " if word['speaker'] is not None else ""
+            lines.append(speaker + word['word'])
+            last_speaker = word['speaker']
+        else:
+            lines[-1] += " " + word['word']
+    return "\n".join(lines)
+
+# multichannel recordings (one microphone per speaker) are transcribed per channel instead of diarized,
+# each word's speaker is its channel, named by channel_names
 class AudioTranscriber:
-    def __init__(self, DEEPGRAM_API_KEY: str):
-        # config: DeepgramClientOptions = DeepgramClientOptions(verbose=logging.SPAM)
-        self.client = DeepgramClient(api_key=DEEPGRAM_API_KEY)
+    # url: another deepgram endpoint, e.g. the mock server of the benchmarks.
+    # transport: connection pool shared with the other API clients, a new connection per request otherwise
+    def __init__(self, DEEPGRAM_API_KEY: str, cache: ResultCache = None, url: str = "", channel_names: list = None, transport: HttpTransport = None):
+        self.api_key = DEEPGRAM_API_KEY
+        self.url = url
+        self.channel_names = channel_names
+        self.cache = cache # results keyed by audio hash + options
+        self.transport = transport
+        self.client_lock = threading.Lock()
+        self._client = None
+        self._prerecorded = None
+
+    # built on first use, the deepgram SDK import is slow
+    @property
+    def client(self):
+        with self.client_lock:
+            if self._client is None:
+                # config: DeepgramClientOptions = DeepgramClientOptions(verbose=logging.SPAM)
+                options = deepgram.DeepgramClientOptions(url=self.url) if self.url else None
+                self._client = deepgram.DeepgramClient(self.api_key, options)
+            return self._client
 
-    def transcribe(self, file_name: str, language: str = "en-US"):
+    # the SDK opens a new HTTP client per request (AbstractAsyncRestClient._handle_request),
+    # with a transport its requests go through the shared pool instead
+    @property
+    def prerecorded(self):
+        if self._prerecorded is None:
+            prerecorded = self.client.listen.asyncprerecorded.v("1")
+            if self.transport is not None:
+                prerecorded._handle_request = self._pooled_request
+            self._prerecorded = prerecorded
+        return self._prerecorded
+
+    # same arguments and result as the SDK's _handle_request
+    async def _pooled_request(self, method: str, url: str, params: dict = None, addons: dict = None, timeout=None, headers: dict = None, **kwargs):
+        for query in (params, addons):
+            if query is not None:
+                url = deepgram.clients.helpers.append_query_params(url, query)
+        if timeout is not None:
+            kwargs['timeout'] = timeout # the transport's default is the SDK's
+        response = await self.transport.client.request(method, url, headers=headers, **kwargs)
+        response.raise_for_status()
+        return response.text
+
+    # where HttpTransport.warm opens the connections of the uploads, same url as the SDK without importing it
+    @property
+    def warm_url(self):
+        url = (self.url or "api.deepgram.com").rstrip('/')
+        return (url if url.startswith(('http://', 'https://')) else "https://" + url) + "/v1/listen"
+
+    # runs on the asyncio loop, the file read and the upload don't block the caller
+    async def transcribe(self, file_name: str, language: str = "en-US", time_map: TimeMap = None):
+        result = await self.transcribe_detailed(file_name, language, time_map)
+        return result['transcript'] if result is not None else None
+
+    # transcript plus the diarized words ({'word', 'start', 'end', 'speaker'}).
+    # time_map maps word times of a silence-trimmed recording back to the original recording.
+    # the file is streamed to the API from disk, memory use doesn't grow with the recording length
+    async def transcribe_detailed(self, file_name: str, language: str = "en-US", time_map: TimeMap = None):
         try:
             print('transcribing', file_name)
-            with open(file_name, "rb") as file:
-                buffer_data = file.read()
-            print('file read...')
-            payload = {"buffer": buffer_data}
-            options = PrerecordedOptions(model="nova-2", language=language, smart_format=True, diarize=True) # nova-2-medical is [en, en-US] only
+            info = await asyncio.to_thread(audio_file_info, file_name) # header only
+            options = self._options(language, info)
+            cache_key = None
+            if self.cache is not None:
+                with metrics.span('file_read'):
+                    cache_key = await asyncio.to_thread(ResultCache.make_file_key, self._cache_description(options), file_name)
+            size = os.path.getsize(file_name)
+        except Exception as e:
+            print(f"transcription exception: {e}")
+            return None
+        return await self._transcribe(options, cache_key, lambda: {"stream": file_chunks(file_name)}, size, time_map)
+
+    async def transcribe_buffer(self, buffer_data: bytes, language: str = "en-US", time_map: TimeMap = None):
+        options = self._options(language, audio_info(buffer_data))
+        cache_key = ResultCache.make_key(self._cache_description(options), buffer_data) if self.cache is not None else None
+        return await self._transcribe(options, cache_key, lambda: {"buffer": buffer_data}, len(buffer_data), time_map)
+
+    # record straight into a transcription request, see UploadSession
+    def start_upload(self, loop: asyncio.AbstractEventLoop, language: str = "en-US", sample_rate: int = 16000, channels: int = 1):
+        session = UploadSession(loop, self, language, sample_rate, channels)
+        session.start()
+        return session
+
+    # info: (channels, seconds) of the recording, or None
+    def _options(self, language: str, info):
+        options = {"model": "nova-2", "language": language, "smart_format": True} # nova-2-medical is [en, en-US] only
+        if info is not None and info[0] > 1:
+            options["multichannel"] = True
+        else:
+            options["diarize"] = True
+        return options
+
+    # the channel names are part of a multichannel transcript
+    def _cache_description(self, options: dict):
+        return [options, self.channel_names] if options.get("multichannel") else options
+
+    # payload() builds the request source, only called on a cache miss
+    async def _transcribe(self, options: dict, cache_key: str, payload, size: int, time_map: TimeMap):
+        result = None
+        if cache_key is not None:
+            result = self.cache.get(cache_key)
+            print('transcription cache', 'hit' if result is not None else 'miss')
+        if result is None:
+            result = await self._request_transcription(payload(), options, size)
+            if result is None:
+                return None
+            if cache_key is not None:
+                self.cache.put(cache_key, result)
+        if time_map is not None:
+            for word in result['words']:
+                word['start'], word['end'] = time_map.to_original(word['start']), time_map.to_original(word['end'])
+        return result
+
+    # payload: {"buffer": bytes} or {"stream": async iterator of bytes}, sent with chunked transfer encoding.
+    # addons are extra query parameters, e.g. the encoding of raw audio
+    async def _request_transcription(self, payload: dict, options: dict, size: int = None, addons: dict = None):
+        try:
             print('sending to deepgram...')
-            response = self.client.listen.prerecorded.v("1").transcribe_file(payload, options)
+            # upload and transcription are a single request
+            with metrics.span('transcription_request', bytes=size):
+                response = await self.prerecorded.transcribe_file(payload, deepgram.PrerecordedOptions(**options), addons)
             print('checking response and returning...')
-            if response and response.results and response.results.channels and response.results.channels[0].alternatives and response.results.channels[0].alternatives[0].transcript:
+            if options.get("multichannel") and response and response.results and response.results.channels:
+                words = []
+                for channel, result in enumerate(response.results.channels):
+                    if result.alternatives:
+                        words += [{'word': word.punctuated_word or word.word, 'start': word.start, 'end': word.end, 'speaker': channel}
+                                  for word in result.alternatives[0].words or []]
+                words.sort(key=lambda word: word['start'])
+                if words:
+                    print('valid response!')
+                    return {'transcript': format_speaker_words(words, self.channel_names), 'words': words}
+            elif response and response.results and response.results.channels and response.results.channels[0].alternatives and response.results.channels[0].alternatives[0].transcript:
                 print('valid response!')
-                return response.results.channels[0].alternatives[0].transcript
+                alternative = response.results.channels[0].alternatives[0]
+                words = [{'word': word.punctuated_word or word.word, 'start': word.start, 'end': word.end, 'speaker': word.speaker}
+                         for word in alternative.words or []]
+                return {'transcript': alternative.transcript, 'words': words}
             print('INvalid response!')
             return None
         except Exception as e:
             print(f"transcription exception: {e}")
             return None
 
+MAX_QUEUED_CHUNKS = 500 # recorder chunks waiting for a streaming connection, several seconds of audio
 
-# # accept audio slices and sends them to deepgram returning transcriptions
-# class DeepgramTranscriber:
-#     def __init__(self, DEEPGRAM_API_KEY):
-#         self.client = Deepgram(DEEPGRAM_API_KEY)
-#         self.deepgram_live = None
-#         self.results_queue = None
-#         self.last_speaker = ""
-
-#     async def initialize(self, results_queue: queue.Queue, language: str, channels: int, multichannel: bool):
-#         self.results_queue = results_queue
-#         try:
-#             # create a websocket connection to deepgram
-#             self.deepgram_live = await self.client.transcription.live(
-#                 { 
-#                     "smart_format": True, 
-#                     "model": "nova-2", 
-#                     "language": language,
-#                     "encoding": "linear16",
-#                     "multichannel": multichannel,
-#                     "channels": channels,
-#                     "sample_rate": 16000
-#                 }
-#             )
-#             print("transcription live")
-#         except Exception as e:
-#             print(f'could not open deepgram socket: {e}')
-        
-#         # deepgram events
-#         self.deepgram_live.register_handler(
-#             self.deepgram_live.event.TRANSCRIPT_RECEIVED, 
-#             self._transcript_received
-#         )
-
-#         self.deepgram_live.register_handler(
-#             self.deepgram_live.event.CLOSE,
-#             lambda _: print('deepgram connection closed')
-#         )
-    
-#     # put transcription results on queue appending the speaker prefix when needed.
-#     async def _transcript_received(self, transcript_json: dict):
-#         if not 'channel' in transcript_json:
-#             return
-        
-#         transcription: str = transcript_json['channel']['alternatives'][0]['transcript']
-        
-#         # stop propagation if empty
-#         if not transcription:
-#             return
-        
-#         # clear new lines
-#         transcription = transcription.replace('\n', '').replace('\r', '')
-
-#         # check need for prefix and speaker identifier
-#         is_channel_0 = transcript_json['channel_index'][0] == 0
-#         msg_type = 'user_msg' if is_channel_0 else 'system_msg'
-#         speaker = 'user: ' if is_channel_0 else 'system: '
-#         if self.last_speaker == "":
-#             # first message
-#             transcription = speaker + transcription
-#         elif speaker != self.last_speaker:
-#             # new speaker
-#             transcription = "\n" + speaker + transcription
-#         else:
-#             # same speaker
-#             transcription = " " + transcription
-        
-#         # put message in queue for consumption
-#         try:
-#             self.results_queue.put_nowait((msg_type, transcription))
-#         except queue.Full:
-#             print("results queue full")
-#         except Exception as e:
-#             print(f"results queue exception {e}")
-        
-#         # update last speaker
-#         self.last_speaker = speaker
-    
-#     # sends audio chunk to live transcription API
-#     def send_audio(self, chunk):
-#         try:
-#             self.deepgram_live.send(chunk)
-#         except Exception as e:
-#             print(f"deepgram send audio exception {e}")
-    
-#     async def close(self):
-#         # check if deepgram connection is open before finishing
-#         if self.deepgram_live is None:
-#             return
-#         try:
-#             await self.deepgram_live.finish()
-#             self.deepgram_live = None
-#         except:
-#             print("exception when closing deepgram")
+# puts a recorder chunk on a streaming session's queue, on the session's loop. a connection too slow for the audio
+# gives up the session instead of buffering without limit: future (the session's run) is cancelled, its finish
+# returns None and the recording on disk is transcribed as usual
+def queue_audio(audio_queue: asyncio.Queue, future, chunk):
+    try:
+        audio_queue.put_nowait(chunk)
+    except asyncio.QueueFull:
+        if not future.done():
+            print(f"audio stream can't keep up, {audio_queue.maxsize} chunks queued: giving up the stream")
+            future.cancel()
+
+# the upload body of a recording, read from disk a block at a time
+async def file_chunks(file_name: str, block_size: int = 1 << 18):
+    with open(file_name, "rb") as file:
+        while True:
+            block = await asyncio.to_thread(file.read, block_size)
+            if not block:
+                return
+            yield block
+
+# records straight into a transcription request: the recorder's frames (raw 16-bit PCM) are uploaded while the
+# consultation goes on, so on stop only the last frames are left to send and no file is read back.
+# same interface as LiveSession, finish returns the transcription
+class UploadSession:
+    def __init__(self, loop: asyncio.AbstractEventLoop, transcriber: AudioTranscriber, language: str, sample_rate: int, channels: int):
+        self.loop = loop
+        self.transcriber = transcriber
+        self.language = language
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.audio_queue = asyncio.Queue(MAX_QUEUED_CHUNKS)
+        self.future = None
+        self.closed = False
+        self.sent_bytes = 0
+
+    def start(self):
+        self.future = asyncio.run_coroutine_threadsafe(self._run(), self.loop)
+
+    # safe to call from the recorder's writer thread
+    def send_audio(self, chunk: bytes):
+        if self.closed or self.future.done():
+            return
+        self.loop.call_soon_threadsafe(queue_audio, self.audio_queue, self.future, chunk)
+
+    # end the upload and wait for the transcription. runs on the asyncio loop
+    async def finish(self, timeout: float = 300.0):
+        if self.closed or self.future.cancelled():
+            return None
+        self.closed = True
+        queue_audio(self.audio_queue, self.future, None)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(self.future), timeout)
+        except asyncio.CancelledError:
+            if not self.future.cancelled():
+                raise
+            return None # given up while recording
+        except Exception as e:
+            print(f"upload transcription finish exception {e}")
+            return None
+
+    async def _run(self):
+        options = self.transcriber._options(self.language, (self.channels, None))
+        addons = {"encoding": "linear16", "sample_rate": self.sample_rate, "channels": self.channels}
+        result = await self.transcriber._request_transcription({"stream": self._chunks()}, options, addons=addons)
+        print(f"uploaded {self.sent_bytes} bytes while recording")
+        return result['transcript'] if result is not None else None
+
+    async def _chunks(self):
+        while True:
+            chunk = await self.audio_queue.get()
+            if chunk is None:
+                return
+            self.sent_bytes += len(chunk)
+            yield chunk
+
+
+# accept audio slices during recording and stream them to deepgram, reporting interim and final transcriptions
+# multichannel audio is transcribed per channel, the channel being the speaker (named by channel_names)
+class LiveTranscriber:
+    def __init__(self, DEEPGRAM_API_KEY: str, url: str = "wss://api.deepgram.com/v1/listen", channel_names: list = None):
+        self.api_key = DEEPGRAM_API_KEY
+        self.url = url # point to a local stand-in (see mock_servers.py) for testing
+        self.channel_names = channel_names
+
+    # open a live session on the asyncio loop; audio sent before the socket is open is queued.
+    # segment_cback, when given, receives every final segment on the asyncio loop
+    def start(self, loop: asyncio.AbstractEventLoop, transcript_cback, language: str = "en-US", sample_rate: int = 16000, channels: int = 1,
+              segment_cback=None):
+        params = {
+            "model": "nova-2",
+            "language": language,
+            "smart_format": "true",
+            "interim_results": "true",
+            "encoding": "linear16",
+            "sample_rate": int(sample_rate),
+            "channels": channels,
+        }
+        if channels > 1:
+            params["multichannel"] = "true"
+        else:
+            params["diarize"] = "true"
+        session = LiveSession(loop, transcript_cback, segment_cback, self.channel_names if channels > 1 else None, channels > 1)
+        session.start(f"{self.url}?{urlencode(params)}", {"Authorization": f"Token {self.api_key}"})
+        return session
+
+# one live websocket connection, consultations run independent sessions so a new one can start while the last one flushes
+class LiveSession:
+    def __init__(self, loop: asyncio.AbstractEventLoop, transcript_cback, segment_cback=None, speaker_names: list = None, multichannel: bool = False):
+        self.loop = loop
+        self.transcript_cback = transcript_cback
+        self.segment_cback = segment_cback
+        self.speaker_names = speaker_names
+        self.multichannel = multichannel # speakers are the channels
+        self.audio_queue = asyncio.Queue(MAX_QUEUED_CHUNKS)
+        self.future = None
+        self.closed = False
+        self.final_segments = []
+        self.last_speaker = None
+
+    def start(self, uri: str, headers: dict):
+        self.future = asyncio.run_coroutine_threadsafe(self._run(uri, headers), self.loop)
+
+    # sends audio chunk to live transcription API, safe to call from the PyAudio callback thread
+    def send_audio(self, chunk: bytes):
+        if self.closed or self.future.done():
+            return
+        self.loop.call_soon_threadsafe(queue_audio, self.audio_queue, self.future, chunk)
+
+    # flush the remaining audio, wait for the last results and return the full final transcription.
+    # runs on the asyncio loop.
+    async def finish(self, timeout: float = 10.0):
+        if self.closed or self.future.cancelled():
+            return None
+        self.closed = True
+        queue_audio(self.audio_queue, self.future, None)
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(self.future), timeout)
+        except asyncio.CancelledError:
+            if not self.future.cancelled():
+                raise
+            return None # given up while recording
+        except Exception as e:
+            print(f"live transcription finish exception {e}")
+            return None
+
+    async def _run(self, uri: str, headers: dict):
+        try:
+            async with websockets.connect(uri, extra_headers=headers) as socket:
+                print("transcription live")
+                sender = asyncio.create_task(self._send_loop(socket))
+                # the server closes the socket once every pending result has been delivered
+                await self._receive_loop(socket)
+                sender.cancel()
+        except Exception as e:
+            print(f"live transcription exception {e}")
+            return None
+        print("deepgram connection closed")
+        transcription = "".join(self.final_segments).strip()
+        return transcription if transcription else None
+
+    async def _send_loop(self, socket):
+        while True:
+            chunk = await self.audio_queue.get()
+            if chunk is None:
+                await socket.send(json.dumps({"type": "CloseStream"}))
+                return
+            await socket.send(chunk)
+
+    async def _receive_loop(self, socket):
+        async for message in socket:
+            if isinstance(message, bytes):
+                continue
+            result = json.loads(message)
+            if result.get("type") != "Results":
+                continue
+            alternative = result["channel"]["alternatives"][0]
+            transcription: str = alternative.get("transcript", "").replace('\n', '').replace('\r', '')
+            is_final = result.get("is_final", False)
+            if is_final:
+                words = alternative.get("words", [])
+                if self.multichannel:
+                    speaker = result.get("channel_index", [0])[0]
+                else:
+                    speaker = words[0]['speaker'] if words and 'speaker' in words[0] else None
+                transcription = self._add_speaker_prefix(transcription, speaker)
+                self.final_segments.append(transcription)
+            try:
+                self.transcript_cback(transcription, is_final)
+                if is_final and transcription and self.segment_cback is not None:
+                    self.segment_cback(transcription)
+            except Exception as e:
+                print(f"transcript callback exception {e}")
+
+    # prefix the speaker identifier when the speaker changes
+    def _add_speaker_prefix(self, transcription: str, speaker):
+        if not transcription:
+            return transcription
+        speaker = f"{speaker_label(speaker, self.speaker_names)}: " if speaker is not None else ""
+        if self.last_speaker is None:
+            # first message
+            transcription = speaker + transcription
+        elif speaker != self.last_speaker:
+            # new speaker
+            transcription = "\n" + speaker + transcription
+        else:
+            # same speaker
+            transcription = " " + transcription
+        self.last_speaker = speaker
+        return transcription
@@ -0,0 +1,135 @@
+import threading
+import time
+import tkinter as tk
+
+# batches the GUI updates into frames of at most max_fps per second.
+# calls are queued from any thread and run in order on the Tk thread, then every view they changed is rendered once
+class RenderScheduler:
+    def __init__(self, root: tk.Tk, max_fps: float = 30):
+        self.root = root
+        self.interval = 1 / max_fps
+        self.lock = threading.Lock()
+        self.calls = []
+        self.dirty = {} # views to render, in request order
+        self.scheduled = False
+        self.last_frame = 0.0
+
+    # thread safe
+    def call(self, fn, *args):
+        with self.lock:
+            self.calls.append((fn, args))
+            self._schedule()
+
+    # Tk thread, the view is rendered with the next frame
+    def request(self, view):
+        with self.lock:
+            self.dirty[view] = None
+            self._schedule()
+
+    def _schedule(self):
+        if self.scheduled:
+            return # joins the frame already scheduled
+        self.scheduled = True
+        delay = max(self.last_frame + self.interval - time.perf_counter(), 0)
+        try:
+            self.root.after(int(delay * 1000), self._frame)
+        except RuntimeError:
+            pass # window closed
+
+    def _frame(self):
+        self.last_frame = time.perf_counter()
+        with self.lock:
+            calls, self.calls = self.calls, []
+        for fn, args in calls:
+            try:
+                fn(*args)
+            except Exception as e:
+                print(f"render call exception {e}")
+        # views changed by the calls above are rendered in this frame
+        with self.lock:
+            views, self.dirty = list(self.dirty), {}
+            self.scheduled = False
+            if self.calls: # queued by other threads during this frame
+                self._schedule()
+        for view in views:
+            try:
+                view.render()
+            except Exception as e:
+                print(f"render exception {e}")
+
+# ScrolledText content kept as pending changes, applied as one diff per frame: only new text is inserted.
+# interim text (tagged 'interim') is shown after the text and replaced by each update.
+# with max_chars only the end of a long text stays in the widget, the start is replaced by a notice
+class TextView:
+    def __init__(self, textbox, scheduler: RenderScheduler, max_chars: int = None):
+        self.textbox = textbox
+        self.scheduler = scheduler
+        self.max_chars = max_chars
+        self.replace = False # clear the widget before inserting
+        self.pending = [] # (text, tag) to insert
+        self.interim = ''
+        self.interim_changed = False
+        self.placeholder = False # the content is replaced by the next append
+        self.widget_chars = 0 # text chars in the widget, interim and notice excluded
+        self.hidden_chars = 0 # chars removed from the start of the widget
+        textbox.tag_configure('interim', foreground='gray')
+        textbox.tag_configure('hidden', foreground='gray')
+
+    def set(self, text: str, tag: str = None):
+        self.replace = True
+        self.pending = [(text, tag)] if text else []
+        self.interim = ''
+        self.placeholder = tag == 'placeholder'
+        self.scheduler.request(self)
+
+    def clear(self):
+        self.set('')
+
+    def set_placeholder(self, text: str):
+        self.set(text, 'placeholder')
+
+    def append(self, text: str, tag: str = None):
+        if self.placeholder:
+            return self.set(text, tag)
+        self.pending.append((text, tag))
+        self.scheduler.request(self)
+
+    def set_interim(self, text: str):
+        self.interim = text
+        self.interim_changed = True
+        self.scheduler.request(self)
+
+    def render(self):
+        if not (self.replace or self.pending or self.interim_changed):
+            return
+        textbox = self.textbox
+        # keep following the end unless the user scrolled up
+        follow = self.replace or textbox.yview()[1] >= 0.999
+        if self.replace:
+            textbox.delete('1.0', tk.END)
+            self.widget_chars = self.hidden_chars = 0
+        elif textbox.tag_ranges('interim'):
+            textbox.delete('interim.first', 'interim.last')
+        for text, tag in self.pending:
+            textbox.insert(tk.END, text, tag)
+            self.widget_chars += len(text)
+        if self.interim:
+            textbox.insert(tk.END, self.interim, 'interim')
+        self.replace, self.pending, self.interim_changed = False, [], False
+        # trim a quarter past the limit at once rather than a little every frame
+        if self.max_chars and self.widget_chars > self.max_chars * 1.25:
+            self.hide(self.widget_chars - self.max_chars)
+        if follow:
+            textbox.see(tk.END)
+
+    def hide(self, count: int):
+        textbox = self.textbox
+        start = '1.0'
+        if textbox.tag_ranges('hidden'):
+            start = 'hidden.last'
+        textbox.delete(start, f'{start} + {count} chars')
+        if textbox.tag_ranges('hidden'):
+            textbox.delete('hidden.first', 'hidden.last')
+        self.widget_chars -= count
+        self.hidden_chars += count
+        textbox.insert('1.0', f"[{self.hidden_chars} earlier characters not shown]\n", 'hidden')
@@ -0,0 +1,133 @@
+import bisect
+import collections
+import json
+import os
+from lazy_import import lazy_import
+np = lazy_import('numpy') # imported on first use, see lazy_import.py
+
+# maps times of the trimmed recording back to the original recording.
+# segments are (trimmed_start, original_start) pairs, one for each continuous span of kept audio
+class TimeMap:
+    def __init__(self, segments=None):
+        self.segments = segments if segments is not None else []
+
+    def add(self, trimmed_start: float, original_start: float):
+        # only record discontinuities
+        if self.segments:
+            last_trimmed, last_original = self.segments[-1]
+            if abs((original_start - last_original) - (trimmed_start - last_trimmed)) < 1e-6:
+                return
+        self.segments.append((trimmed_start, original_start))
+
+    def to_original(self, t: float):
+        if not self.segments:
+            return t
+        i = max(bisect.bisect_right(self.segments, (t, float('inf'))) - 1, 0)
+        trimmed_start, original_start = self.segments[i]
+        return original_start + (t - trimmed_start)
+
+    # sidecar file stored next to the recording
+    @staticmethod
+    def sidecar_name(file_name: str):
+        return file_name + '.timemap.json'
+
+    def save(self, file_name: str):
+        with open(self.sidecar_name(file_name), 'w') as file:
+            json.dump(self.segments, file)
+
+    # a new recording of that name must not pick up an earlier recording's map
+    @staticmethod
+    def discard(file_name: str):
+        try:
+            os.remove(TimeMap.sidecar_name(file_name))
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def load(file_name: str):
+        sidecar = TimeMap.sidecar_name(file_name)
+        if not os.path.exists(sidecar):
+            return None
+        with open(sidecar) as file:
+            return TimeMap([tuple(x) for x in json.load(file)])
+
+# energy / zero-crossing-rate voice activity detector for 16-bit PCM.
+# speech is kept, each pause is shortened to max_pause_ms and the rest of the pause is dropped.
+# multichannel audio (interleaved) is detected on the channels' mix and cut the same on every channel
+class VoiceActivityDetector:
+    def __init__(self, sample_rate: int = 16000, frame_ms: int = 30, threshold_db: float = 9.0,
+                 hangover_ms: int = 300, preroll_ms: int = 150, max_pause_ms: int = 600, channels: int = 1):
+        self.sample_rate = sample_rate
+        self.channels = channels
+        self.frame_size = int(sample_rate * frame_ms / 1000)
+        self.threshold_db = threshold_db
+        self.hangover_frames = hangover_ms // frame_ms
+        self.preroll_frames = preroll_ms // frame_ms
+        self.max_pause_frames = max_pause_ms // frame_ms
+        self.noise_db = None # adaptive noise floor
+        self.remainder = np.zeros((0, channels), dtype=np.int16)
+        self.silent_frames = 0 # frames since the last speech frame
+        self.preroll = collections.deque(maxlen=max(self.preroll_frames, 1))
+        self.original_samples = 0
+        self.kept_samples = 0
+        self.time_map = TimeMap()
+
+    # returns the audio to keep
+    def process(self, frames: bytes):
+        samples = np.concatenate((self.remainder, np.frombuffer(frames, dtype=np.int16).reshape(-1, self.channels)))
+        count = len(samples) // self.frame_size
+        self.remainder = samples[count * self.frame_size:]
+        kept = []
+        for frame in samples[:count * self.frame_size].reshape(count, self.frame_size, self.channels) if count else []:
+            if self._is_speech(frame.mean(axis=1) if self.channels > 1 else frame[:, 0]):
+                if self.silent_frames > self.max_pause_frames:
+                    # speech resumes after a dropped span: keep a little audio before the onset
+                    for dropped_start, dropped in self.preroll:
+                        self._keep(dropped, dropped_start, kept)
+                self.silent_frames = 0
+            else:
+                self.silent_frames += 1
+            if self.silent_frames <= max(self.max_pause_frames, self.hangover_frames):
+                self._keep(frame, self.original_samples, kept)
+                self.preroll.clear()
+            else:
+                self.preroll.append((self.original_samples, frame))
+            self.original_samples += self.frame_size
+        return b''.join(x.tobytes() for x in kept)
+
+    # the trailing partial frame is kept as is
+    def flush(self):
+        frame, self.remainder = self.remainder, np.zeros((0, self.channels), dtype=np.int16)
+        kept = []
+        if len(frame):
+            self._keep(frame, self.original_samples, kept)
+            self.original_samples += len(frame)
+        return b''.join(x.tobytes() for x in kept)
+
+    def _keep(self, frame, original_start, kept):
+        self.time_map.add(self.kept_samples / self.sample_rate, original_start / self.sample_rate)
+        self.kept_samples += len(frame)
+        kept.append(frame)
+
+    def _is_speech(self, frame):
+        x = frame.astype(np.float32)
+        energy_db = 10 * np.log10(np.mean(x * x) + 1.0)
+        zcr = np.mean(np.abs(np.diff(np.signbit(x).astype(np.int8))))
+        if self.noise_db is None:
+            # capped so a recording starting with speech doesn't take it as the noise level
+            self.noise_db = min(energy_db, 40.0)
+        # the floor follows quiet frames quickly and loud frames slowly
+        rate = 0.2 if energy_db < self.noise_db else 0.005
+        self.noise_db += rate * (energy_db - self.noise_db)
+        above_noise = energy_db - self.noise_db
+        # voiced speech is loud, unvoiced consonants are quieter but have a high zero crossing rate
+        return above_noise > self.threshold_db or (above_noise > self.threshold_db / 2 and 0.25 < zcr < 0.6)
+
+    def get_stats(self):
+        original = self.original_samples / self.sample_rate
+        kept = self.kept_samples / self.sample_rate
+        return {
+            'original_seconds': original,
+            'kept_seconds': kept,
+            'removed_fraction': 1 - kept / original if original else 0.0,
+        }